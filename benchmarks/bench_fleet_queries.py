@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Time the fleet wide package queries on the bitmaps of the package sets.
+
+Usage: python3 benchmarks/bench_fleet_queries.py [nb_hosts] [nb_packages]
+"""
+
+import sys
+
+import fleet
+
+from oneconf.hosts import Hosts
+from oneconf.packagesethandler import PackageSetHandler
+
+
+def bench(nb_hosts, nb_packages):
+    hostids = fleet.generate_fleet(nb_hosts, nb_packages)
+    handler = PackageSetHandler(Hosts())
+
+    def common_with_sets():
+        package_lists = [handler.get_packages(hostid) for hostid in hostids]
+        return sorted(frozenset(package_lists[0]).intersection(
+            *package_lists[1:]))
+
+    print("%d hosts, %d packages per host" % (nb_hosts, nb_packages))
+    print("  loading all hosts:    %8.2f ms" % (fleet.best_time(
+        lambda: handler.get_common_packages(), 1) * 1000))
+    assert handler.get_common_packages() == common_with_sets()
+    queries = (
+        ("common (name sets)", common_with_sets),
+        ("common", handler.get_common_packages),
+        ("common manual", lambda: handler.get_common_packages(True)),
+        ("unique", lambda: handler.get_unique_packages(hostids[-1])),
+        ("drift", handler.get_hosts_drift),
+        ("drift manual", lambda: handler.get_hosts_drift(None, None, True)),
+        )
+    for name, query in queries:
+        print("  %-20s %8.2f ms" % (name, fleet.best_time(query) * 1000))
+
+
+if __name__ == '__main__':
+    nb_hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    nb_packages = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    bench(nb_hosts, nb_packages)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Load test the real infra client and SyncHandler over HTTP.
+
+A local WebCatalog stand-in server is started and every simulated client is
+a separate process, with its own hostid, syncing through
+infraclient_pristine. Usage:
+  python3 benchmarks/bench_http_sync.py [--clients 20] [--packages 2000]
+      [--syncs 3] [--network-delay 0] [--output results.json]
+"""
+
+from optparse import OptionParser
+import json
+import os
+import subprocess
+import sys
+import time
+
+import fleet
+
+
+def run_client(service_root, nb_packages, nb_syncs):
+    '''Sync nb_syncs times as the current host, print timings as json'''
+    # network and sso are forced off, the syncs are started by hand
+    os.environ["ONECONF_NET_CONNECTED"] = "False"
+    os.environ["ONECONF_SSO_CRED"] = "False"
+    from piston_mini_client.auth import OAuthAuthorizer
+    from oneconf import metrics
+    from oneconf.hosts import get_host_identity, get_hosts
+    from oneconf.networksync import SyncHandler
+    from oneconf.networksync.infraclient_pristine import WebCatalogAPI
+    from oneconf.packagesethandler import PackageSetHandler
+
+    class LocalWebCatalogAPI(WebCatalogAPI):
+        '''plain http to the local server, even for authenticated calls'''
+        def _path2url(self, path, scheme=None):
+            return WebCatalogAPI._path2url(self, path)
+
+    hostid = get_host_identity()[0]
+    fleet.generate_host(hostid, nb_packages)
+    hosts = get_hosts()
+    authorizer = OAuthAuthorizer(token_key='token', token_secret='secret',
+                                 consumer_key='key',
+                                 consumer_secret='secret')
+    sync_handler = SyncHandler(
+        hosts, PackageSetHandler(hosts),
+        LocalWebCatalogAPI(service_root=service_root, auth=authorizer))
+    sync_handler._can_sync = True
+    sync_times = []
+    for i in range(nb_syncs):
+        start = time.time()
+        sync_handler.process_sync()
+        sync_times.append(time.time() - start)
+    print(json.dumps({'hostid': hostid, 'sync_times': sync_times,
+                      'metrics': metrics.get_metrics()}))
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def run_load_test(nb_clients, nb_packages, nb_syncs, network_delay):
+    '''Spawn nb_clients syncing clients at once against a local server'''
+    from oneconf.networksync.webcatalog_server import WebCatalogServer
+
+    server = WebCatalogServer()
+    server.silo.set_setting('fake_network_delay', network_delay)
+    server.start()
+    start = time.time()
+    try:
+        clients = []
+        for i in range(nb_clients):
+            hostid = 'client%04d' % i
+            env = dict(os.environ)
+            env['ONECONF_HOST'] = '%s:%s' % (hostid, hostid)
+            clients.append(subprocess.Popen(
+                [sys.executable, __file__, '--client', server.service_root,
+                 '--packages', str(nb_packages), '--syncs', str(nb_syncs)],
+                stdout=subprocess.PIPE, env=env, universal_newlines=True))
+        client_results = []
+        for client in clients:
+            (output, error) = client.communicate()
+            if client.returncode:
+                raise RuntimeError("a client failed with %s" %
+                                   client.returncode)
+            client_results.append(json.loads(output.strip().splitlines()[-1]))
+    finally:
+        server.stop()
+    duration = time.time() - start
+
+    first_syncs = [result['sync_times'][0] for result in client_results]
+    next_syncs = [sync_time for result in client_results
+                  for sync_time in result['sync_times'][1:]]
+    report = {'clients': nb_clients, 'packages': nb_packages,
+              'syncs': nb_syncs, 'network_delay': network_delay,
+              'duration': duration,
+              'first_sync_median': percentile(first_syncs, 0.5),
+              'first_sync_p95': percentile(first_syncs, 0.95),
+              'server': server.stats}
+    if next_syncs:
+        report['next_sync_median'] = percentile(next_syncs, 0.5)
+        report['next_sync_p95'] = percentile(next_syncs, 0.95)
+    return report
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--clients", type="int", default=20,
+                      help="number of simultaneous clients")
+    parser.add_option("--packages", type="int", default=2000,
+                      help="number of packages per client")
+    parser.add_option("--syncs", type="int", default=3,
+                      help="number of syncs per client")
+    parser.add_option("--network-delay", type="float", default=0,
+                      help="seconds added by the server to every request")
+    parser.add_option("--output", help="save the results as json in OUTPUT")
+    parser.add_option("--client", metavar="SERVICE_ROOT",
+                      help="internal: run as a client of SERVICE_ROOT")
+    (options, args) = parser.parse_args()
+
+    if options.client:
+        run_client(options.client, options.packages, options.syncs)
+        sys.exit(0)
+
+    report = run_load_test(options.clients, options.packages, options.syncs,
+                           options.network_delay)
+    print("%(clients)d clients, %(packages)d packages, %(syncs)d syncs each: "
+          "%(duration).2f s" % report)
+    print("  first sync: median %.1f ms, p95 %.1f ms" %
+          (report['first_sync_median'] * 1000,
+           report['first_sync_p95'] * 1000))
+    if 'next_sync_median' in report:
+        print("  next syncs: median %.1f ms, p95 %.1f ms" %
+              (report['next_sync_median'] * 1000,
+               report['next_sync_p95'] * 1000))
+    for endpoint in sorted(report['server']):
+        stats = report['server'][endpoint]
+        print("  %-20s %6d requests, %10d bytes in, %10d bytes out" %
+              (endpoint, stats['requests'], stats['bytes_received'],
+               stats['bytes_sent']))
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Time module imports and oneconf-query startup in direct mode.
+
+Every measure is a fresh process. Usage:
+  python3 benchmarks/bench_import.py [nb_runs]
+"""
+
+import subprocess
+import sys
+import time
+
+import fleet
+
+COMMANDS = (
+    ("python startup",
+     [sys.executable, "-c", "pass"]),
+    ("import oneconf.packagesethandler",
+     [sys.executable, "-c", "import oneconf.packagesethandler"]),
+    ("oneconf-query --direct --hosts",
+     [sys.executable, "./oneconf-query", "--direct", "--hosts"]),
+    ("oneconf-query --direct --list",
+     [sys.executable, "./oneconf-query", "--direct", "--list"]),
+    )
+
+
+def run_time(command):
+    '''Return the wall clock time of running command in a new process'''
+    start = time.time()
+    subprocess.check_call(command, stdout=subprocess.PIPE)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    nb_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    fleet.generate_fleet(10, 2000)
+    for name, command in COMMANDS:
+        times = sorted(run_time(command) for i in range(nb_runs))
+        print("%-35s min %7.1f ms  median %7.1f ms" %
+              (name, times[0] * 1000, times[len(times) // 2] * 1000))
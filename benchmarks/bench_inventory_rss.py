@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Compare the service RSS when the local package list is computed in
+process or in a short lived worker process.
+
+The real apt cache is used when python-apt is installed, a synthetic cache
+of the same magnitude otherwise.
+Usage: python3 benchmarks/bench_inventory_rss.py [nb_updates]
+"""
+
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+
+from oneconf.distributor import Distro
+from oneconf import inventoryworker
+from oneconf.packageset import PackageSet
+
+NB_CACHE_PACKAGES = 60000
+
+
+class SyntheticAptDistro(Distro):
+    '''Build a cache of every available package, as apt does'''
+
+    def compute_local_packagelist(self):
+        cache = [{'name': 'package%05d' % i,
+                  'version': '1.%d-0ubuntu%d' % (i, i % 7),
+                  'description': 'Description of package %d ' % i * 8,
+                  'depends': ['package%05d' % ((i * 7 + j) %
+                                               NB_CACHE_PACKAGES)
+                              for j in range(5)],
+                  'installed': i % 20 == 0,
+                  'auto': i % 3 != 0}
+                 for i in range(NB_CACHE_PACKAGES)]
+        return dict((pkg['name'], {'auto': pkg['auto']})
+                    for pkg in cache if pkg['installed'])
+
+
+def get_distro():
+    try:
+        from oneconf.distributor.Ubuntu import Ubuntu
+        return Ubuntu()
+    except ImportError:
+        # imported by name, so that the worker can find it
+        from bench_inventory_rss import SyntheticAptDistro
+        return SyntheticAptDistro()
+
+
+def current_rss():
+    '''Return the current RSS of this process, in KiB'''
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def daemon(use_worker, nb_updates):
+    '''Do nb_updates updates as the service does, print RSS as json'''
+    distro = get_distro()
+    start_rss = current_rss()
+    package_sets = []
+    for i in range(nb_updates):
+        if use_worker:
+            package_list = inventoryworker.compute_local_packagelist(distro)
+        else:
+            package_list = distro.compute_local_packagelist()
+        # only the latest list stays loaded
+        package_sets = [PackageSet.from_dict(package_list)]
+        del package_list
+        gc.collect()
+    print(json.dumps({'distro': type(distro).__name__,
+                      'packages': len(package_sets[0]),
+                      'start': start_rss, 'steady': current_rss(),
+                      'peak': resource.getrusage(
+                          resource.RUSAGE_SELF).ru_maxrss,
+                      'worker_peak': resource.getrusage(
+                          resource.RUSAGE_CHILDREN).ru_maxrss}))
+
+
+def bench(nb_updates):
+    # the worker imports the synthetic distro from this directory
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        path for path in (os.path.dirname(os.path.abspath(__file__)),
+                          env.get('PYTHONPATH')) if path)
+    print("%d updates" % nb_updates)
+    for (name, mode) in (("in process", 'inprocess'), ("worker", 'worker')):
+        output = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--daemon', mode,
+             str(nb_updates)], stdout=subprocess.PIPE, env=env,
+            universal_newlines=True).communicate()[0]
+        result = json.loads(output)
+        print("  %-10s %s, %d packages: service RSS start %6d KiB, peak "
+              "%6d KiB, steady %6d KiB, worker peak %6d KiB" %
+              (name, result['distro'], result['packages'], result['start'],
+               result['peak'], result['steady'], result['worker_peak']))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--daemon']:
+        daemon(sys.argv[2] == 'worker', int(sys.argv[3]))
+    else:
+        bench(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
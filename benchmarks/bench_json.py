@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Compare the json serialization backends on package lists.
+
+Usage: python3 benchmarks/bench_json.py [nb_packages]
+"""
+
+import json
+import random
+import sys
+
+import fleet
+
+from oneconf import serialization
+
+
+def bench(nb_packages):
+    package_list = fleet.generate_package_list(
+        fleet.package_names(nb_packages), random.Random(42), share=1)
+    reference = json.dumps(package_list)
+    print("%d packages, default backend: %s" % (nb_packages,
+                                                serialization.BACKEND))
+    for name in serialization.BACKENDS:
+        try:
+            (dumps, loads) = serialization.get_backend(name)
+        except ImportError:
+            print("  %-8s not installed" % name)
+            continue
+        # same content than json, whatever the backend
+        assert json.loads(dumps(package_list)) == package_list
+        assert loads(reference) == package_list
+        dump_time = fleet.best_time(lambda: dumps(package_list))
+        load_time = fleet.best_time(lambda: loads(reference))
+        print("  %-8s dump: %8.2f ms  load: %8.2f ms" %
+              (name, dump_time * 1000, load_time * 1000))
+
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
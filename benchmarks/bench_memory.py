@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Measure the memory taken by the loaded package lists of a fleet.
+
+Usage: python3 benchmarks/bench_memory.py [nb_hosts] [nb_packages]
+"""
+
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+import fleet
+
+from oneconf import packageset, paths
+from oneconf.packageset import PackageSet
+
+
+def measure(load):
+    '''Return (result of load(), bytes it allocated and kept)'''
+    gc.collect()
+    tracemalloc.start()
+    result = load()
+    gc.collect()
+    (size, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (result, size)
+
+
+def bench(nb_hosts, nb_packages):
+    hostids = fleet.generate_fleet(nb_hosts, nb_packages)
+    hostdir = os.path.join(paths.ONECONF_CACHE_DIR, fleet.CURRENT_HOSTID)
+
+    def load_dicts():
+        package_lists = []
+        for hostid in hostids:
+            with open(os.path.join(hostdir, '%s_%s' % (
+                    paths.PACKAGE_LIST_PREFIX, hostid))) as f:
+                package_lists.append(json.load(f))
+        return package_lists
+
+    def load_package_sets():
+        # the shared name table is part of what is measured
+        packageset.name_table = packageset.PackageNameTable()
+        return ([PackageSet.from_dict(package_list)
+                 for package_list in load_dicts()], packageset.name_table)
+
+    print("%d hosts, %d packages per host" % (nb_hosts, nb_packages))
+    (dicts, dicts_size) = measure(load_dicts)
+    nb_loaded = sum(len(package_list) for package_list in dicts)
+    del dicts
+    (package_sets, package_sets_size) = measure(load_package_sets)
+    print("  %d distinct package names" % len(package_sets[1]))
+    del package_sets
+    for (name, size) in (('dicts', dicts_size),
+                         ('PackageSet', package_sets_size)):
+        print("  %-12s %10.1f KiB per host, %6.1f bytes per package" %
+              (name, size / 1024.0 / nb_hosts, float(size) / nb_loaded))
+
+
+if __name__ == '__main__':
+    nb_hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    nb_packages = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    bench(nb_hosts, nb_packages)
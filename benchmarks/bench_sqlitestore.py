@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Compare the json package lists with the sqlite store.
+
+Usage: python3 benchmarks/bench_sqlitestore.py [nb_hosts] [nb_packages]
+"""
+
+import os
+import sys
+
+import fleet
+
+from oneconf import paths
+from oneconf.hosts import Hosts
+from oneconf.packagesethandler import PackageSetHandler
+from oneconf.sqlitestore import SqlitePackageStore
+
+
+def bench(nb_hosts, nb_packages):
+    hostids = fleet.generate_fleet(nb_hosts, nb_packages)
+    distant_hostid = hostids[-1]
+    db_path = os.path.join(paths.ONECONF_CACHE_DIR, fleet.CURRENT_HOSTID,
+                           paths.PACKAGE_DB_FILENAME)
+    hosts = Hosts()
+
+    def cold_json_handler():
+        return PackageSetHandler(hosts)
+
+    def migrate():
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        PackageSetHandler(hosts, SqlitePackageStore(db_path))
+
+    print("%d hosts, %d packages per host" % (nb_hosts, nb_packages))
+    print("  sqlite migration:     %8.2f ms" %
+          (fleet.best_time(migrate, 1) * 1000))
+
+    json_handler = cold_json_handler()
+    sqlite_handler = PackageSetHandler(hosts, SqlitePackageStore(db_path))
+    queries = (
+        ("get_packages (cold)",
+         lambda handler: handler.get_packages(distant_hostid), True),
+        ("get_packages", lambda handler: handler.get_packages(distant_hostid),
+         False),
+        ("get_packages manual",
+         lambda handler: handler.get_packages(distant_hostid, None, True),
+         False),
+        ("diff", lambda handler: handler.diff(distant_hostid), False),
+        ("which hosts (cold)",
+         lambda handler: handler.get_hosts_with_package('package00042'),
+         True),
+        ("which hosts",
+         lambda handler: handler.get_hosts_with_package('package00042'),
+         False),
+        )
+    for name, query, cold in queries:
+        if cold:
+            json_time = fleet.best_time(
+                lambda: query(cold_json_handler()), 1)
+        else:
+            json_time = fleet.best_time(lambda: query(json_handler))
+        sqlite_time = fleet.best_time(lambda: query(sqlite_handler))
+        print("  %-20s json: %8.2f ms  sqlite: %8.2f ms" %
+              (name, json_time * 1000, sqlite_time * 1000))
+
+
+if __name__ == '__main__':
+    nb_hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    nb_packages = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    bench(nb_hosts, nb_packages)
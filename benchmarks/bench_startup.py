@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Time from oneconf-service spawn to its first D-Bus reply.
+
+Needs a session bus without any running OneConf service.
+Usage: python3 benchmarks/bench_startup.py [nb_runs] [nb_hosts]
+"""
+
+import subprocess
+import sys
+import time
+
+import fleet
+
+import dbus
+
+from oneconf.dbusconnect import HOSTS_INTERFACE, HOSTS_OBJECT_NAME
+from oneconf.enums import ONECONF_SERVICE_NAME
+
+
+def first_reply_time(bus):
+    '''Spawn the service and return the time to answer get_all_hosts'''
+    start = time.time()
+    service = subprocess.Popen(["./oneconf-service"])
+    try:
+        # don't call before the name is owned, it would D-Bus activate the
+        # installed service instead of this one
+        while not bus.name_has_owner(ONECONF_SERVICE_NAME):
+            if service.poll() is not None:
+                raise RuntimeError("oneconf-service exited early")
+            time.sleep(0.001)
+        hosts = dbus.Interface(
+            bus.get_object(ONECONF_SERVICE_NAME, HOSTS_OBJECT_NAME),
+            HOSTS_INTERFACE)
+        hosts.get_all_hosts()
+        duration = time.time() - start
+        hosts.stop_service()
+    finally:
+        service.wait()
+    return duration
+
+
+if __name__ == '__main__':
+    nb_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    nb_hosts = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    fleet.generate_fleet(nb_hosts, 2000)
+    bus = dbus.SessionBus()
+    if bus.name_has_owner(ONECONF_SERVICE_NAME):
+        print("A OneConf service is already running, stop it first")
+        sys.exit(1)
+    times = sorted(first_reply_time(bus) for i in range(nb_runs))
+    print("spawn to first D-Bus reply (%d runs, %d hosts): "
+          "min %.1f ms, median %.1f ms" %
+          (nb_runs, nb_hosts, times[0] * 1000,
+           times[len(times) // 2] * 1000))
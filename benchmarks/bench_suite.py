@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Time the hot paths on synthetic fleets and save the results as json.
+
+Every (nb_hosts, nb_packages) combination gets a freshly generated cache.
+Compare two revisions by running this on each of them with --output and
+diffing the json files. Usage:
+  python3 benchmarks/bench_suite.py [--hosts 1,50,500]
+      [--packages 1000,20000] [--output results.json] [--no-sync] [--no-dbus]
+      [--network-delay 0]
+"""
+
+from optparse import OptionParser
+import json
+import os
+import platform
+import shutil
+import subprocess
+import time
+
+import fleet
+
+from oneconf import paths
+from oneconf.hosts import Hosts
+from oneconf.packagesethandler import PackageSetHandler
+
+
+def bench_packageset(hostids, repeat):
+    '''Time Hosts() and the package set handler operations'''
+    distant_hostid = hostids[-1]
+    results = {}
+    results['Hosts()'] = fleet.best_time(Hosts, repeat)
+    hosts = Hosts()
+    results['update'] = fleet.best_time(
+        lambda: PackageSetHandler(hosts).update(), repeat)
+    results['get_packages (cold)'] = fleet.best_time(
+        lambda: PackageSetHandler(hosts).get_packages(distant_hostid), repeat)
+    results['diff (cold)'] = fleet.best_time(
+        lambda: PackageSetHandler(hosts).diff(distant_hostid), repeat)
+    handler = PackageSetHandler(hosts)
+    handler.diff(distant_hostid)
+    results['get_packages'] = fleet.best_time(
+        lambda: handler.get_packages(distant_hostid), repeat)
+    results['diff'] = fleet.best_time(
+        lambda: handler.diff(distant_hostid), repeat)
+    return results
+
+
+def bench_sync(hostids, repeat, network_delay):
+    '''Time a first sync downloading every host, then a sync without change
+
+    The fake infra is filled with the generated fleet and the local cache
+    only knows about the current host. Every fake infra call takes
+    network_delay seconds.'''
+    os.environ["ONECONF_NET_CONNECTED"] = "False"
+    os.environ["ONECONF_SSO_CRED"] = "False"
+    from oneconf.networksync import SyncHandler
+    from oneconf.networksync.fake_webcatalog_silo import FakeWebCatalogSilo
+    from oneconf.networksync.infraclient_fake import WebCatalogAPI
+
+    hostdir = os.path.join(paths.ONECONF_CACHE_DIR, fleet.CURRENT_HOSTID)
+    silo = FakeWebCatalogSilo()
+    silo.set_setting('fake_network_delay', network_delay)
+    silo.set_setting('persist_batch_size', 100)
+    with open(os.path.join(hostdir, paths.OTHER_HOST_FILENAME)) as f:
+        silo.get_host_silo().update(json.load(f))
+    for hostid in hostids[1:]:
+        filename = os.path.join(hostdir, '%s_%s' % (paths.PACKAGE_LIST_PREFIX,
+                                                    hostid))
+        with open(filename) as f:
+            silo.get_package_silo()[hostid] = json.load(f)
+    silo_file = os.path.join(fleet.BASE_DIR, 'bench_silo')
+    silo.save_settings(silo_file)
+
+    def sync(first):
+        if first:
+            for hostid in hostids[1:]:
+                os.remove(os.path.join(hostdir, '%s_%s' % (
+                    paths.PACKAGE_LIST_PREFIX, hostid)))
+            shutil.rmtree(os.path.join(hostdir, paths.PACKAGE_LISTS_DIRNAME),
+                          ignore_errors=True)
+            os.remove(os.path.join(hostdir, paths.OTHER_HOST_FILENAME))
+        hosts = Hosts()
+        sync_handler = SyncHandler(hosts, PackageSetHandler(hosts),
+                                   WebCatalogAPI(silo_file))
+        # network and sso are forced off, start the sync by hand
+        sync_handler._can_sync = True
+        start = time.time()
+        sync_handler.process_sync()
+        sync_handler.infraclient.flush()
+        return time.time() - start
+
+    results = {}
+    results['process_sync (first)'] = sync(True)
+    results['process_sync'] = min(sync(False) for i in range(repeat))
+    return results
+
+
+def bench_dbus(hostids, repeat):
+    '''Time D-Bus round trips to a freshly spawned oneconf-service'''
+    import dbus
+    from oneconf.dbusconnect import (
+        HOSTS_INTERFACE, HOSTS_OBJECT_NAME, PACKAGE_SET_INTERFACE)
+    from oneconf.enums import ONECONF_SERVICE_NAME
+
+    bus = dbus.SessionBus()
+    if bus.name_has_owner(ONECONF_SERVICE_NAME):
+        raise RuntimeError("A OneConf service is already running")
+    service = subprocess.Popen(["./oneconf-service"])
+    results = {}
+    try:
+        while not bus.name_has_owner(ONECONF_SERVICE_NAME):
+            if service.poll() is not None:
+                raise RuntimeError("oneconf-service exited early")
+            time.sleep(0.001)
+        proxy = bus.get_object(ONECONF_SERVICE_NAME, HOSTS_OBJECT_NAME)
+        hosts = dbus.Interface(proxy, HOSTS_INTERFACE)
+        packageset = dbus.Interface(proxy, PACKAGE_SET_INTERFACE)
+        distant_hostid = hostids[-1]
+        results['dbus get_all_hosts'] = fleet.best_time(
+            hosts.get_all_hosts, repeat)
+        results['dbus get_packages'] = fleet.best_time(
+            lambda: packageset.get_packages(distant_hostid, '', False),
+            repeat)
+        results['dbus diff'] = fleet.best_time(
+            lambda: packageset.diff(distant_hostid, ''), repeat)
+        hosts.stop_service()
+    finally:
+        service.wait()
+    return results
+
+
+def get_revision():
+    '''Return the current git revision, if any'''
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            stderr=subprocess.PIPE).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--hosts", default="1,50,500",
+                      help="comma separated numbers of hosts")
+    parser.add_option("--packages", default="1000,20000",
+                      help="comma separated numbers of packages per host")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="keep the best of REPEAT runs")
+    parser.add_option("--network-delay", type="float", default=0,
+                      help="seconds taken by every fake infra call")
+    parser.add_option("--output", help="save the results as json in OUTPUT")
+    parser.add_option("--no-sync", action="store_false", dest="sync",
+                      default=True, help="skip the sync benchmarks")
+    parser.add_option("--no-dbus", action="store_false", dest="dbus",
+                      default=True, help="skip the D-Bus benchmarks")
+    (options, args) = parser.parse_args()
+
+    report = {'revision': get_revision(),
+              'python': platform.python_version(),
+              'date': time.time(),
+              'results': []}
+    for nb_hosts in [int(value) for value in options.hosts.split(',')]:
+        for nb_packages in [int(value)
+                            for value in options.packages.split(',')]:
+            print("%d hosts, %d packages per host" % (nb_hosts, nb_packages))
+            hostids = fleet.generate_fleet(nb_hosts, nb_packages)
+            results = bench_packageset(hostids, options.repeat)
+            if options.sync:
+                try:
+                    results.update(bench_sync(hostids, options.repeat,
+                                              options.network_delay))
+                except ImportError as e:
+                    print("  sync benchmarks skipped: %s" % e)
+            if options.dbus:
+                try:
+                    results.update(bench_dbus(hostids, options.repeat))
+                except (ImportError, RuntimeError) as e:
+                    print("  D-Bus benchmarks skipped: %s" % e)
+            for name in sorted(results):
+                print("  %-25s %10.2f ms" % (name, results[name] * 1000))
+                report['results'].append({'hosts': nb_hosts,
+                                          'packages': nb_packages,
+                                          'name': name,
+                                          'seconds': results[name]})
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
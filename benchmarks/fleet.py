@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Synthetic fleet helpers shared by the benchmarks.
+
+This module must be imported before any oneconf module: like the test suite,
+it writes the override file that oneconf.paths reads at import time.
+"""
+
+import atexit
+import errno
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OVERRIDE_FILE = '/tmp/oneconf.override'
+CURRENT_HOSTID = '0000'
+CURRENT_HOSTNAME = 'benchmachine'
+
+# benchmark subprocesses share the setup of their parent
+BASE_DIR = os.environ.get('ONECONF_BENCH_DIR')
+IS_PARENT = BASE_DIR is None
+if IS_PARENT:
+    BASE_DIR = tempfile.mkdtemp(prefix='oneconf-bench-')
+    os.environ['ONECONF_BENCH_DIR'] = BASE_DIR
+CACHE_DIR = os.path.join(BASE_DIR, 'cache')
+SILO_DIR = os.path.join(BASE_DIR, 'silo')
+
+
+def cleanup():
+    try:
+        os.remove(OVERRIDE_FILE)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+    shutil.rmtree(BASE_DIR, ignore_errors=True)
+
+if IS_PARENT:
+    atexit.register(cleanup)
+    with open(OVERRIDE_FILE, 'w') as f:
+        f.write("""[TestSuite]
+ONECONF_CACHE_DIR=%s
+WEBCATALOG_SILO_DIR=%s
+FAKE_WALLPAPER=test/data/wallpaper.png
+FAKE_WALLPAPER_MTIME=0000000000.000042
+MIN_TIME_WITHOUT_ACTIVITY=5
+distro=Test
+""" % (CACHE_DIR, SILO_DIR))
+
+sys.path.insert(0, ROOT_DIR)
+os.chdir(ROOT_DIR)
+os.environ.setdefault("ONECONF_HOST",
+                      "%s:%s" % (CURRENT_HOSTID, CURRENT_HOSTNAME))
+
+
+def package_names(nb_packages):
+    '''Return a stable list of nb_packages fake package names'''
+    return ['package%05d' % i for i in range(nb_packages)]
+
+
+def generate_package_list(names, rand, share=0.9):
+    '''Pick roughly share of names, a third of them manually installed'''
+    return dict((name, {'auto': rand.random() > 0.33})
+                for name in names if rand.random() < share)
+
+
+def generate_fleet(nb_hosts, nb_packages, seed=42):
+    '''Write a cache with nb_hosts hosts (including the current one)
+
+    Return the list of hostids, current one first'''
+    hostdir = os.path.join(CACHE_DIR, CURRENT_HOSTID)
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+    os.makedirs(hostdir)
+    rand = random.Random(seed)
+    names = package_names(nb_packages)
+
+    hostids = [CURRENT_HOSTID] + ['host%04d' % i for i in range(1, nb_hosts)]
+    other_hosts = {}
+    for hostid in hostids:
+        checksum = '%s-%s' % (hostid, seed)
+        with open(os.path.join(hostdir, 'package_list_%s' % hostid), 'w') as f:
+            json.dump(generate_package_list(names, rand), f)
+        if hostid == CURRENT_HOSTID:
+            current_host = {'hostid': hostid, 'hostname': CURRENT_HOSTNAME,
+                            'share_inventory': True, 'logo_checksum': None,
+                            'packages_checksum': checksum}
+        else:
+            other_hosts[hostid] = {'hostname': hostid, 'logo_checksum': None,
+                                   'packages_checksum': checksum}
+    with open(os.path.join(hostdir, 'host'), 'w') as f:
+        json.dump(current_host, f)
+    with open(os.path.join(hostdir, 'other_hosts'), 'w') as f:
+        json.dump(other_hosts, f)
+    return hostids
+
+
+def generate_host(hostid, nb_packages, seed=42):
+    '''Write a cache only knowing hostid, the current host, and its packages
+
+    Return its package list'''
+    hostdir = os.path.join(CACHE_DIR, hostid)
+    shutil.rmtree(hostdir, ignore_errors=True)
+    os.makedirs(hostdir)
+    package_list = generate_package_list(package_names(nb_packages),
+                                         random.Random('%s-%s' % (hostid,
+                                                                  seed)))
+    with open(os.path.join(hostdir, 'package_list_%s' % hostid), 'w') as f:
+        json.dump(package_list, f)
+    with open(os.path.join(hostdir, 'host'), 'w') as f:
+        json.dump({'hostid': hostid, 'hostname': hostid,
+                   'share_inventory': True, 'logo_checksum': None,
+                   'packages_checksum': '%s-%s' % (hostid, seed)}, f)
+    return package_list
+
+
+def best_time(func, repeat=5):
+    '''Return the best wall clock time of repeat calls to func, in seconds'''
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
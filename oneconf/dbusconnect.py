@@ -20,23 +20,35 @@ import dbus
 import dbus.service
 from gi.repository import GLib
 import logging
+import os
 import sys
+import threading
+import time
 
 from gettext import gettext as _
 
 LOG = logging.getLogger(__name__)
 
+from oneconf import metrics
 from oneconf.enums import ONECONF_SERVICE_NAME
+from oneconf.packageset import PackageSet
+from oneconf.packing import pack_diff, pack_packages, unpack_diff, unpack_packages
 
 HOSTS_OBJECT_NAME = "/com/ubuntu/oneconf/HostsHandler"
 PACKAGE_SET_INTERFACE = "com.ubuntu.OneConf.HostsHandler.PackageSetHandler"
 HOSTS_INTERFACE = "com.ubuntu.OneConf.HostsHandler.Hosts"
 ONECONF_DBUS_TIMEOUT = 300
+PACKAGES_PAGE_SIZE = 1000
 
 def none_to_null(var):
     '''return var in dbus compatible format'''
     if not var:
         var = ''
+    elif isinstance(var, (PackageSet, dict)):
+        # package details can mix booleans and strings, whatever the store
+        var = dbus.Dictionary(
+            ((name, dbus.Dictionary(details, signature='sv'))
+             for (name, details) in var.items()), signature='sa{sv}')
     return var
 
 class DbusHostsService(dbus.service.Object):
@@ -45,19 +57,27 @@ class DbusHostsService(dbus.service.Object):
     Dbus service, daemon side
     """
 
-    def __init__(self, loop):
+    def __init__(self, loop, use_sqlite_store=False,
+                 use_inventory_worker=False, use_snapshots=False):
         '''registration over dbus'''
         bus_name = dbus.service.BusName(ONECONF_SERVICE_NAME,
                                         bus=dbus.SessionBus())
         dbus.service.Object.__init__(self, bus_name, HOSTS_OBJECT_NAME)
         # Only import oneconf module now for only getting it on server side
-        from oneconf.hosts import Hosts
+        from oneconf.hosts import get_hosts
 
-        self.hosts = Hosts()
+        self.hosts = get_hosts()
         self._packageSetHandler = None
         self.activity = False
         self.synchandler = None
         self.loop = loop
+        self.use_sqlite_store = use_sqlite_store
+        self.use_inventory_worker = use_inventory_worker
+        self.use_snapshots = use_snapshots
+        self._update_running = False
+        self._update_queued = False
+        self._update_callbacks = []
+        self._queued_update_callbacks = []
 
     # TODO: can be a decorator, handling null case and change the API so that if it returns
     # the None value -> no result
@@ -65,11 +85,29 @@ class DbusHostsService(dbus.service.Object):
         '''Ensure we load the package set handler at the right time'''
         if not self._packageSetHandler:
             from oneconf.packagesethandler import PackageSetHandler, PackageSetInitError
+            store = None
+            if self.use_sqlite_store:
+                from oneconf.paths import PACKAGE_DB_FILENAME
+                from oneconf.sqlitestore import SqlitePackageStore
+                store = SqlitePackageStore(os.path.join(
+                    self.hosts.get_currenthost_dir(), PACKAGE_DB_FILENAME))
+            snapshot_store = None
+            if self.use_snapshots:
+                from oneconf.paths import SNAPSHOTS_DIRNAME
+                from oneconf.snapshotstore import SnapshotStore
+                snapshot_store = SnapshotStore(os.path.join(
+                    self.hosts.get_currenthost_dir(), SNAPSHOTS_DIRNAME))
             try:
-                self._packageSetHandler = PackageSetHandler(self.hosts)
+                self._packageSetHandler = PackageSetHandler(
+                    self.hosts, store, self.use_inventory_worker,
+                    snapshot_store)
             except PackageSetInitError as e:
                 LOG.error (e)
                 self._packageSetHandler = None
+            else:
+                # drift can change in worker threads: signal from the loop
+                self._packageSetHandler.emit_drift_changed = \
+                    lambda *args: GLib.idle_add(self.drift_changed, *args)
         return self._packageSetHandler
 
     @dbus.service.method(HOSTS_INTERFACE)
@@ -86,31 +124,223 @@ class DbusHostsService(dbus.service.Object):
             share_inventory = False
         return self.hosts.set_share_inventory(share_inventory, hostid, hostname)
 
-    @dbus.service.method(PACKAGE_SET_INTERFACE)
-    def get_packages(self, hostid, hostname, only_manual):
+    def _run_in_worker(self, name, func, reply_handler, error_handler):
+        '''run func in a worker thread and send its result from the main loop
+
+        The package set handler serializes the requests itself, this only
+        keeps long apt cache and package list loads out of the main loop.
+        The time until the reply is recorded in the dbus.<name> timer.'''
+        start = time.time()
+        def reply(handler, value):
+            metrics.add_time('dbus.' + name, time.time() - start)
+            handler(value)
+        def work():
+            try:
+                result = func()
+            except Exception as e:
+                LOG.warning("Request failed: %s", e)
+                GLib.idle_add(reply, error_handler, e)
+            else:
+                GLib.idle_add(reply, reply_handler, result)
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+    @dbus.service.method(PACKAGE_SET_INTERFACE, out_signature='v',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def get_packages(self, hostid, hostname, only_manual, reply_handler,
+                     error_handler):
         self.activity = True
         if not self.get_packageSetHandler():
-            return ''
-        return none_to_null(self.get_packageSetHandler().get_packages(hostid, hostname, only_manual))
-
-    @dbus.service.method(PACKAGE_SET_INTERFACE)
-    def diff(self, hostid, hostname):
+            reply_handler('')
+            return
+        self._run_in_worker(
+            'get_packages',
+            lambda: none_to_null(self.get_packageSetHandler().get_packages(
+                hostid, hostname, only_manual)),
+            reply_handler, error_handler)
+
+    @dbus.service.method(PACKAGE_SET_INTERFACE, in_signature='ssbuu',
+                         out_signature='asabu',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def get_packages_page(self, hostid, hostname, only_manual, offset, limit,
+                          reply_handler, error_handler):
         self.activity = True
         if not self.get_packageSetHandler():
-            return ('', '')
-        return self.get_packageSetHandler().diff(hostid, hostname)
-
-    @dbus.service.method(PACKAGE_SET_INTERFACE)
-    def update(self):
+            reply_handler([], [], 0)
+            return
+        def get_page():
+            (page, total) = self.get_packageSetHandler().get_packages_page(
+                hostid, hostname, only_manual, offset, limit)
+            return ([name for (name, auto) in page],
+                    [auto for (name, auto) in page], total)
+        self._run_in_worker('get_packages_page', get_page,
+                            lambda result: reply_handler(*result),
+                            error_handler)
+
+    @dbus.service.method(PACKAGE_SET_INTERFACE,
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def diff(self, hostid, hostname, reply_handler, error_handler):
         self.activity = True
-        if self.get_packageSetHandler():
-            self.get_packageSetHandler().update()
+        if not self.get_packageSetHandler():
+            reply_handler('', '')
+            return
+        self._run_in_worker(
+            'diff',
+            lambda: self.get_packageSetHandler().diff(hostid, hostname),
+            lambda result: reply_handler(*result), error_handler)
+
+    @dbus.service.method(PACKAGE_SET_INTERFACE, in_signature='ss',
+                         out_signature='asasa(sssss)',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def diff_versions(self, hostid, hostname, reply_handler, error_handler):
+        self.activity = True
+        if not self.get_packageSetHandler():
+            reply_handler([], [], [])
+            return
+        self._run_in_worker(
+            'diff_versions',
+            lambda: self.get_packageSetHandler().diff_versions(hostid,
+                                                               hostname),
+            lambda result: reply_handler(*result), error_handler)
+
+    @dbus.service.method(PACKAGE_SET_INTERFACE, in_signature='ssbb',
+                         out_signature='ay',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def get_packages_packed(self, hostid, hostname, only_manual, compress,
+                            reply_handler, error_handler):
+        self.activity = True
+        if not self.get_packageSetHandler():
+            reply_handler(dbus.ByteArray(pack_packages({})))
+            return
+        def get_packed():
+            package_list = PackageSet.from_dict(
+                self.get_packageSetHandler().get_packages(hostid, hostname))
+            if only_manual:
+                package_list = PackageSet(tuple(package_list.manual_names()))
+            return dbus.ByteArray(pack_packages(package_list, compress))
+        self._run_in_worker('get_packages_packed', get_packed, reply_handler,
+                            error_handler)
+
+    @dbus.service.method(PACKAGE_SET_INTERFACE, in_signature='ssb',
+                         out_signature='ay',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def diff_packed(self, hostid, hostname, compress, reply_handler,
+                    error_handler):
+        self.activity = True
+        if not self.get_packageSetHandler():
+            reply_handler(dbus.ByteArray(pack_diff([], [])))
+            return
+        def get_packed():
+            (packages_to_install, packages_to_remove) = \
+                self.get_packageSetHandler().diff(hostid, hostname)
+            return dbus.ByteArray(pack_diff(packages_to_install,
+                                            packages_to_remove, compress))
+        self._run_in_worker('diff_packed', get_packed, reply_handler,
+                            error_handler)
+
+    @dbus.service.method(PACKAGE_SET_INTERFACE,
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def get_hosts_with_package(self, package, only_manual, reply_handler,
+                               error_handler):
+        self.activity = True
+        if not self.get_packageSetHandler():
+            reply_handler('')
+            return
+        self._run_in_worker(
+            'get_hosts_with_package',
+            lambda: none_to_null(
+                self.get_packageSetHandler().get_hosts_with_package(
+                    package, only_manual)),
+            reply_handler, error_handler)
+
+    @dbus.service.method(PACKAGE_SET_INTERFACE, in_signature='ss',
+                         out_signature='a(suu)',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def set_drift_baseline(self, hostid, hostname, reply_handler,
+                           error_handler):
+        self.activity = True
+        if not self.get_packageSetHandler():
+            reply_handler([])
+            return
+        self._run_in_worker(
+            'set_drift_baseline',
+            lambda: self.get_packageSetHandler().set_drift_baseline(
+                hostid, hostname),
+            reply_handler, error_handler)
+
+    @dbus.service.method(PACKAGE_SET_INTERFACE, out_signature='a(suu)',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def get_drift_summary(self, reply_handler, error_handler):
+        self.activity = True
+        if not self.get_packageSetHandler():
+            reply_handler([])
+            return
+        self._run_in_worker(
+            'get_drift_summary',
+            self.get_packageSetHandler().get_drift_summary,
+            reply_handler, error_handler)
+
+    def _request_update(self, reply_handler=None, error_handler=None):
+        '''run an update in a worker, coalescing the concurrent requests
+
+        At most one update runs and one is queued: every request made while
+        an update runs is answered by the queued one.'''
+        if self._update_running:
+            LOG.debug("An update is already in progress, queuing the request")
+            self._update_queued = True
+            if reply_handler:
+                self._queued_update_callbacks.append((reply_handler,
+                                                      error_handler))
+            return
+        if reply_handler:
+            self._update_callbacks.append((reply_handler, error_handler))
+        self._start_update()
+
+    def _start_update(self):
+        self._update_running = True
+        self._run_in_worker('update',
+                            self.get_packageSetHandler().coalesced_update,
+                            self._on_update_done, self._on_update_failed)
+
+    def _update_finished(self):
+        '''Return the callbacks of the finished update, start the queued one'''
+        callbacks = self._update_callbacks
+        self._update_running = False
+        self._update_callbacks = self._queued_update_callbacks
+        self._queued_update_callbacks = []
+        if self._update_queued:
+            self._update_queued = False
+            self._start_update()
+        return callbacks
+
+    def _on_update_done(self, result):
+        (checksum, (added, removed, auto_changed)) = result
+        if added or removed or auto_changed:
+            self.packagelist_delta_changed(
+                self.hosts.current_host['hostid'], checksum, added, removed,
+                auto_changed)
+        for (reply_handler, error_handler) in self._update_finished():
+            reply_handler()
+
+    def _on_update_failed(self, error):
+        for (reply_handler, error_handler) in self._update_finished():
+            error_handler(error)
+
+    @dbus.service.method(PACKAGE_SET_INTERFACE,
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def update(self, reply_handler, error_handler):
+        self.activity = True
+        if not self.get_packageSetHandler():
+            reply_handler()
+            return
+        self._request_update(reply_handler, error_handler)
 
     @dbus.service.method(PACKAGE_SET_INTERFACE)
     def async_update(self):
         self.activity = True
         if self.get_packageSetHandler():
-            GLib.timeout_add_seconds(1, self.get_packageSetHandler().update)
+            self._request_update()
 
     @dbus.service.signal(HOSTS_INTERFACE)
     def hostlist_changed(self):
@@ -120,6 +350,18 @@ class DbusHostsService(dbus.service.Object):
     def packagelist_changed(self, hostid):
         LOG.debug("Send package list changed dbus signal for hostid: %s" % hostid)
 
+    @dbus.service.signal(PACKAGE_SET_INTERFACE, signature='ssasasas')
+    def packagelist_delta_changed(self, hostid, packages_checksum, added,
+                                  removed, auto_changed):
+        LOG.debug("Send package list delta dbus signal for hostid: %s (%s "
+                  "added, %s removed, %s auto flag changed)", hostid,
+                  len(added), len(removed), len(auto_changed))
+
+    @dbus.service.signal(PACKAGE_SET_INTERFACE, signature='suu')
+    def drift_changed(self, hostid, nb_missing, nb_extra):
+        LOG.debug("Send drift changed dbus signal for hostid: %s (%s "
+                  "missing, %s extra)", hostid, nb_missing, nb_extra)
+
     @dbus.service.signal(HOSTS_INTERFACE)
     def logo_changed(self, hostid):
         LOG.debug("Send logo changed dbus signal for hostid: %s" % hostid)
@@ -133,6 +375,16 @@ class DbusHostsService(dbus.service.Object):
         self.activity = True
         return self.hosts.get_last_sync_date()
 
+    @dbus.service.method(HOSTS_INTERFACE, out_signature='a{sd}')
+    def get_metrics(self):
+        self.activity = True
+        return metrics.get_metrics()
+
+    @dbus.service.method(HOSTS_INTERFACE, in_signature='s')
+    def profile_next_sync(self, filename):
+        self.activity = True
+        metrics.profile_next_sync(filename)
+
     @dbus.service.method(HOSTS_INTERFACE)
     def stop_service(self):
         LOG.debug("Request for stopping OneConf service")
@@ -179,6 +431,26 @@ class DbusConnect(object):
             print(e)
             sys.exit(1)
 
+    def iter_packages(self, hostid, hostname, only_manual,
+                      page_size=PACKAGES_PAGE_SIZE):
+        '''yield installed package names sorted, fetching them page by page'''
+
+        offset = 0
+        total = None
+        while total is None or offset < total:
+            try:
+                (names, autos, total) = \
+                    self._get_package_handler_dbusobject().get_packages_page(
+                        hostid, hostname, only_manual, offset, page_size)
+            except dbus.exceptions.DBusException as e:
+                print(e)
+                sys.exit(1)
+            if not names:
+                break
+            for name in names:
+                yield name
+            offset += len(names)
+
     def diff(self, hostid, hostname):
         '''trigger diff handling'''
 
@@ -190,6 +462,75 @@ class DbusConnect(object):
             print(e)
             sys.exit(1)
 
+    def diff_versions(self, hostid, hostname):
+        '''trigger diff_versions handling'''
+
+        try:
+            return self._get_package_handler_dbusobject().diff_versions(
+                hostid, hostname, timeout=ONECONF_DBUS_TIMEOUT)
+        except dbus.exceptions.DBusException as e:
+            print(e)
+            sys.exit(1)
+
+    def get_packages_packed(self, hostid, hostname, only_manual,
+                            compress=False):
+        '''get packages with their auto flag, in one packed reply
+
+        Return: {name: {"auto": bool}}'''
+
+        try:
+            return unpack_packages(
+                self._get_package_handler_dbusobject().get_packages_packed(
+                    hostid, hostname, only_manual, compress,
+                    byte_arrays=True, timeout=ONECONF_DBUS_TIMEOUT))
+        except dbus.exceptions.DBusException as e:
+            print(e)
+            sys.exit(1)
+
+    def diff_packed(self, hostid, hostname, compress=False):
+        '''trigger diff handling, in one packed reply
+
+        Return: (packages_to_install, packages_to_remove)'''
+
+        try:
+            return unpack_diff(
+                self._get_package_handler_dbusobject().diff_packed(
+                    hostid, hostname, compress,
+                    byte_arrays=True, timeout=ONECONF_DBUS_TIMEOUT))
+        except dbus.exceptions.DBusException as e:
+            print(e)
+            sys.exit(1)
+
+    def get_hosts_with_package(self, package, only_manual):
+        '''trigger get_hosts_with_package handling'''
+
+        try:
+            return self._get_package_handler_dbusobject().get_hosts_with_package(
+                package, only_manual)
+        except dbus.exceptions.DBusException as e:
+            print(e)
+            sys.exit(1)
+
+    def set_drift_baseline(self, hostid, hostname):
+        '''trigger set_drift_baseline handling'''
+
+        try:
+            return self._get_package_handler_dbusobject().set_drift_baseline(
+                hostid, hostname, timeout=ONECONF_DBUS_TIMEOUT)
+        except dbus.exceptions.DBusException as e:
+            print(e)
+            sys.exit(1)
+
+    def get_drift_summary(self):
+        '''trigger get_drift_summary handling'''
+
+        try:
+            return self._get_package_handler_dbusobject().get_drift_summary(
+                timeout=ONECONF_DBUS_TIMEOUT)
+        except dbus.exceptions.DBusException as e:
+            print(e)
+            sys.exit(1)
+
     def update(self):
         '''trigger update handling'''
         self._get_package_handler_dbusobject().update(timeout=ONECONF_DBUS_TIMEOUT)
@@ -202,6 +543,22 @@ class DbusConnect(object):
         '''just send a kindly ping to retrieve the last sync date'''
         return self._get_hosts_dbusobject().get_last_sync_date(timeout=ONECONF_DBUS_TIMEOUT)
 
+    def get_metrics(self):
+        '''get the timers and counters of the service'''
+        try:
+            return self._get_hosts_dbusobject().get_metrics()
+        except dbus.exceptions.DBusException as e:
+            print(e)
+            sys.exit(1)
+
+    def profile_next_sync(self, filename):
+        '''ask the service to profile its next sync in filename'''
+        try:
+            self._get_hosts_dbusobject().profile_next_sync(filename)
+        except dbus.exceptions.DBusException as e:
+            print(e)
+            sys.exit(1)
+
     def stop_service(self):
         '''kindly ask the oneconf service to stop'''
         try:
@@ -18,7 +18,8 @@
 
 from gettext import gettext as _
 
-from oneconf.hosts import Hosts, HostError
+from oneconf import metrics
+from oneconf.hosts import HostError, get_hosts
 
 import sys
 
@@ -26,54 +27,120 @@ class DirectConnect(object):
 
     """
     Dummy backend handling exit and exception directly
+
+    With session=True, for using oneconf as a library, the hosts and package
+    set handler are kept alive between calls so that their caches are reused,
+    and HostError is raised to the caller instead of exiting.
     """
 
-    def _ensurePackageSetHandler(self):
-        '''Ensure we import the package set handler at the right time'''
+    def __init__(self, session=False):
+        self.session = session
+        self._packageSetHandler = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''drop the objects kept alive by the session'''
+        self._packageSetHandler = None
+
+    def _get_packageSetHandler(self):
+        '''Return the package set handler, only imported at the right time'''
         from oneconf.packagesethandler import PackageSetHandler
-        self.PackageSetHandler = PackageSetHandler
+        hosts = get_hosts()
+        if not self.session:
+            return PackageSetHandler(hosts)
+        # a new hosts object means that its files changed on disk: the
+        # package lists cache can't be trusted anymore
+        if (self._packageSetHandler is None or
+                self._packageSetHandler.hosts is not hosts):
+            self._packageSetHandler = PackageSetHandler(hosts)
+        return self._packageSetHandler
+
+    def _handle_error(self, error):
+        '''exit with the error message, unless used as a library'''
+        if self.session:
+            raise error
+        print(error)
+        sys.exit(1)
 
     def get_all_hosts(self):
         '''get a dict of all available hosts'''
-        return Hosts().get_all_hosts()
+        return get_hosts().get_all_hosts()
 
     def set_share_inventory(self, share_inventory, hostid=None, hostname=None):
         '''update if we share the chosen host inventory on the server'''
         try:
-            Hosts().set_share_inventory(share_inventory, hostid, hostname)
+            get_hosts().set_share_inventory(share_inventory, hostid, hostname)
         except HostError as e:
-            print(e)
-            sys.exit(1)
+            self._handle_error(e)
 
     def get_packages(self, hostid, hostname, only_manual):
         '''trigger getpackages handling'''
 
         try:
-            self._ensurePackageSetHandler()
-            return self.PackageSetHandler().get_packages(
+            return self._get_packageSetHandler().get_packages(
+                hostid, hostname, only_manual)
+        except HostError as e:
+            self._handle_error(e)
+
+    def iter_packages(self, hostid, hostname, only_manual):
+        '''yield installed package names sorted'''
+
+        try:
+            (page, total) = self._get_packageSetHandler().get_packages_page(
                 hostid, hostname, only_manual)
         except HostError as e:
-            print(e)
-            sys.exit(1)
+            self._handle_error(e)
+        for (name, auto) in page:
+            yield name
 
     def diff(self, hostid, hostname):
         '''trigger diff handling'''
 
         try:
-            self._ensurePackageSetHandler()
-            return self.PackageSetHandler().diff(hostid, hostname)
+            return self._get_packageSetHandler().diff(hostid, hostname)
         except HostError as e:
-            print(e)
-            sys.exit(1)
+            self._handle_error(e)
+
+    def diff_versions(self, hostid, hostname):
+        '''trigger diff_versions handling'''
+
+        try:
+            return self._get_packageSetHandler().diff_versions(hostid,
+                                                               hostname)
+        except HostError as e:
+            self._handle_error(e)
+
+    def get_hosts_with_package(self, package, only_manual):
+        '''trigger get_hosts_with_package handling'''
+
+        return self._get_packageSetHandler().get_hosts_with_package(
+            package, only_manual)
+
+    def set_drift_baseline(self, hostid, hostname):
+        '''trigger set_drift_baseline handling'''
+
+        try:
+            return self._get_packageSetHandler().set_drift_baseline(
+                hostid, hostname)
+        except HostError as e:
+            self._handle_error(e)
+
+    def get_drift_summary(self):
+        '''trigger get_drift_summary handling'''
+
+        return self._get_packageSetHandler().get_drift_summary()
 
     def update(self):
         '''trigger update handling'''
         try:
-            self._ensurePackageSetHandler()
-            self.PackageSetHandler().update()
+            self._get_packageSetHandler().update()
         except HostError as e:
-            print(e)
-            sys.exit(1)
+            self._handle_error(e)
 
     def async_update(self):
         '''only used in fallback mode: no async notion for direct connexion'''
@@ -81,7 +148,16 @@ class DirectConnect(object):
 
     def get_last_sync_date(self):
         '''get last time the store was successfully synced'''
-        return Hosts().get_last_sync_date()
+        return get_hosts().get_last_sync_date()
+
+    def get_metrics(self):
+        '''get the timers and counters of this process'''
+        return metrics.get_metrics()
+
+    def profile_next_sync(self, filename):
+        '''no sync is running in direct mode'''
+        print(_("Nothing done: in direct mode, there is no communication with the service"))
+        sys.exit(1)
 
     def stop_service(self):
         '''kindly ask the oneconf service to stop (not relevant for a direct mode)'''
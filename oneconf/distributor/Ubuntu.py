@@ -42,7 +42,11 @@ class Ubuntu(Distro):
         with apt.Cache() as apt_cache:
             for pkg in apt_cache:
                 if pkg.is_installed:
-                    installed_packages[pkg.name] = {"auto": pkg.is_auto_installed}
+                    installed = pkg.installed
+                    installed_packages[pkg.name] = {
+                        "auto": pkg.is_auto_installed,
+                        "version": installed.version,
+                        "arch": installed.architecture}
 
         return installed_packages
         
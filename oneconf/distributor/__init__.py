@@ -37,21 +37,45 @@ class Distro(object):
     def compute_local_packagelist(self):
         '''Introspect what's installed on this hostid
 
-        Return: installed_packages list
+        Return: installed_packages list, as {name: {"auto": bool}}, with
+                optional "version" and "arch" strings in every entry
         '''
         raise NotImplementedError
 
 
+OS_RELEASE_FILE = "/etc/os-release"
+
+def _get_os_release_id(os_release_file=OS_RELEASE_FILE):
+    """Return the distribution id as lsb_release -i -s would
+
+    The file is parsed directly, avoiding to fork lsb_release which is
+    itself a python script."""
+    distro_id = None
+    try:
+        with open(os_release_file) as f:
+            for line in f:
+                key, sep, value = line.strip().partition('=')
+                if key == 'ID':
+                    distro_id = value.strip('"\'')
+                    break
+    except IOError as e:
+        LOG.debug("Can't read %s: %s" % (os_release_file, e))
+    if not distro_id:
+        LOG.debug("No distro id found, falling back to lsb_release")
+        return subprocess.Popen(
+            ["lsb_release","-i","-s"],
+            stdout=subprocess.PIPE,
+            universal_newlines=True).communicate()[0].strip()
+    # lsb_release returns the capitalized form: "ubuntu" -> "Ubuntu"
+    return distro_id.capitalize()
+
 def _get_distro():
     config = RawConfigParser()
     try:
         config.read(ONECONF_OVERRIDE_FILE)
         distro_id = config.get('TestSuite', 'distro')
     except NoSectionError:
-        distro_id = subprocess.Popen(
-            ["lsb_release","-i","-s"],
-            stdout=subprocess.PIPE,
-            universal_newlines=True).communicate()[0].strip()
+        distro_id = _get_os_release_id()
     LOG.debug("get_distro: '%s'" % distro_id)
     # start with a import, this gives us only a oneconf module
     try:
@@ -64,13 +88,18 @@ def _get_distro():
         return None
     return instance
 
+# singleton, only resolved on first get_distro() call
+_distro_resolved = False
+distro_instance = None
+
 def get_distro():
     """ factory to return the right Distro object """
+    global _distro_resolved, distro_instance
+    if not _distro_resolved:
+        distro_instance = _get_distro()
+        _distro_resolved = True
     return distro_instance
 
-# singleton
-distro_instance=_get_distro()
-
 
 if __name__ == "__main__":
     print(get_distro())
@@ -0,0 +1,140 @@
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+import logging
+
+LOG = logging.getLogger(__name__)
+
+from oneconf.packageset import PackageSet
+from oneconf import serialization, utils
+
+
+class DriftTracker(object):
+    """
+    Persistent drift of every host against a baseline host
+
+    hosts has a {hostid: {"checksum": packages checksum, "missing": [...],
+    "extra": [...]}} format: the sorted baseline packages the host doesn't
+    have, and the sorted packages it has which the baseline doesn't. The
+    baseline packages are kept so that a new baseline list only moves every
+    drift by its own delta.
+    """
+
+    def __init__(self, drift_path):
+        self.drift_path = drift_path
+        try:
+            with open(drift_path, 'r') as f:
+                content = serialization.load(f)
+            self.baseline = content['baseline']
+            self.baseline_checksum = content['baseline_checksum']
+            self.baseline_packages = PackageSet(
+                tuple(content['baseline_packages']))
+            self.hosts = content['hosts']
+        except (IOError, KeyError, TypeError, ValueError):
+            LOG.debug("No valid drift report in %s, no baseline", drift_path)
+            self.baseline = None
+            self.baseline_checksum = None
+            self.baseline_packages = PackageSet()
+            self.hosts = {}
+
+    def save(self, save=utils.save_json_file_update):
+        '''Save the drift report on disk with save(path, content)'''
+        save(self.drift_path,
+             {'baseline': self.baseline,
+              'baseline_checksum': self.baseline_checksum,
+              'baseline_packages': list(self.baseline_packages.names),
+              'hosts': self.hosts})
+
+    def set_baseline(self, hostid, checksum, package_list):
+        '''Use package_list of hostid as the new reference, forget drifts'''
+        LOG.debug("Tracking drift against %s", hostid)
+        self.baseline = hostid
+        self.baseline_checksum = checksum
+        self.baseline_packages = PackageSet.from_dict(package_list)
+        self.hosts = {}
+
+    def is_uptodate(self, hostid, checksum):
+        '''Return True if the drift of hostid is for this exact checksum'''
+        if hostid == self.baseline:
+            return self.baseline_checksum == checksum
+        return (hostid in self.hosts and
+                self.hosts[hostid]['checksum'] == checksum)
+
+    def set_host(self, hostid, checksum, package_list):
+        '''Record the new package list of hostid
+
+        Return: the list of hostids whose drift changed'''
+        package_list = PackageSet.from_dict(package_list)
+        if hostid == self.baseline:
+            return self._move_baseline(checksum, package_list)
+        drift = {'checksum': checksum,
+                 'missing': self.baseline_packages.difference(package_list),
+                 'extra': package_list.difference(self.baseline_packages)}
+        old_drift = self.hosts.get(hostid)
+        self.hosts[hostid] = drift
+        if (old_drift and old_drift['missing'] == drift['missing'] and
+                old_drift['extra'] == drift['extra']):
+            return []
+        return [hostid]
+
+    def _move_baseline(self, checksum, package_list):
+        '''Apply the delta of the baseline package list to every drift
+
+        A package added to the baseline is no more extra on hosts having
+        it and is missing on the others, and conversely when removed.'''
+        added = package_list.difference(self.baseline_packages)
+        removed = self.baseline_packages.difference(package_list)
+        self.baseline_checksum = checksum
+        self.baseline_packages = package_list
+        if not added and not removed:
+            return []
+        for drift in self.hosts.values():
+            missing = set(drift['missing'])
+            extra = set(drift['extra'])
+            for package in added:
+                if package in extra:
+                    extra.remove(package)
+                else:
+                    missing.add(package)
+            for package in removed:
+                if package in missing:
+                    missing.remove(package)
+                else:
+                    extra.add(package)
+            drift['missing'] = sorted(missing)
+            drift['extra'] = sorted(extra)
+        return sorted(self.hosts)
+
+    def remove_host(self, hostid):
+        '''Forget the drift of hostid'''
+        self.hosts.pop(hostid, None)
+
+    def get_drift(self, hostid):
+        '''Return (missing, extra) package names of hostid'''
+        if hostid == self.baseline:
+            return ([], [])
+        drift = self.hosts[hostid]
+        return (drift['missing'], drift['extra'])
+
+    def get_summary(self):
+        '''Return [(hostid, nb missing, nb extra), ...], most drifting first'''
+        summary = [(hostid, len(drift['missing']), len(drift['extra']))
+                   for (hostid, drift) in self.hosts.items()]
+        summary.sort(key=lambda entry: (-entry[1] - entry[2], entry[0]))
+        return summary
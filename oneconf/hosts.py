@@ -17,12 +17,10 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import hashlib
-import json
 import logging
 import os
 import platform
 import sys
-from gi.repository import Gio
 
 from gettext import gettext as _
 
@@ -34,7 +32,7 @@ from oneconf.paths import (
     ONECONF_CACHE_DIR, OTHER_HOST_FILENAME, PACKAGE_LIST_PREFIX,
     PENDING_UPLOAD_FILENAME)
 
-from oneconf import utils
+from oneconf import metrics, serialization, utils
 
 class HostError(Exception):
     def __init__(self, message):
@@ -42,39 +40,64 @@ class HostError(Exception):
     def __str__(self):
         return repr(self.message)
 
+def get_host_identity():
+    '''Return the (hostid, hostname) of the current host'''
+    try:
+        # faking this id for testing purpose. Format is hostid:hostname
+        hostid, hostname = os.environ["ONECONF_HOST"].split(':')
+        LOG.debug("Fake current hostid to %s and hostname to %s" %
+                  (hostid, hostname))
+    except KeyError:
+        with open('/var/lib/dbus/machine-id') as fp:
+            hostid = fp.read()[:-1]
+        hostname = platform.node()
+    return (hostid, hostname)
+
+# shared instance, see get_hosts()
+hosts_instance = None
+
+def get_hosts():
+    '''factory returning the Hosts object shared in the process
+
+    The shared object is only rebuilt if the host identity or the files it
+    loaded changed on disk.'''
+    global hosts_instance
+    if hosts_instance is None or not hosts_instance.is_uptodate():
+        hosts_instance = Hosts()
+    return hosts_instance
+
 class Hosts(object):
     """
     Class to get hosts
     """
 
-    def __init__(self):
+    def __init__(self, cache_dir=None):
         '''initialize database
 
-        This will register/update this host if not already done.
+        This will register/update this host if not already done. cache_dir
+        replaces ONECONF_CACHE_DIR, for simulated hosts.
         '''
 
+        if cache_dir is None:
+            cache_dir = ONECONF_CACHE_DIR
         # create cache dir if doesn't exist
-        if not os.path.isdir(ONECONF_CACHE_DIR):
-            os.makedirs(ONECONF_CACHE_DIR)
-
-        (logo_checksum, logo_path) = self._get_current_wallpaper_data()
-        LOG.debug('LOGO %s: %s' % (logo_checksum, logo_path))
-
-        try:
-            # faking this id for testing purpose. Format is hostid:hostname
-            hostid, hostname = os.environ["ONECONF_HOST"].split(':')
-            LOG.debug("Fake current hostid to %s and hostname to %s" %
-                      (hostid, hostname))
-        except KeyError:
-            with open('/var/lib/dbus/machine-id') as fp:
-                hostid = fp.read()[:-1]
-            hostname = platform.node()
-
-        self._host_file_dir = os.path.join(ONECONF_CACHE_DIR, hostid)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # the wallpaper isn't looked at there: logo work is deferred until
+        # refresh_logo() is called
+        hostid, hostname = get_host_identity()
+
+        # stat of the files loaded in memory, to detect external changes
+        self._file_stamps = {}
+        self._host_file_dir = os.path.join(cache_dir, hostid)
+        # a sync may have stopped in the middle of saving its files
+        utils.recover_json_file_transaction(self._host_file_dir)
         try:
             file_path = os.path.join(self._host_file_dir, HOST_DATA_FILENAME)
             with open(file_path, 'r') as f:
-                self.current_host = json.load(f)
+                with metrics.timer('json_load'):
+                    self.current_host = serialization.load(f)
                 has_changed = False
                 if hostname != self.current_host['hostname']:
                     self.current_host['hostname'] = hostname
@@ -82,28 +105,63 @@ class Hosts(object):
                 if hostid != self.current_host['hostid']:
                     self.current_host['hostid'] = hostid
                     has_changed = True
-                if logo_checksum != self.current_host['logo_checksum']:
-                    if self._create_logo(logo_path):
-                        self.current_host['logo_checksum'] = logo_checksum
-                    has_changed = True
             if has_changed:
                 self.save_current_host()
+            else:
+                self._stamp_file(HOST_DATA_FILENAME)
         except (IOError, ValueError):
             self.current_host = {
                 'hostid': hostid,
                 'hostname': hostname,
                 'share_inventory': False,
-                'logo_checksum': logo_checksum,
+                'logo_checksum': None,
                 'packages_checksum': None,
                 }
             if not os.path.isdir(self._host_file_dir):
                 os.mkdir(self._host_file_dir)
-            if not self._create_logo(logo_path):
-                self.current_host['logo_checksum'] = None
             self.save_current_host()
         self.other_hosts = None
         self.update_other_hosts()
 
+    def _get_file_stamp(self, filename):
+        '''Return a cheap signature of a file of the host directory'''
+        try:
+            stat = os.stat(os.path.join(self._host_file_dir, filename))
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+    def _stamp_file(self, filename):
+        '''Remember the signature of a file we are in sync with'''
+        self._file_stamps[filename] = self._get_file_stamp(filename)
+
+    def is_uptodate(self):
+        '''Return True if the host identity and files didn't change since
+        they were loaded'''
+        if get_host_identity() != (self.current_host['hostid'],
+                                   self.current_host['hostname']):
+            return False
+        for filename in self._file_stamps:
+            if self._file_stamps[filename] != self._get_file_stamp(filename):
+                return False
+        return True
+
+    def refresh_logo(self):
+        '''Refresh the current host logo if the wallpaper changed
+
+        This reads the desktop settings, so it's only done once a logo is
+        really needed.
+        Return True if the logo changed'''
+        (logo_checksum, logo_path) = self._get_current_wallpaper_data()
+        LOG.debug('LOGO %s: %s' % (logo_checksum, logo_path))
+        if logo_checksum == self.current_host['logo_checksum']:
+            return False
+        if not self._create_logo(logo_path):
+            return False
+        self.current_host['logo_checksum'] = logo_checksum
+        self.save_current_host()
+        return True
+
     def _get_current_wallpaper_data(self):
         '''Get current wallpaper metadatas from store'''
         # TODO: add fake objects instead of introducing logic into the code
@@ -111,6 +169,7 @@ class Hosts(object):
         file_path = FAKE_WALLPAPER
         file_mtime = FAKE_WALLPAPER_MTIME
         if not file_path:
+            from gi.repository import Gio
             settings = Gio.Settings.new("org.gnome.desktop.background")
             file_path = settings.get_string("picture-uri")
         if not file_path:
@@ -159,6 +218,7 @@ class Hosts(object):
 
     def update_other_hosts(self):
         '''Update all the other hosts from local store'''
+        self._stamp_file(OTHER_HOST_FILENAME)
         new_other_hosts = self._load_other_hosts()
         if self.other_hosts:
             for old_hostid in self.other_hosts:
@@ -179,7 +239,8 @@ class Hosts(object):
 
         try:
             with open(os.path.join(self._host_file_dir, OTHER_HOST_FILENAME), 'r') as f:
-                return json.load(f)
+                with metrics.timer('json_load'):
+                    return serialization.load(f)
         except (IOError, TypeError, ValueError) as e:
             LOG.warning("Error in loading %s file: %s" % (OTHER_HOST_FILENAME, e))
             return {}
@@ -189,6 +250,7 @@ class Hosts(object):
 
         LOG.debug("Save current host to disk")
         utils.save_json_file_update(os.path.join(self._host_file_dir, HOST_DATA_FILENAME), self.current_host)
+        self._stamp_file(HOST_DATA_FILENAME)
 
     def add_hostid_pending_change(self, change):
         '''Pend a scheduled change for another host on disk
@@ -198,7 +260,7 @@ class Hosts(object):
         LOG.debug("Pend a change for another host on disk")
         try:
             with open(os.path.join(self._host_file_dir, PENDING_UPLOAD_FILENAME), 'r') as f:
-                pending_changes = json.load(f)
+                pending_changes = serialization.load(f)
         except (IOError, ValueError):
             pending_changes = {}
 
@@ -216,7 +278,7 @@ class Hosts(object):
         Return None if nothing in progress'''
         try:
             with open(os.path.join(self._host_file_dir, PENDING_UPLOAD_FILENAME), 'r') as f:
-                return json.load(f)[hostid][attribute]
+                return serialization.load(f)[hostid][attribute]
         except (IOError, KeyError, ValueError):
             return None
 
@@ -332,7 +394,7 @@ class Hosts(object):
         LOG.debug("Getting last sync date with remote server")
         try:
             with open(os.path.join(self._host_file_dir, LAST_SYNC_DATE_FILENAME), 'r') as f:
-                content = json.load(f)
+                content = serialization.load(f)
                 last_sync = content['last_sync']
                 #last_sync = datetime.datetime.fromtimestamp(content['last_sync']).strftime("%X %x")
         except IOError:
@@ -0,0 +1,80 @@
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""Compute the local package list in a short lived subprocess
+
+Opening the apt cache leaves a large memory high-water mark in the process
+doing it. Run in a worker process, that memory goes back to the system as
+soon as the worker exits, and the computation doesn't hold the service's
+interpreter. The package list is streamed back packed (see oneconf.packing).
+
+Worker usage: python -m oneconf.inventoryworker <distro module> <distro class>
+"""
+
+from importlib import import_module
+import logging
+import os
+import resource
+import subprocess
+import sys
+
+import oneconf
+from oneconf import metrics
+from oneconf.packing import pack_packages, unpack_packages
+
+LOG = logging.getLogger(__name__)
+
+
+class InventoryWorkerError(Exception):
+    """The inventory worker didn't send a package list."""
+
+
+def compute_local_packagelist(distro):
+    '''Return distro.compute_local_packagelist() computed in a worker'''
+    distro_class = type(distro)
+    env = dict(os.environ)
+    # the worker imports the same oneconf, even when not installed
+    oneconf_dir = os.path.dirname(os.path.dirname(os.path.abspath(
+        oneconf.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        path for path in (oneconf_dir, env.get('PYTHONPATH')) if path)
+    LOG.debug("Computing the package list in a worker process")
+    with metrics.timer('inventory_worker'):
+        worker = subprocess.Popen(
+            [sys.executable, '-m', __name__, distro_class.__module__,
+             distro_class.__name__], stdout=subprocess.PIPE, env=env)
+        data = worker.communicate()[0]
+    if worker.returncode != 0:
+        raise InventoryWorkerError(
+            "Inventory worker failed with exit code %s" % worker.returncode)
+    LOG.debug("Package list received from the worker (%s bytes, peak worker "
+              "RSS: %s KiB)", len(data),
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return unpack_packages(data)
+
+
+def main():
+    (module_name, class_name) = sys.argv[1:3]
+    distro = getattr(import_module(module_name), class_name)()
+    data = pack_packages(distro.compute_local_packagelist())
+    getattr(sys.stdout, 'buffer', sys.stdout).write(data)
+
+
+if __name__ == '__main__':
+    main()
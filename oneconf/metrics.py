@@ -0,0 +1,119 @@
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Process wide timers and counters, and on demand sync profiling"""
+
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# name -> [number of calls, total time, max time]
+_timers = {}
+# name -> value
+_counters = {}
+_sync_profile_filename = None
+
+
+def count(name, increment=1):
+    '''Increment the name counter'''
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + increment
+
+
+def add_time(name, duration):
+    '''Record one duration, in seconds, for the name timer'''
+    with _lock:
+        timer_values = _timers.setdefault(name, [0, 0.0, 0.0])
+        timer_values[0] += 1
+        timer_values[1] += duration
+        timer_values[2] = max(timer_values[2], duration)
+
+
+@contextmanager
+def timer(name):
+    '''Time the enclosed block in the name timer'''
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_time(name, time.time() - start)
+
+
+def get_metrics():
+    '''Return a flat {name: value} dict of every counter and timer
+
+    Timers are given as name.count, name.total and name.max, in seconds.'''
+    with _lock:
+        metrics = dict((name, float(value))
+                       for (name, value) in _counters.items())
+        for (name, (nb_calls, total, max_time)) in _timers.items():
+            metrics[name + '.count'] = float(nb_calls)
+            metrics[name + '.total'] = total
+            metrics[name + '.max'] = max_time
+    return metrics
+
+
+def reset():
+    '''Forget every recorded value'''
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+class _InstrumentedProxy(object):
+    '''Time every method call on the proxied object'''
+
+    def __init__(self, proxied, prefix):
+        self._proxied = proxied
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attribute = getattr(self._proxied, name)
+        if not callable(attribute):
+            return attribute
+        timer_name = '%s.%s' % (self._prefix, name)
+        def timed_call(*args, **kwargs):
+            with timer(timer_name):
+                return attribute(*args, **kwargs)
+        return timed_call
+
+
+def instrument(proxied, prefix):
+    '''Return a proxy of proxied timing its method calls as prefix.method'''
+    if proxied is None:
+        return None
+    return _InstrumentedProxy(proxied, prefix)
+
+
+def profile_next_sync(filename):
+    '''Ask for the next sync to run under cProfile, stats dumped in filename'''
+    global _sync_profile_filename
+    LOG.debug("Next sync will be profiled in %s", filename)
+    _sync_profile_filename = filename
+
+
+def pop_sync_profile_request():
+    '''Return the requested sync profile filename, if any, only once'''
+    global _sync_profile_filename
+    filename = _sync_profile_filename
+    _sync_profile_filename = None
+    return filename
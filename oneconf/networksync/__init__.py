@@ -19,19 +19,18 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 from gi.repository import GObject, GLib
-import json
 import logging
 import os
 import time
 
 from oneconf.enums import MIN_TIME_WITHOUT_ACTIVITY
-from oneconf import utils
+from oneconf import metrics, packagelistcache, serialization, utils
+from oneconf.packageset import PackageSet
 from .netstatus import NetworkStatusWatcher
 from .ssohandler import LoginBackendDbusSSO
 
 from oneconf.paths import (
-    LAST_SYNC_DATE_FILENAME, ONECONF_CACHE_DIR, OTHER_HOST_FILENAME,
-    PACKAGE_LIST_PREFIX, PENDING_UPLOAD_FILENAME)
+    LAST_SYNC_DATE_FILENAME, OTHER_HOST_FILENAME, PENDING_UPLOAD_FILENAME)
 
 from piston_mini_client.failhandlers import APIError
 try:
@@ -55,12 +54,14 @@ class SyncHandler(GObject.GObject):
         self._can_sync = False
         self.credential = None
         self.hosts = hosts
-        self.infraclient = infraclient
+        self.infraclient = metrics.instrument(infraclient, 'infra')
         self.package_handler = package_handler
 
         if dbusemitter:
             self.emit_new_hostlist = dbusemitter.hostlist_changed
             self.emit_new_packagelist = dbusemitter.packagelist_changed
+            self.emit_new_packagelist_delta = \
+                dbusemitter.packagelist_delta_changed
             self.emit_new_logo = dbusemitter.logo_changed
             self.emit_new_latestsync = dbusemitter.latestsync_changed
 
@@ -104,8 +105,9 @@ class SyncHandler(GObject.GObject):
                 consumer_key=credential['consumer_key'],
                 consumer_secret=credential['consumer_secret'],
                 oauth_realm='Ubuntu Software Center')
-            self.infraclient = WebCatalogAPI(service_root=service_root,
-                                             auth=authorizer)
+            self.infraclient = metrics.instrument(
+                WebCatalogAPI(service_root=service_root, auth=authorizer),
+                'infra')
         self._refresh_can_sync()
 
     def _network_state_changed(self, netstate, connected):
@@ -148,6 +150,11 @@ class SyncHandler(GObject.GObject):
         '''this signal will be bound at init time'''
         LOG.warning("emit_new_packagelist(%s) not bound to anything" % hostid)
 
+    def emit_new_packagelist_delta(self, hostid, packages_checksum, added,
+                                   removed, auto_changed):
+        '''this signal will be bound at init time'''
+        LOG.warning("emit_new_packagelist_delta(%s) not bound to anything" % hostid)
+
     def emit_new_logo(self, hostid):
         '''this signal will be bound at init time'''
         LOG.warning("emit_new_logo(%s) not bound to anything" % hostid)
@@ -164,6 +171,39 @@ class SyncHandler(GObject.GObject):
         # we can't no more sync, removing the timeout
         if not self._can_sync:
             return False
+
+        profile_filename = metrics.pop_sync_profile_request()
+        if not profile_filename:
+            with metrics.timer('sync'):
+                return self._process_sync()
+        import cProfile
+        LOG.info("Profiling this sync in %s", profile_filename)
+        profiler = cProfile.Profile()
+        try:
+            with metrics.timer('sync'):
+                return profiler.runcall(self._process_sync)
+        finally:
+            profiler.dump_stats(profile_filename)
+
+    def _load_stored_packagelist(self, hostdir, checksum):
+        '''Return the package list already stored for checksum or None'''
+        if not packagelistcache.has_package_list(hostdir, checksum):
+            return None
+        try:
+            package_list = packagelistcache.load_content(hostdir, checksum)
+        except (IOError, ValueError):
+            LOG.warning("Stored package list %s is broken, downloading it",
+                        checksum)
+            os.remove(packagelistcache.get_content_path(hostdir, checksum))
+            return None
+        LOG.debug("Package list %s already stored, not downloading it",
+                  checksum)
+        metrics.count('packagelist_download.skipped')
+        return package_list
+
+    def _process_sync(self):
+        '''sync every hosts and packages data with the server'''
+
         LOG.debug("Start processing sync")
 
         # Check server connection
@@ -176,178 +216,226 @@ class SyncHandler(GObject.GObject):
             LOG.error ("WebClient server answer error: %s", e)
             return True
 
-        # Try to do every other hosts pending changes first (we will get fresh
-        # data then)
-        try:
-            pending_upload_filename = os.path.join(
-                self.hosts.get_currenthost_dir(), PENDING_UPLOAD_FILENAME)
-            with open(pending_upload_filename, 'r') as f:
-                pending_changes = json.load(f)
-            # We're going to mutate the dictionary inside the loop, so we need
-            # to make a copy of the keys dictionary view.
-            for hostid in list(pending_changes.keys()):
-                # now do action depending on what needs to be refreshed
-                try:
-                    # we can only remove distant machines for now, not
-                    # register new ones
-                    try:
-                        if not pending_changes[hostid].pop('share_inventory'):
-                            LOG.debug('Removing machine %s requested as a '
-                                      'pending change' % hostid)
-                            self.infraclient.delete_machine(
-                                machine_uuid=hostid)
-                    except APIError as e:
-                        LOG.error("WebClient server doesn't want to remove "
-                                  "hostid (%s): %s" % (hostid, e))
-                        # append it again to be done
-                        pending_changes[hostid]['share_inventory'] = False
-                except KeyError:
-                    pass
-                # after all changes, is hostid still relevant?
-                if not pending_changes[hostid]:
-                    pending_changes.pop(hostid)
-            # no more change, remove the file
-            if not pending_changes:
-                LOG.debug(
-                    "No more pending changes remaining, removing the file")
-                os.remove(pending_upload_filename)
-            # update the remaining tasks
-            else:
-                utils.save_json_file_update(
-                    pending_upload_filename, pending_changes)
-        except IOError:
-            pass
-        except ValueError:
-            LOG.warning("The pending file is broken, ignoring")
-
         current_hostid = self.hosts.current_host['hostid']
         old_hosts = self.hosts.other_hosts
         hostlist_changed = None
         packagelist_changed = []
+        packagelist_deltas = {}
         logo_changed = []
-
-        # Get all machines
-        try:
-            full_hosts_list = self.infraclient.list_machines()
-        except APIError as e:
-            LOG.error("Invalid machine list from server, stopping sync: %s" % e)
-            return True
-        other_hosts = {}
-        distant_current_host = {}
-        for machine in full_hosts_list:
-            hostid = machine.pop("uuid")
-            if hostid != current_hostid:
-                other_hosts[hostid] = machine
-            else:
-                distant_current_host = machine
-
-        # now refresh packages list for every hosts
-        for hostid in other_hosts:
-            # init the list as the infra can not send it
-            if not "packages_checksum" in other_hosts[hostid]:
-                other_hosts[hostid]["packages_checksum"] = None
-            packagelist_filename = os.path.join(self.hosts.get_currenthost_dir(), '%s_%s' % (PACKAGE_LIST_PREFIX, hostid))
-            if self.check_if_refresh_needed(old_hosts, other_hosts, hostid, 'packages'):
-                try:
-                    new_package_list = self.infraclient.list_packages(machine_uuid=hostid)
-                    utils.save_json_file_update(packagelist_filename, new_package_list)
-                    # if already loaded, unload the package cache
-                    if self.package_handler:
-                        try:
-                           self.package_handler.package_list[hostid]['valid'] = False
-                        except KeyError:
-                            pass
-                    packagelist_changed.append(hostid)
-                except APIError as e:
-                    LOG.error ("Invalid package data from server: %s", e)
+        new_package_lists = {}
+
+        # every file of this sync is saved in one commit, when leaving this
+        # block
+        with utils.JsonFileTransaction(
+                self.hosts.get_currenthost_dir()) as transaction:
+            # Try to do every other hosts pending changes first (we will get fresh
+            # data then)
+            try:
+                pending_upload_filename = os.path.join(
+                    self.hosts.get_currenthost_dir(), PENDING_UPLOAD_FILENAME)
+                with open(pending_upload_filename, 'r') as f:
+                    pending_changes = serialization.load(f)
+                # We're going to mutate the dictionary inside the loop, so we need
+                # to make a copy of the keys dictionary view.
+                for hostid in list(pending_changes.keys()):
+                    # now do action depending on what needs to be refreshed
                     try:
-                        old_checksum = old_hosts[hostid]['packages_checksum']
+                        # we can only remove distant machines for now, not
+                        # register new ones
+                        try:
+                            if not pending_changes[hostid].pop('share_inventory'):
+                                LOG.debug('Removing machine %s requested as a '
+                                          'pending change' % hostid)
+                                self.infraclient.delete_machine(
+                                    machine_uuid=hostid)
+                        except APIError as e:
+                            LOG.error("WebClient server doesn't want to remove "
+                                      "hostid (%s): %s" % (hostid, e))
+                            # append it again to be done
+                            pending_changes[hostid]['share_inventory'] = False
                     except KeyError:
-                        old_checksum = None
-                    other_hosts[hostid]['packages_checksum'] = old_checksum
-
-            # refresh the logo for every hosts as well
-            # WORKING but not wanted on the isd side for now
-            #if self.check_if_refresh_needed(old_hosts, other_hosts, hostid, 'logo'):
-            #    try:
-            #        logo_content = self.infraclient.get_machine_logo(machine_uuid=hostid)
-            #        logo_file = open(os.path.join(self.hosts.get_currenthost_dir(), "%s_%s.png" % (LOGO_PREFIX, hostid)), 'wb+')
-            #        logo_file.write(self.infraclient.get_machine_logo(machine_uuid=hostid))
-            #        logo_file.close()
-            #        logo_changed.append(hostid)
-            #    except APIError, e:
-            #        LOG.error ("Invalid data from server: %s", e)
-            #        try:
-            #            old_checksum = old_hosts[hostid]['logo_checksum']
-            #        except KeyError:
-            #            old_checksum = None
-            #        other_hosts[hostid]['logo_checksum'] = old_checksum
-
-        # Now that the package list and logo are successfully downloaded, save
-        # the hosts metadata there. This removes as well the remaining package list and logo
-        LOG.debug("Check if other hosts metadata needs to be refreshed")
-        if other_hosts != old_hosts:
-            LOG.debug("Refresh new host")
-            hostlist_changed = True
-            other_host_filename = os.path.join(ONECONF_CACHE_DIR, current_hostid, OTHER_HOST_FILENAME)
-            utils.save_json_file_update(other_host_filename, other_hosts)
-            self.hosts.update_other_hosts()
-
-        # now push current host
-        if not self.hosts.current_host['share_inventory']:
-            LOG.debug("Ensure that current host is not shared")
+                        pass
+                    # after all changes, is hostid still relevant?
+                    if not pending_changes[hostid]:
+                        pending_changes.pop(hostid)
+                # no more change, remove the file
+                if not pending_changes:
+                    LOG.debug(
+                        "No more pending changes remaining, removing the file")
+                    os.remove(pending_upload_filename)
+                # update the remaining tasks
+                else:
+                    transaction.save(pending_upload_filename, pending_changes)
+            except IOError:
+                pass
+            except ValueError:
+                LOG.warning("The pending file is broken, ignoring")
+
+            # Get all machines
             try:
-                self.infraclient.delete_machine(machine_uuid=current_hostid)
+                full_hosts_list = self.infraclient.list_machines()
             except APIError as e:
-                # just a debug message as it can be already not shared
-                LOG.debug ("Can't delete current host from infra: %s" % e)
-        else:
-            LOG.debug("Push current host to infra now")
-            # check if current host changed
-            try:
-                if self.hosts.current_host['hostname'] != distant_current_host['hostname']:
+                LOG.error("Invalid machine list from server, stopping sync: %s" % e)
+                return True
+            other_hosts = {}
+            distant_current_host = {}
+            for machine in full_hosts_list:
+                hostid = machine.pop("uuid")
+                if hostid != current_hostid:
+                    other_hosts[hostid] = machine
+                else:
+                    distant_current_host = machine
+
+            # now refresh packages list for every hosts. Lists are stored once
+            # per packages checksum, only unknown ones are downloaded.
+            hostdir = self.hosts.get_currenthost_dir()
+            saved_package_lists = {}
+            for hostid in other_hosts:
+                # init the list as the infra can not send it
+                if not "packages_checksum" in other_hosts[hostid]:
+                    other_hosts[hostid]["packages_checksum"] = None
+                if self.check_if_refresh_needed(old_hosts, other_hosts, hostid, 'packages'):
+                    checksum = other_hosts[hostid]['packages_checksum']
                     try:
-                        self.infraclient.update_machine(machine_uuid=current_hostid, hostname=self.hosts.current_host['hostname'])
-                        LOG.debug ("Host data refreshed")
+                        if checksum in saved_package_lists:
+                            # already part of this transaction
+                            new_package_list = saved_package_lists[checksum]
+                            packagelistcache.save_pointer(
+                                hostdir, hostid, checksum, transaction.save)
+                        else:
+                            new_package_list = self._load_stored_packagelist(
+                                hostdir, checksum)
+                            if new_package_list is None:
+                                new_package_list = self.infraclient.list_packages(machine_uuid=hostid)
+                            packagelistcache.save_package_list(
+                                hostdir, hostid, checksum, new_package_list,
+                                transaction.save)
+                            # only the compact form is kept until the commit
+                            new_package_list = PackageSet.from_dict(
+                                new_package_list)
+                            if packagelistcache.is_valid_checksum(checksum):
+                                saved_package_lists[checksum] = new_package_list
+                        if self.package_handler:
+                            packagelist_deltas[hostid] = \
+                                self.package_handler.get_packagelist_delta(
+                                    hostid, new_package_list)
+                        new_package_lists[hostid] = new_package_list
+                        packagelist_changed.append(hostid)
                     except APIError as e:
-                        LOG.error ("Can't update machine: %s", e)
-            except KeyError:
+                        LOG.error ("Invalid package data from server: %s", e)
+                        try:
+                            old_checksum = old_hosts[hostid]['packages_checksum']
+                        except KeyError:
+                            old_checksum = None
+                        other_hosts[hostid]['packages_checksum'] = old_checksum
+
+                # refresh the logo for every hosts as well
+                # WORKING but not wanted on the isd side for now
+                #if self.check_if_refresh_needed(old_hosts, other_hosts, hostid, 'logo'):
+                #    try:
+                #        logo_content = self.infraclient.get_machine_logo(machine_uuid=hostid)
+                #        logo_file = open(os.path.join(self.hosts.get_currenthost_dir(), "%s_%s.png" % (LOGO_PREFIX, hostid)), 'wb+')
+                #        logo_file.write(self.infraclient.get_machine_logo(machine_uuid=hostid))
+                #        logo_file.close()
+                #        logo_changed.append(hostid)
+                #    except APIError, e:
+                #        LOG.error ("Invalid data from server: %s", e)
+                #        try:
+                #            old_checksum = old_hosts[hostid]['logo_checksum']
+                #        except KeyError:
+                #            old_checksum = None
+                #        other_hosts[hostid]['logo_checksum'] = old_checksum
+
+            # Now that the package list and logo are successfully downloaded, save
+            # the hosts metadata there. This removes as well the remaining package list and logo
+            LOG.debug("Check if other hosts metadata needs to be refreshed")
+            if other_hosts != old_hosts:
+                LOG.debug("Refresh new host")
+                hostlist_changed = True
+                other_host_filename = os.path.join(hostdir, OTHER_HOST_FILENAME)
+                transaction.save(other_host_filename, other_hosts)
+
+            # now push current host
+            if not self.hosts.current_host['share_inventory']:
+                LOG.debug("Ensure that current host is not shared")
                 try:
-                    self.infraclient.update_machine(machine_uuid=current_hostid, hostname=self.hosts.current_host['hostname'])
-                    LOG.debug ("New host registered done")
-                    distant_current_host = {'packages_checksum': None, 'logo_checksum': None}
+                    self.infraclient.delete_machine(machine_uuid=current_hostid)
                 except APIError as e:
-                    LOG.error ("Can't register new host: %s", e)
-
-            # local package list
-            if self.check_if_push_needed(self.hosts.current_host, distant_current_host, 'packages'):
-                local_packagelist_filename = os.path.join(self.hosts.get_currenthost_dir(), '%s_%s' % (PACKAGE_LIST_PREFIX, current_hostid))
+                    # just a debug message as it can be already not shared
+                    LOG.debug ("Can't delete current host from infra: %s" % e)
+            else:
+                LOG.debug("Push current host to infra now")
+                # check if current host changed
                 try:
-                    with open(local_packagelist_filename, 'r') as f:
-                        self.infraclient.update_packages(machine_uuid=current_hostid, packages_checksum=self.hosts.current_host['packages_checksum'], package_list=json.load(f))
-                except (APIError, IOError) as e:
-                        LOG.error ("Can't push current package list: %s", e)
-
-            # local logo
-            # WORKING but not wanted on the isd side for now
-            #if self.check_if_push_needed(self.hosts.current_host, distant_current_host, 'logo'):
-            #    logo_file = open(os.path.join(self.hosts.get_currenthost_dir(), "%s_%s.png" % (LOGO_PREFIX, current_hostid))).read()
-            #    try:
-            #        self.infraclient.update_machine_logo(machine_uuid=current_hostid, logo_checksum=self.hosts.current_host['logo_checksum'], logo_content=logo_file)
-            #        LOG.debug ("refresh done")
-            #    except APIError, e:
-            #        LOG.error ("Error while pushing current logo: %s", e)
-
-        # write the last sync date
-        timestamp = str(time.time())
-        content = {"last_sync":  timestamp}
-        utils.save_json_file_update(os.path.join(self.hosts.get_currenthost_dir(), LAST_SYNC_DATE_FILENAME), content)
+                    if self.hosts.current_host['hostname'] != distant_current_host['hostname']:
+                        try:
+                            self.infraclient.update_machine(machine_uuid=current_hostid, hostname=self.hosts.current_host['hostname'])
+                            LOG.debug ("Host data refreshed")
+                        except APIError as e:
+                            LOG.error ("Can't update machine: %s", e)
+                except KeyError:
+                    try:
+                        self.infraclient.update_machine(machine_uuid=current_hostid, hostname=self.hosts.current_host['hostname'])
+                        LOG.debug ("New host registered done")
+                        distant_current_host = {'packages_checksum': None, 'logo_checksum': None}
+                    except APIError as e:
+                        LOG.error ("Can't register new host: %s", e)
+
+                # local package list
+                if self.check_if_push_needed(self.hosts.current_host, distant_current_host, 'packages'):
+                    try:
+                        package_list = packagelistcache.load_package_list(
+                            hostdir, current_hostid)
+                        self.infraclient.update_packages(machine_uuid=current_hostid, packages_checksum=self.hosts.current_host['packages_checksum'], package_list=package_list)
+                    except (APIError, IOError) as e:
+                            LOG.error ("Can't push current package list: %s", e)
+
+                # local logo
+                # WORKING but not wanted on the isd side for now
+                #if self.check_if_push_needed(self.hosts.current_host, distant_current_host, 'logo'):
+                #    logo_file = open(os.path.join(self.hosts.get_currenthost_dir(), "%s_%s.png" % (LOGO_PREFIX, current_hostid))).read()
+                #    try:
+                #        self.infraclient.update_machine_logo(machine_uuid=current_hostid, logo_checksum=self.hosts.current_host['logo_checksum'], logo_content=logo_file)
+                #        LOG.debug ("refresh done")
+                #    except APIError, e:
+                #        LOG.error ("Error while pushing current logo: %s", e)
+
+            # write the last sync date
+            timestamp = str(time.time())
+            content = {"last_sync":  timestamp}
+            transaction.save(os.path.join(self.hosts.get_currenthost_dir(), LAST_SYNC_DATE_FILENAME), content)
+
+            if self.package_handler:
+                for hostid in packagelist_changed:
+                    # refresh the package cache and index if already loaded
+                    self.package_handler.refresh_packagelist(
+                        hostid, other_hosts[hostid]['packages_checksum'],
+                        new_package_lists[hostid])
+                # saved once, and with the package lists they come from
+                self.package_handler.save_indexes(transaction.save)
+
+        # the saved files are visible now, refresh what was loaded from them
+        if hostlist_changed:
+            self.hosts.update_other_hosts()
+        if hostlist_changed or packagelist_changed:
+            if self.package_handler:
+                self.package_handler.remove_unused_package_lists()
+            else:
+                packagelistcache.remove_unused(hostdir, set(
+                    [self.hosts.current_host['packages_checksum']] +
+                    [host['packages_checksum']
+                     for host in other_hosts.values()]))
 
         # send dbus signal if needed events (just now so that we don't block on remaining operations)
         if hostlist_changed:
             self.emit_new_hostlist()
         for hostid in packagelist_changed:
             self.emit_new_packagelist(hostid)
+            if hostid in packagelist_deltas:
+                (added, removed, auto_changed) = packagelist_deltas[hostid]
+                self.emit_new_packagelist_delta(
+                    hostid, other_hosts[hostid]['packages_checksum'], added,
+                    removed, auto_changed)
         for hostid in logo_changed:
             self.emit_new_logo(hostid)
         self.emit_new_latestsync(timestamp)
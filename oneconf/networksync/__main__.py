@@ -21,10 +21,13 @@
 """For the test suite.
 
 See test/test_syncing.py
+
+With --simulate-fleet, measure instead the cost of a sync as the number of
+machines in the account grows, see fake_fleet.py.
 """
 
+from optparse import OptionParser
 import os
-import sys
 import logging
 
 from gi.repository import GLib
@@ -32,22 +35,46 @@ from gi.repository import GLib
 from oneconf.paths import WEBCATALOG_SILO_SOURCE
 from . import SyncHandler
 from .infraclient_fake import WebCatalogAPI
-from ..hosts import Hosts
+from ..hosts import get_hosts
 
 
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.DEBUG)
+    parser = OptionParser()
+    parser.add_option("--no-infra-client", action="store_true",
+                      default=False, help="sync without any infra client")
+    parser.add_option("--simulate-fleet", metavar="SIZES",
+                      help="simulate fleets of comma separated SIZES "
+                           "virtual hosts and report the cost per sync")
+    parser.add_option("--packages", type="int", default=1000,
+                      help="number of packages per virtual host")
+    parser.add_option("--changes", type="int", default=10,
+                      help="packages changed on every host between syncs")
+    parser.add_option("--rounds", type="int", default=3,
+                      help="number of sync rounds after registration")
+    (options, args) = parser.parse_args()
+
     from dbus.mainloop.glib import DBusGMainLoop
     DBusGMainLoop(set_as_default=True)
 
-    os.environ["ONECONF_SINGLE_SYNC"] = "True"
+    if options.simulate_fleet:
+        logging.basicConfig(level=logging.ERROR)
+        # network and sso are not watched, syncs are started by hand
+        os.environ.setdefault("ONECONF_NET_CONNECTED", "False")
+        os.environ.setdefault("ONECONF_SSO_CRED", "False")
+        from .fake_fleet import simulate_fleets
+        simulate_fleets([int(size)
+                         for size in options.simulate_fleet.split(',')],
+                        options.packages, options.changes, options.rounds)
+    else:
+        logging.basicConfig(level=logging.DEBUG)
+        os.environ["ONECONF_SINGLE_SYNC"] = "True"
 
-    infraclient = None
-    if not "--no-infra-client" in sys.argv:
-        infraclient = WebCatalogAPI(WEBCATALOG_SILO_SOURCE)
+        infraclient = None
+        if not options.no_infra_client:
+            infraclient = WebCatalogAPI(WEBCATALOG_SILO_SOURCE)
 
-    sync_handler = SyncHandler(Hosts(), infraclient=infraclient)
-    loop = GLib.MainLoop()
-    GLib.timeout_add_seconds(15, loop.quit)
+        sync_handler = SyncHandler(get_hosts(), infraclient=infraclient)
+        loop = GLib.MainLoop()
+        GLib.timeout_add_seconds(15, loop.quit)
 
-    loop.run()
+        loop.run()
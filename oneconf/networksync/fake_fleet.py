@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Simulate many machines of one account syncing with the fake infra
+
+Every virtual host has its own ONECONF_HOST identity, hence its own cache
+dir, its own Hosts and SyncHandler, and syncs against one shared silo.
+The cache dirs live in a temporary directory, removed by FakeFleet.close().
+See python3 -m oneconf.networksync --simulate-fleet.
+"""
+
+import hashlib
+import logging
+import os
+from pprint import pformat
+import random
+import shutil
+import tempfile
+import time
+
+from oneconf import packagelistcache
+from oneconf.hosts import Hosts
+from oneconf.packagesethandler import PackageSetHandler
+from . import SyncHandler
+from .infraclient_fake import WebCatalogAPI
+
+LOG = logging.getLogger(__name__)
+
+
+try:
+    _cpu_time = time.process_time
+except AttributeError:
+    # Python 2
+    _cpu_time = time.clock
+
+
+class _VirtualHost(object):
+    '''One simulated machine, with its identity and inventory'''
+
+    def __init__(self, hostid, package_list, infraclient, cache_dir):
+        self.hostid = hostid
+        self.package_list = package_list
+        with self.identity():
+            self.hosts = Hosts(cache_dir)
+            self.hosts.current_host['share_inventory'] = True
+            self.save_package_list()
+            self.sync_handler = SyncHandler(
+                self.hosts, PackageSetHandler(self.hosts), infraclient)
+        # network and sso are not watched, syncs are started by hand
+        self.sync_handler._can_sync = True
+
+    def identity(self):
+        '''context manager for running code as this host'''
+        return _HostIdentity(self.hostid)
+
+    def save_package_list(self):
+        '''write the package list and its checksum as update() would'''
+        checksum = hashlib.sha224(
+            pformat(self.package_list).encode('utf-8')).hexdigest()
+        packagelistcache.save_package_list(
+            self.hosts.get_currenthost_dir(), self.hostid, checksum,
+            self.package_list)
+        self.hosts.current_host['packages_checksum'] = checksum
+        self.hosts.save_current_host()
+
+    def sync(self):
+        with self.identity():
+            self.sync_handler.process_sync()
+
+
+class _HostIdentity(object):
+    '''set ONECONF_HOST for the enclosed block'''
+
+    def __init__(self, hostid):
+        self.hostid = hostid
+
+    def __enter__(self):
+        self.old_identity = os.environ.get('ONECONF_HOST')
+        os.environ['ONECONF_HOST'] = '%s:%s' % (self.hostid, self.hostid)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.old_identity is None:
+            del os.environ['ONECONF_HOST']
+        else:
+            os.environ['ONECONF_HOST'] = self.old_identity
+
+
+class FakeFleet(object):
+    """
+    nb_hosts virtual hosts syncing against the same fake infra silo
+
+    Between two sync rounds, every host installs or removes nb_changes
+    packages.
+    """
+
+    def __init__(self, nb_hosts, nb_packages=1000, nb_changes=10, seed=42):
+        self._random = random.Random(seed)
+        self.nb_changes = nb_changes
+        self.package_names = ['package%05d' % i
+                              for i in range(nb_packages * 2)]
+        # never touch the real cache of the user
+        self.cache_dir = tempfile.mkdtemp(prefix='oneconf-fleet-')
+        self.infraclient = WebCatalogAPI()
+        silo = self.infraclient.silo
+        silo.set_setting('fake_network_delay', 0)
+        silo.set_setting('fake_record_traffic', True)
+        silo.set_setting('persist_batch_size', max(100, nb_hosts))
+        self.virtual_hosts = []
+        for i in range(nb_hosts):
+            package_list = dict(
+                (name, {'auto': self._random.random() < 0.7})
+                for name in self._random.sample(self.package_names,
+                                                nb_packages))
+            self.virtual_hosts.append(_VirtualHost(
+                'simhost%05d' % i, package_list, self.infraclient,
+                self.cache_dir))
+
+    def close(self):
+        '''remove the cache dirs of the virtual hosts'''
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def mutate(self):
+        '''install or remove nb_changes packages on every host'''
+        for virtual_host in self.virtual_hosts:
+            package_list = virtual_host.package_list
+            for name in self._random.sample(self.package_names,
+                                            self.nb_changes):
+                if name in package_list:
+                    del package_list[name]
+                else:
+                    package_list[name] = {'auto': False}
+            with virtual_host.identity():
+                virtual_host.save_package_list()
+
+    def _traffic(self):
+        requests = nb_bytes = 0
+        for endpoint_stats in self.infraclient.silo.stats.values():
+            requests += endpoint_stats['requests']
+            nb_bytes += (endpoint_stats['bytes_received'] +
+                         endpoint_stats['bytes_sent'])
+        return (requests, nb_bytes)
+
+    def sync_round(self):
+        '''sync every host once
+
+        Return the mean requests, bytes and cpu time (in seconds) per sync'''
+        (start_requests, start_bytes) = self._traffic()
+        start_cpu = _cpu_time()
+        for virtual_host in self.virtual_hosts:
+            virtual_host.sync()
+        cpu_time = _cpu_time() - start_cpu
+        (requests, nb_bytes) = self._traffic()
+        nb_syncs = float(len(self.virtual_hosts))
+        return {'requests': (requests - start_requests) / nb_syncs,
+                'bytes': (nb_bytes - start_bytes) / nb_syncs,
+                'cpu': cpu_time / nb_syncs}
+
+    def run(self, nb_rounds):
+        '''register every host, then mutate and sync nb_rounds times
+
+        Return (first round stats, mean stats of the next rounds)'''
+        first_round = self.sync_round()
+        # a second round brings the hosts registered after each one
+        self.sync_round()
+        rounds = []
+        for i in range(nb_rounds):
+            self.mutate()
+            rounds.append(self.sync_round())
+        self.infraclient.flush()
+        steady = {}
+        for key in ('requests', 'bytes', 'cpu'):
+            steady[key] = sum(stats[key] for stats in rounds) / max(
+                1, len(rounds))
+        return (first_round, steady)
+
+
+def simulate_fleets(fleet_sizes, nb_packages=1000, nb_changes=10,
+                    nb_rounds=3):
+    '''Run a fake fleet for every size and print the cost per sync'''
+    print("%6s | %-30s | %-30s" % ('hosts', 'first sync', 'next syncs'))
+    print("%6s | %8s %11s %9s | %8s %11s %9s" % (
+        '', 'requests', 'bytes', 'cpu ms', 'requests', 'bytes', 'cpu ms'))
+    results = []
+    for nb_hosts in fleet_sizes:
+        fleet = FakeFleet(nb_hosts, nb_packages, nb_changes)
+        try:
+            (first_round, steady) = fleet.run(nb_rounds)
+        finally:
+            fleet.close()
+        print("%6d | %8.1f %11d %9.2f | %8.1f %11d %9.2f" % (
+            nb_hosts, first_round['requests'], first_round['bytes'],
+            first_round['cpu'] * 1000, steady['requests'], steady['bytes'],
+            steady['cpu'] * 1000))
+        results.append((nb_hosts, first_round, steady))
+    return results
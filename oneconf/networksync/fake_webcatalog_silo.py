@@ -1,24 +1,62 @@
+import copy
+import functools
+import json
 import time
 import logging
 import os
 import pickle
+import random
 
 
 LOG = logging.getLogger(__name__)
 
-# decorator to add a fake network delay if set
-# in FakeReviewSettings.fake_network_delay
+def _payload_size(content):
+    '''Return the size of content once serialized for the wire'''
+    if isinstance(content, (bytes, str)):
+        return len(content)
+    return len(json.dumps(content))
+
+
+# decorator to add a fake network delay, and random failures, following the
+# network settings of the silo (self.silo)
 def network_delay(fn):
     def slp(self, *args, **kwargs):
-        #FIXME: CHECK how a decorator can take parameters
-        #delay = fake_settings.get_setting('fake_network_delay')
-        delay = 2
+        endpoint = fn.__name__
+        if self.silo.inject_failure(endpoint):
+            from piston_mini_client.failhandlers import APIError
+            raise APIError('Fake WebCatalogAPI random failure on %s' %
+                           endpoint)
+        result = fn(self, *args, **kwargs)
+        nb_bytes = 0
+        if self.silo.get_setting('fake_bandwidth'):
+            nb_bytes = (_payload_size(kwargs) + _payload_size(args) +
+                        _payload_size(result))
+        delay = self.silo.get_network_delay(endpoint, nb_bytes)
         if delay:
             time.sleep(delay)
-        return fn(self, *args, **kwargs)
+        return result
     return slp
 
 
+# decorator counting the calls and their payload bytes in the silo stats,
+# when the fake_record_traffic setting is on
+def record_traffic(fn):
+    @functools.wraps(fn)
+    def record(self, *args, **kwargs):
+        if not self.silo.get_setting('fake_record_traffic'):
+            return fn(self, *args, **kwargs)
+        result = None
+        try:
+            result = fn(self, *args, **kwargs)
+            return result
+        finally:
+            # failed requests are counted too, without answer
+            self.silo.record_request(
+                fn.__name__, _payload_size(kwargs) + _payload_size(args),
+                _payload_size(result) if result is not None else 0)
+    return record
+
+
 class FakeWebCatalogSilo(object):
 
     """An object that simply holds settings and data which are used by
@@ -56,6 +94,22 @@ class FakeWebCatalogSilo(object):
     # delay (in seconds) before returning from any of the fake cat methods
     # useful for emulating real network timings (use None for no delays)
     _FAKE_SETTINGS['fake_network_delay'] = 2
+    # per endpoint delay (in seconds), overriding fake_network_delay, like
+    # {'list_packages': 0.3}
+    _FAKE_SETTINGS['fake_endpoint_latency'] = {}
+    # bytes per second for the request and answer payloads (None: no limit)
+    _FAKE_SETTINGS['fake_bandwidth'] = None
+    # each delay is randomly changed by up to this fraction of itself
+    _FAKE_SETTINGS['fake_jitter'] = 0
+    # probability for any fake cat method to raise APIError
+    _FAKE_SETTINGS['fake_failure_rate'] = 0
+    # seed of the jitter and failure random generator (None: not seeded)
+    _FAKE_SETTINGS['fake_seed'] = None
+    # number of changes before the silo is saved on disk again, pending
+    # changes are saved by flush()
+    _FAKE_SETTINGS['persist_batch_size'] = 1
+    # count the requests and payload bytes per endpoint in the silo stats
+    _FAKE_SETTINGS['fake_record_traffic'] = False
 
     # server status
     # *****************************
@@ -106,8 +160,14 @@ class FakeWebCatalogSilo(object):
         overwritten with the defaults set in the class.
         """
 
+        # set_setting() and stored data changes stay local to this silo
+        self._FAKE_SETTINGS = copy.deepcopy(self._FAKE_SETTINGS)
         if silo_filepath:
             self._update_from_file(silo_filepath)
+        self._random = random.Random(self.get_setting('fake_seed'))
+        self._pending_changes = 0
+        # endpoint -> {'requests', 'bytes_received', 'bytes_sent'}, not saved
+        self.stats = {}
 
     def get_setting(self, key_name):
         """Takes a string (key_name) which corresponds to a setting in this
@@ -129,6 +189,46 @@ class FakeWebCatalogSilo(object):
             raise NameError('Setting %s does not exist' % key_name)
         return self._FAKE_SETTINGS[key_name]
 
+    def set_setting(self, key_name, value):
+        """Change a setting of this silo, like the network model ones
+
+        Raises a NameError if the setting name doesn't exist
+        """
+        if not key_name in self._FAKE_SETTINGS:
+            raise NameError('Setting %s does not exist' % key_name)
+        if key_name == 'fake_seed':
+            self._random.seed(value)
+        self._FAKE_SETTINGS[key_name] = value
+
+    def get_network_delay(self, endpoint, nb_bytes=0):
+        '''Return the time (in seconds) a call to endpoint, transferring
+        nb_bytes, should take'''
+        delay = self.get_setting('fake_endpoint_latency').get(
+            endpoint, self.get_setting('fake_network_delay')) or 0
+        jitter = self.get_setting('fake_jitter')
+        if jitter:
+            delay *= 1 + self._random.uniform(-jitter, jitter)
+        bandwidth = self.get_setting('fake_bandwidth')
+        if bandwidth:
+            delay += float(nb_bytes) / bandwidth
+        return delay
+
+    def inject_failure(self, endpoint):
+        '''Return True if this call to endpoint should randomly fail'''
+        failure_rate = self.get_setting('fake_failure_rate')
+        if failure_rate and self._random.random() < failure_rate:
+            LOG.debug("Injecting a failure on %s", endpoint)
+            return True
+        return False
+
+    def record_request(self, endpoint, nb_bytes_received, nb_bytes_sent):
+        '''Count one request to endpoint in the silo stats'''
+        endpoint_stats = self.stats.setdefault(
+            endpoint, {'requests': 0, 'bytes_received': 0, 'bytes_sent': 0})
+        endpoint_stats['requests'] += 1
+        endpoint_stats['bytes_received'] += nb_bytes_received
+        endpoint_stats['bytes_sent'] += nb_bytes_sent
+
     def get_host_silo(self):
         """ return a reference to the host list silo"""
         return self._FAKE_SETTINGS['hosts_metadata']
@@ -141,7 +241,10 @@ class FakeWebCatalogSilo(object):
         '''Loads existing settings from cache file into _FAKE_SETTINGS dict'''
         if os.path.exists(filepath):
             with open(filepath, 'rb') as fp:
-                self._FAKE_SETTINGS = pickle.load(fp)
+                # older silo files don't have every setting
+                settings = dict(self._FAKE_SETTINGS)
+                settings.update(pickle.load(fp))
+                self._FAKE_SETTINGS = settings
         else:
             LOG.warning("Settings file %s doesn't exist. "
                         'Will run with the default' % filepath)
@@ -158,3 +261,17 @@ class FakeWebCatalogSilo(object):
             return True
         except:
             return False
+
+    def save_changes(self, filepath):
+        '''Record one change, saving the silo every persist_batch_size ones'''
+        self._pending_changes += 1
+        if self._pending_changes >= self.get_setting('persist_batch_size'):
+            return self.flush(filepath)
+        return True
+
+    def flush(self, filepath):
+        '''Save the silo if there are changes not saved yet'''
+        if not self._pending_changes:
+            return True
+        self._pending_changes = 0
+        return self.save_settings(filepath)
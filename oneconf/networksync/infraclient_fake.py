@@ -14,7 +14,9 @@ from piston_mini_client.failhandlers import APIError
 PUBLIC_API_SCHEME = 'http'
 AUTHENTICATED_API_SCHEME = 'https'
 
-from .fake_webcatalog_silo import FakeWebCatalogSilo, network_delay
+from .fake_webcatalog_silo import (
+    FakeWebCatalogSilo, network_delay, record_traffic)
+import atexit
 import os
 import json
 
@@ -39,6 +41,12 @@ class WebCatalogAPI(PistonAPI):
         super(WebCatalogAPI, self).__init__()
         self.silo = FakeWebCatalogSilo(fake_settings_filename)
         self.silo.save_settings(WEBCATALOG_SILO_RESULT)
+        # changes can be saved in batches, don't lose the last ones
+        atexit.register(self.flush)
+
+    def flush(self):
+        '''Save the silo changes not saved yet'''
+        self.silo.flush(WEBCATALOG_SILO_RESULT)
 
     def machineuuid_exist(self, machine_uuid):
         '''Generic method to check before doing an update operation that the machine_uuid exist in the host list'''
@@ -46,12 +54,14 @@ class WebCatalogAPI(PistonAPI):
 
     @returns_json
     @network_delay
+    @record_traffic
     def server_status(self):
         if self.silo.get_setting('server_response_error'):
             raise APIError(self._exception_msg)
         return json.dumps('ok')
 
     @network_delay
+    @record_traffic
     def list_machines(self):
         if self.silo.get_setting('list_machines_error'):
             raise APIError(self._exception_msg)
@@ -68,6 +78,7 @@ class WebCatalogAPI(PistonAPI):
     @validate_pattern('hostname', r'[-\w+]+')
     @returns_json
     @network_delay
+    @record_traffic
     def update_machine(self, machine_uuid, hostname):
         if self.silo.get_setting('update_machine_error'):
             raise APIError(self._exception_msg)
@@ -81,11 +92,13 @@ class WebCatalogAPI(PistonAPI):
                                    'logo_checksum': None,
                                    'packages_checksum': None,
                                    }
-        self.silo.save_settings(WEBCATALOG_SILO_RESULT)
+        self.silo.save_changes(WEBCATALOG_SILO_RESULT)
         return json.dumps('Success')
 
     @validate_pattern('machine_uuid', r'[-\w+]+')
     @returns_json
+    @network_delay
+    @record_traffic
     def delete_machine(self, machine_uuid):
         if self.silo.get_setting('delete_machine_error'):
             raise APIError(self._exception_msg)
@@ -105,10 +118,12 @@ class WebCatalogAPI(PistonAPI):
         if not self.machineuuid_exist(machine_uuid):
             raise APIError('Host Not Found')
         del hosts[machine_uuid]
-        self.silo.save_settings(WEBCATALOG_SILO_RESULT)
+        self.silo.save_changes(WEBCATALOG_SILO_RESULT)
         return json.dumps('Success')
 
     @validate_pattern('machine_uuid', r'[-\w+]+')
+    @network_delay
+    @record_traffic
     def get_machine_logo(self, machine_uuid):
         if self.silo.get_setting('get_machine_logo_error'):
             raise APIError(self._exception_msg)
@@ -122,6 +137,8 @@ class WebCatalogAPI(PistonAPI):
     @validate_pattern('machine_uuid', r'[-\w+]+')
     @validate_pattern('logo_checksum', r'[-\w+]+\.[-\w+]+')
     @returns_json
+    @network_delay
+    @record_traffic
     def update_machine_logo(self, machine_uuid, logo_checksum, logo_content):
         if self.silo.get_setting('update_machine_logo_error'):
             raise APIError(self._exception_msg)
@@ -133,11 +150,13 @@ class WebCatalogAPI(PistonAPI):
             image_on_disk.write(logo_content)
         hosts = self.silo.get_host_silo()
         hosts[machine_uuid]['logo_checksum'] = logo_checksum
-        self.silo.save_settings(WEBCATALOG_SILO_RESULT)
+        self.silo.save_changes(WEBCATALOG_SILO_RESULT)
         return json.dumps('Success')
 
     @validate_pattern('machine_uuid', r'[-\w+]+')
     @returns_json
+    @network_delay
+    @record_traffic
     def list_packages(self, machine_uuid):
         if self.silo.get_setting('list_packages_error'):
             raise APIError(self._exception_msg)
@@ -153,6 +172,8 @@ class WebCatalogAPI(PistonAPI):
     @validate_pattern('machine_uuid', r'[-\w+]+')
     @validate_pattern('packages_checksum', r'[-\w+]+')
     @returns_json
+    @network_delay
+    @record_traffic
     def update_packages(self, machine_uuid, packages_checksum, package_list):
         if self.silo.get_setting('update_packages_error'):
             raise APIError(self._exception_msg)
@@ -164,5 +185,5 @@ class WebCatalogAPI(PistonAPI):
         packages[machine_uuid] = package_list
         hosts = self.silo.get_host_silo()
         hosts[machine_uuid]['packages_checksum'] = packages_checksum
-        self.silo.save_settings(WEBCATALOG_SILO_RESULT)
+        self.silo.save_changes(WEBCATALOG_SILO_RESULT)
         return json.dumps('Success')
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Local HTTP stand-in for the WebCatalog server
+
+It answers the requests of infraclient_pristine.WebCatalogAPI from a
+FakeWebCatalogSilo, with the same answers and error settings than
+infraclient_fake, so that the real client code path can be load tested.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from oneconf.paths import WEBCATALOG_SILO_DIR
+from .fake_webcatalog_silo import FakeWebCatalogSilo
+
+LOG = logging.getLogger(__name__)
+
+# (method, path regexp, endpoint name as in WebCatalogAPI)
+_ROUTES = (
+    ('GET', re.compile(r'/server-status/$'), 'server_status'),
+    ('GET', re.compile(r'/list-machines/$'), 'list_machines'),
+    ('POST', re.compile(r'/machine/([-\w+]+)/$'), 'update_machine'),
+    ('DELETE', re.compile(r'/machine/([-\w+]+)/$'), 'delete_machine'),
+    ('GET', re.compile(r'/logo/([-\w+]+)/$'), 'get_machine_logo'),
+    ('POST', re.compile(r'/logo/([-\w+]+)/([-\w+]+\.[-\w+]+)/$'),
+     'update_machine_logo'),
+    ('GET', re.compile(r'/packages/([-\w+]+)/$'), 'list_packages'),
+    ('POST', re.compile(r'/packages/([-\w+]+)/$'), 'update_packages'),
+    )
+# silo settings making an endpoint fail, when not named <endpoint>_error
+_ERROR_SETTINGS = {'server_status': 'server_response_error'}
+
+
+class WebCatalogError(Exception):
+    '''An error answered to the client with its HTTP status'''
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class _WebCatalogRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        LOG.debug(format, *args)
+
+    def _dispatch(self, method):
+        path = self.path.split('?', 1)[0]
+        body = b''
+        if 'Content-Length' in self.headers:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+        for (route_method, route, endpoint) in _ROUTES:
+            match = route.search(path)
+            if route_method == method and match:
+                break
+        else:
+            self._answer(404, b'Not Found', 'unknown')
+            return
+        try:
+            (content_type, answer) = self.server.answer_request(
+                endpoint, match.groups(), body)
+            status = 200
+        except WebCatalogError as e:
+            (content_type, answer) = ('text/plain', str(e).encode('utf-8'))
+            status = e.status
+        delay = self.server.silo.get_network_delay(endpoint,
+                                                   len(body) + len(answer))
+        if delay:
+            time.sleep(delay)
+        self._answer(status, answer, endpoint, content_type, len(body))
+
+    def _answer(self, status, answer, endpoint, content_type='text/plain',
+                nb_bytes_received=0):
+        self.server.record_request(endpoint, nb_bytes_received, len(answer))
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+
+
+class WebCatalogServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server answering WebCatalog requests from a silo
+
+    Every request is counted, with the bytes received and sent, in stats.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, silo_filepath=None, silo_result=None,
+                 address=('127.0.0.1', 0)):
+        HTTPServer.__init__(self, address, _WebCatalogRequestHandler)
+        self.silo = FakeWebCatalogSilo(silo_filepath)
+        self.silo_result = silo_result
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def service_root(self):
+        '''url to give as service_root to WebCatalogAPI'''
+        return 'http://%s:%s/cat/api/1.0/' % self.server_address[:2]
+
+    def start(self):
+        '''serve requests in a background thread'''
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        LOG.debug("WebCatalog stand-in listening on %s", self.service_root)
+
+    def stop(self):
+        '''stop serving and save the silo changes not saved yet'''
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+        if self.silo_result:
+            with self._lock:
+                self.silo.flush(self.silo_result)
+
+    @property
+    def stats(self):
+        '''requests and bytes per endpoint, as recorded in the silo'''
+        return self.silo.stats
+
+    def record_request(self, endpoint, nb_bytes_received, nb_bytes_sent):
+        with self._lock:
+            self.silo.record_request(endpoint, nb_bytes_received,
+                                     nb_bytes_sent)
+
+    def _save_changes(self):
+        if self.silo_result:
+            self.silo.save_changes(self.silo_result)
+
+    def answer_request(self, endpoint, args, body):
+        '''Return (content type, answer) for endpoint, as the infra would
+
+        Raise WebCatalogError for errors.'''
+        error_setting = _ERROR_SETTINGS.get(endpoint, '%s_error' % endpoint)
+        with self._lock:
+            if (self.silo.get_setting(error_setting) or
+                    self.silo.inject_failure(endpoint)):
+                raise WebCatalogError(500, 'Fake WebCatalog server error')
+            return getattr(self, '_' + endpoint)(body, *args)
+
+    def _host_exists(self, machine_uuid):
+        if machine_uuid not in self.silo.get_host_silo():
+            raise WebCatalogError(404, 'Host Not Found')
+
+    def _server_status(self, body):
+        return ('application/json', json.dumps('ok').encode('utf-8'))
+
+    def _list_machines(self, body):
+        hosts = self.silo.get_host_silo()
+        machines = []
+        for hostid in hosts:
+            machine = dict(hosts[hostid])
+            machine['uuid'] = hostid
+            machines.append(machine)
+        # the client evaluates a python literal here
+        return ('text/plain', repr(machines).encode('utf-8'))
+
+    def _update_machine(self, body, machine_uuid):
+        hostname = json.loads(body.decode('utf-8'))['hostname']
+        hosts = self.silo.get_host_silo()
+        if machine_uuid in hosts:
+            hosts[machine_uuid]['hostname'] = hostname
+        else:
+            hosts[machine_uuid] = {'hostname': hostname,
+                                   'logo_checksum': None,
+                                   'packages_checksum': None,
+                                   }
+        self._save_changes()
+        return ('application/json', json.dumps('Success').encode('utf-8'))
+
+    def _delete_machine(self, body, machine_uuid):
+        self._host_exists(machine_uuid)
+        self.silo.get_package_silo().pop(machine_uuid, None)
+        try:
+            os.remove(os.path.join(WEBCATALOG_SILO_DIR,
+                                   "%s.png" % machine_uuid))
+        except OSError:
+            pass # there was no logo
+        del self.silo.get_host_silo()[machine_uuid]
+        self._save_changes()
+        return ('application/json', json.dumps('Success').encode('utf-8'))
+
+    def _get_machine_logo(self, body, machine_uuid):
+        logo_path = os.path.join(WEBCATALOG_SILO_DIR, "%s.png" % machine_uuid)
+        try:
+            with open(logo_path, 'rb') as f:
+                return ('image/png', f.read())
+        except IOError:
+            raise WebCatalogError(404, 'No logo found')
+
+    def _update_machine_logo(self, body, machine_uuid, logo_checksum):
+        self._host_exists(machine_uuid)
+        with open(os.path.join(WEBCATALOG_SILO_DIR,
+                               '%s.png' % machine_uuid), 'wb') as f:
+            f.write(body)
+        self.silo.get_host_silo()[machine_uuid]['logo_checksum'] = \
+            logo_checksum
+        self._save_changes()
+        return ('application/json', json.dumps('Success').encode('utf-8'))
+
+    def _list_packages(self, body, machine_uuid):
+        package_list = self.silo.get_package_silo().get(machine_uuid)
+        if not package_list:
+            raise WebCatalogError(404, 'Package list empty')
+        # the client expects a json string holding a python literal
+        return ('application/json',
+                json.dumps(repr(package_list)).encode('utf-8'))
+
+    def _update_packages(self, body, machine_uuid):
+        self._host_exists(machine_uuid)
+        content = json.loads(body.decode('utf-8'))
+        self.silo.get_package_silo()[machine_uuid] = content['package_list']
+        self.silo.get_host_silo()[machine_uuid]['packages_checksum'] = \
+            content['packages_checksum']
+        self._save_changes()
+        return ('application/json', json.dumps('Success').encode('utf-8'))
@@ -0,0 +1,96 @@
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+
+LOG = logging.getLogger(__name__)
+
+from oneconf import serialization, utils
+
+
+class PackageIndex(object):
+    """
+    Persistent package -> hosts inverted index
+
+    packages has a {package: {hostid: auto}} format. Every indexed host is
+    recorded with the packages checksum it was indexed from, so that an
+    outdated host can be detected and indexed again.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        try:
+            with open(index_path, 'r') as f:
+                content = serialization.load(f)
+            self.hosts = content['hosts']
+            self.packages = content['packages']
+        except (IOError, KeyError, TypeError, ValueError):
+            LOG.debug("No valid package index in %s, starting empty",
+                      index_path)
+            self.hosts = {}
+            self.packages = {}
+
+    def save(self, save=utils.save_json_file_update):
+        '''Save the index on disk with save(path, content)'''
+        save(self.index_path, {'hosts': self.hosts,
+                               'packages': self.packages})
+
+    def is_uptodate(self, hostid, checksum):
+        '''Return True if hostid is indexed with this exact checksum'''
+        return hostid in self.hosts and self.hosts[hostid] == checksum
+
+    def set_host(self, hostid, checksum, package_list, old_package_list=None):
+        '''Index package_list for hostid
+
+        Only the differences with old_package_list are applied. If the old
+        package list isn't known, every entry of hostid is looked up.'''
+        LOG.debug("Indexing packages for %s", hostid)
+        if hostid in self.hosts:
+            if old_package_list is None:
+                old_package_list = [
+                    package for package in self.packages
+                    if hostid in self.packages[package]]
+            for package in old_package_list:
+                if package not in package_list:
+                    self._remove_entry(package, hostid)
+        for (package, details) in package_list.items():
+            self.packages.setdefault(package, {})[hostid] = \
+                bool(details['auto'])
+        self.hosts[hostid] = checksum
+
+    def remove_host(self, hostid):
+        '''Remove every entry of hostid from the index'''
+        LOG.debug("Removing %s from the package index", hostid)
+        for package in list(self.packages):
+            self._remove_entry(package, hostid)
+        self.hosts.pop(hostid, None)
+
+    def _remove_entry(self, package, hostid):
+        try:
+            hosts = self.packages[package]
+            del hosts[hostid]
+        except KeyError:
+            return
+        if not hosts:
+            del self.packages[package]
+
+    def get_hosts_with_package(self, package, only_manual=False):
+        '''Return the sorted list of hostids having package installed'''
+        hosts = self.packages.get(package, {})
+        return sorted(hostid for hostid in hosts
+                      if not (only_manual and hosts[hostid]))
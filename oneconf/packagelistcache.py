@@ -0,0 +1,152 @@
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""Package lists stored by packages checksum
+
+Hosts with the same inventory (cloned images, CI runners...) advertise the
+same packages checksum: their list is stored once, in
+package_lists/<checksum>, and the package_list_<hostid> file of each host
+only points to it with {"packages_checksum": checksum}. A host file can
+still hold the package list itself, for hosts without checksum and caches
+written by older versions.
+"""
+
+import errno
+import logging
+import os
+import re
+
+from oneconf.paths import PACKAGE_LIST_PREFIX, PACKAGE_LISTS_DIRNAME
+from oneconf import serialization, utils
+
+LOG = logging.getLogger(__name__)
+
+POINTER_KEY = 'packages_checksum'
+# sha224 hexdigest, as computed by PackageSetHandler.update()
+_CHECKSUM_RE = re.compile(r'[0-9a-f]{56}\Z')
+
+
+def _is_pointer(content):
+    # package list entries are dicts, never strings
+    return (isinstance(content, dict) and len(content) == 1 and
+            not isinstance(content.get(POINTER_KEY, {}), dict))
+
+
+def get_host_path(host_dir, hostid):
+    '''Return the path of the package list file of hostid'''
+    return os.path.join(host_dir, '%s_%s' % (PACKAGE_LIST_PREFIX, hostid))
+
+
+def is_valid_checksum(checksum):
+    '''Return True if checksum can name a stored package list
+
+    Checksums come from the server too: anything else than what we compute
+    ourselves is never used as a file name.'''
+    try:
+        return _CHECKSUM_RE.match(checksum) is not None
+    except TypeError:
+        return False
+
+
+def get_content_path(host_dir, checksum):
+    '''Return the path of the package list of checksum
+
+    Raise ValueError if checksum is not a valid one.'''
+    if not is_valid_checksum(checksum):
+        raise ValueError("Invalid packages checksum: %r" % (checksum,))
+    return os.path.join(host_dir, PACKAGE_LISTS_DIRNAME, checksum)
+
+
+def has_package_list(host_dir, checksum):
+    '''Return True if the package list of checksum is stored'''
+    return is_valid_checksum(checksum) and os.path.exists(
+        get_content_path(host_dir, checksum))
+
+
+def _load(path):
+    with open(path, 'r') as f:
+        return serialization.load(f)
+
+
+def load_host_file(host_dir, hostid):
+    '''Return (checksum, None) if hostid points to a stored package list,
+    (None, package list) if its file still holds the list itself
+
+    Raise IOError or ValueError if there is none.'''
+    content = _load(get_host_path(host_dir, hostid))
+    if _is_pointer(content):
+        return (content[POINTER_KEY], None)
+    return (None, content)
+
+
+def load_package_list(host_dir, hostid):
+    '''Return the package list of hostid, following its pointer
+
+    Raise IOError or ValueError if there is none.'''
+    (checksum, package_list) = load_host_file(host_dir, hostid)
+    if checksum is not None:
+        return load_content(host_dir, checksum)
+    return package_list
+
+
+def load_content(host_dir, checksum):
+    '''Return the package list stored for checksum
+
+    Raise IOError or ValueError if there is none.'''
+    return _load(get_content_path(host_dir, checksum))
+
+
+def save_package_list(host_dir, hostid, checksum, package_list,
+                      save=utils.save_json_file_update):
+    '''Save package_list once for checksum and point hostid to it
+
+    save(path, content) writes the files, the package list first. Without
+    a valid checksum, the host file holds the package list itself.'''
+    if not is_valid_checksum(checksum):
+        save(get_host_path(host_dir, hostid), package_list)
+        return
+    if not has_package_list(host_dir, checksum):
+        try:
+            os.makedirs(os.path.join(host_dir, PACKAGE_LISTS_DIRNAME))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        save(get_content_path(host_dir, checksum), package_list)
+    save_pointer(host_dir, hostid, checksum, save)
+
+
+def save_pointer(host_dir, hostid, checksum,
+                 save=utils.save_json_file_update):
+    '''Point hostid to the already saved package list of checksum'''
+    save(get_host_path(host_dir, hostid), {POINTER_KEY: checksum})
+
+
+def remove_unused(host_dir, used_checksums):
+    '''Remove the stored package lists no host points to anymore'''
+    try:
+        checksums = os.listdir(os.path.join(host_dir, PACKAGE_LISTS_DIRNAME))
+    except OSError:
+        return
+    for checksum in checksums:
+        if checksum not in used_checksums:
+            LOG.debug("Removing unused package list %s", checksum)
+            try:
+                os.remove(get_content_path(host_dir, checksum))
+            except OSError:
+                pass
@@ -0,0 +1,434 @@
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Compact in memory package lists
+
+A {name: {"auto": bool}} package list costs a dict per package. A PackageSet
+holds the same content in a sorted tuple of names and a bitmap of the auto
+flags, and reads like the dict it replaces.
+
+Hosts mostly have the same packages: names are shared by every PackageSet
+of the process through a table giving each name an integer id, so that
+comparing two sets is a matter of bitmaps over those ids.
+
+Package lists can also give the "version" and "arch" of every package.
+Those are held in columns only allocated when the list has them: a tuple
+of shared version strings and one byte per package indexing architectures.
+"""
+
+from array import array
+from binascii import hexlify, unhexlify
+from bisect import bisect_left
+from functools import reduce
+import logging
+import operator
+import threading
+
+try:
+    from itertools import filterfalse
+except ImportError:
+    from itertools import ifilterfalse as filterfalse
+
+LOG = logging.getLogger(__name__)
+
+
+class PackageNameTable(object):
+    """
+    Process wide package name -> id table
+
+    Ids are given in order of first appearance and never change, so that
+    ids and bitmaps over them stay valid while the table grows.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def intern_names(self, names):
+        '''Return (names, array of their ids), with the shared names'''
+        ids = array('I')
+        shared_names = []
+        with self._lock:
+            for name in names:
+                try:
+                    package_id = self._ids[name]
+                except KeyError:
+                    package_id = len(self._names)
+                    self._ids[name] = package_id
+                    self._names.append(name)
+                ids.append(package_id)
+                shared_names.append(self._names[package_id])
+        return (tuple(shared_names), ids)
+
+    def get_id(self, name):
+        '''Return the id of name, None if no package set has it'''
+        return self._ids.get(name)
+
+    def get_name(self, package_id):
+        return self._names[package_id]
+
+# shared by every PackageSet
+name_table = PackageNameTable()
+
+# shared version strings
+_versions = {}
+# architecture names by index, '' being unknown
+_architectures = ['']
+_architecture_ids = {'': 0}
+_architectures_lock = threading.Lock()
+
+
+def _get_architecture_id(arch):
+    try:
+        return _architecture_ids[arch]
+    except KeyError:
+        with _architectures_lock:
+            if arch not in _architecture_ids:
+                if len(_architectures) > 255:
+                    raise ValueError("Too many architectures: %s" % arch)
+                _architecture_ids[arch] = len(_architectures)
+                _architectures.append(arch)
+            return _architecture_ids[arch]
+
+
+def _get_entry(auto, version, arch):
+    '''Return the package list entry, without unknown version or arch'''
+    entry = {'auto': auto}
+    if version:
+        entry['version'] = version
+    if arch:
+        entry['arch'] = arch
+    return entry
+
+
+def _normalize_entry(details):
+    return _get_entry(bool(details['auto']), details.get('version'),
+                      details.get('arch'))
+
+
+def _bitmap_to_int(bitmap):
+    '''Return the integer of a LSB first bitmap'''
+    try:
+        return int.from_bytes(bytes(bitmap), 'little')
+    except AttributeError:
+        return int(hexlify(bytes(bitmap[::-1])) or '0', 16)
+
+
+def _int_to_bitmap(bits):
+    '''Return the LSB first bitmap of a positive integer'''
+    try:
+        return bytearray(bits.to_bytes((bits.bit_length() + 7) // 8,
+                                       'little'))
+    except AttributeError:
+        hex_bits = '%x' % bits
+        return bytearray(unhexlify('0' * (len(hex_bits) % 2) + hex_bits))[::-1]
+
+
+def _ids_to_bits(ids):
+    bitmap = bytearray((max(ids) + 8) // 8 if ids else 0)
+    for package_id in ids:
+        bitmap[package_id >> 3] |= 1 << (package_id & 7)
+    return _bitmap_to_int(bitmap)
+
+# positions of the set bits of every byte value
+_BYTE_BITS = [tuple(i for i in range(8) if value & (1 << i))
+              for value in range(256)]
+
+
+def bits_to_ids(bits):
+    '''Return the ids of the set bits of an integer, in ascending order'''
+    ids = []
+    for (byte_index, value) in enumerate(_int_to_bitmap(bits)):
+        if value:
+            base = byte_index << 3
+            ids.extend(base + i for i in _BYTE_BITS[value])
+    return ids
+
+
+def popcount(bits):
+    '''Return the number of packages in bits'''
+    return bin(bits).count('1')
+
+
+def union_bits(bitsets):
+    '''Return the bits of the packages in any of bitsets'''
+    return reduce(operator.or_, bitsets, 0)
+
+
+def intersection_bits(bitsets):
+    '''Return the bits of the packages in all of bitsets (at least one)'''
+    return reduce(operator.and_, bitsets)
+
+
+def names_of_bits(bits):
+    '''Return the sorted package names of bits'''
+    return sorted(name_table.get_name(package_id)
+                  for package_id in bits_to_ids(bits))
+
+
+class PackageSet(object):
+    """
+    Immutable package list: sorted names and one auto bit per name
+
+    Bit i of autos (LSB first) is set if names[i] was automatically
+    installed, ids[i] is the id of names[i] in name_table. If the list has
+    versions, versions[i] and archs[i] are the version and architecture
+    index of names[i] ('' and 0 when unknown), otherwise both are None.
+    Iterating, len(), in, keys(), items(), get() and package_set[name]
+    behave like on the {name: {"auto": bool, "version": str, "arch": str}}
+    dict.
+    """
+
+    __slots__ = ('names', 'autos', 'ids', 'versions', 'archs', '_id_bits',
+                 '_manual_id_bits', '__weakref__')
+
+    def __init__(self, names=(), autos=None, ids=None, versions=None,
+                 archs=None):
+        '''names must be sorted without duplicates'''
+        if ids is None:
+            (names, ids) = name_table.intern_names(names)
+        self.names = names
+        self.ids = ids
+        if autos is None:
+            autos = bytearray((len(names) + 7) // 8)
+        self.autos = autos
+        self.versions = versions
+        self.archs = archs
+        self._id_bits = None
+        self._manual_id_bits = None
+
+    @classmethod
+    def from_dict(cls, package_list):
+        '''Return the PackageSet of a {name: {"auto": bool}} package list
+
+        A PackageSet is returned as is.'''
+        if isinstance(package_list, PackageSet):
+            return package_list
+        (names, ids) = name_table.intern_names(sorted(package_list))
+        autos = bytearray((len(names) + 7) // 8)
+        versions = None
+        archs = None
+        for (i, name) in enumerate(names):
+            details = package_list[name]
+            if details['auto']:
+                autos[i >> 3] |= 1 << (i & 7)
+            version = details.get('version')
+            arch = details.get('arch')
+            if version or arch:
+                if versions is None:
+                    versions = [''] * len(names)
+                    archs = bytearray(len(names))
+                if version:
+                    versions[i] = _versions.setdefault(version, version)
+                if arch:
+                    archs[i] = _get_architecture_id(arch)
+        if versions is not None:
+            versions = tuple(versions)
+        return cls(names, autos, ids, versions, archs)
+
+    @classmethod
+    def from_columns(cls, names, autos, versions=None, archs=None):
+        '''Return the PackageSet of sorted names and their columns
+
+        autos is a list of bools, versions and archs lists of strings.'''
+        bitmap = bytearray((len(names) + 7) // 8)
+        for (i, auto) in enumerate(autos):
+            if auto:
+                bitmap[i >> 3] |= 1 << (i & 7)
+        if versions is not None:
+            versions = tuple(_versions.setdefault(version, version)
+                             for version in versions)
+            archs = bytearray(_get_architecture_id(arch) for arch in archs)
+        return cls(tuple(names), bitmap, None, versions, archs)
+
+    def to_dict(self):
+        '''Return the {name: {"auto": bool, ...}} package list'''
+        return dict(self.items())
+
+    def _position(self, name):
+        i = bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            return i
+        return -1
+
+    def _is_auto_at(self, i):
+        return bool(self.autos[i >> 3] & (1 << (i & 7)))
+
+    def _version_at(self, i):
+        '''Return (version, arch) of names[i], '' if unknown'''
+        if self.versions is None:
+            return ('', '')
+        return (self.versions[i], _architectures[self.archs[i]])
+
+    def _entry_at(self, i):
+        (version, arch) = self._version_at(i)
+        return _get_entry(self._is_auto_at(i), version, arch)
+
+    def has_versions(self):
+        '''Return True if the package list has versions'''
+        return self.versions is not None
+
+    def get_version(self, name):
+        '''Return (version, arch) of name, '' if unknown, KeyError if absent'''
+        i = self._position(name)
+        if i < 0:
+            raise KeyError(name)
+        return self._version_at(i)
+
+    def get_arch_names(self):
+        '''Return the architecture of every package, None without versions'''
+        if self.archs is None:
+            return None
+        return [_architectures[arch] for arch in self.archs]
+
+    def get_id_bits(self):
+        '''Return the package ids of this set as the bits of an integer
+
+        Bit i is set if the package of id i in name_table is in the set.'''
+        if self._id_bits is None:
+            self._id_bits = _ids_to_bits(self.ids)
+        return self._id_bits
+
+    def get_manual_id_bits(self):
+        '''Return the ids of the manually installed packages as bits'''
+        if self._manual_id_bits is None:
+            self._manual_id_bits = _ids_to_bits(
+                [package_id for (i, package_id) in enumerate(self.ids)
+                 if not self._is_auto_at(i)])
+        return self._manual_id_bits
+
+    def is_auto(self, name):
+        '''Return if name was automatically installed, KeyError if absent'''
+        i = self._position(name)
+        if i < 0:
+            raise KeyError(name)
+        return self._is_auto_at(i)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        package_id = name_table.get_id(name)
+        return (package_id is not None and
+                bool(self.get_id_bits() >> package_id & 1))
+
+    def __getitem__(self, name):
+        i = self._position(name)
+        if i < 0:
+            raise KeyError(name)
+        return self._entry_at(i)
+
+    def get(self, name, default=None):
+        i = self._position(name)
+        if i < 0:
+            return default
+        return self._entry_at(i)
+
+    def keys(self):
+        return self.names
+
+    def items(self):
+        '''yield (name, {"auto": bool, ...}) sorted by name'''
+        for (i, name) in enumerate(self.names):
+            yield (name, self._entry_at(i))
+
+    def slice_items(self, start=0, stop=None):
+        '''Return [(name, auto), ...] for the names from start to stop'''
+        if stop is None or stop > len(self.names):
+            stop = len(self.names)
+        return [(self.names[i], self._is_auto_at(i))
+                for i in range(start, stop)]
+
+    def manual_names(self):
+        '''Return the sorted names of manually installed packages'''
+        return [name for (i, name) in enumerate(self.names)
+                if not self._is_auto_at(i)]
+
+    def _filter(self, other, keep_common):
+        '''sorted names of this set which are in other, or not'''
+        other = PackageSet.from_dict(other)
+        if keep_common:
+            bits = self.get_id_bits() & other.get_id_bits()
+        else:
+            bits = self.get_id_bits() & ~other.get_id_bits()
+        if popcount(bits) * 8 < len(self.names):
+            # few names: only look at the set bits
+            return names_of_bits(bits)
+        other_names = frozenset(other.names)
+        if keep_common:
+            return [name for name in self.names if name in other_names]
+        return list(filterfalse(other_names.__contains__, self.names))
+
+    def difference(self, other):
+        '''Return the sorted names in this set and not in other'''
+        return self._filter(other, False)
+
+    def intersection(self, other):
+        '''Return the sorted names both in this set and in other'''
+        return self._filter(other, True)
+
+    def union(self, other):
+        '''Return the sorted names in this set or in other'''
+        return sorted(frozenset(self.names).union(other))
+
+    def version_changes(self, other):
+        '''Return the packages of both sets with another version or arch
+
+        Packages without a known version on both sides are skipped.
+        Return: sorted [(name, version, arch, other version, other arch)]'''
+        other = PackageSet.from_dict(other)
+        changes = []
+        if self.versions is None or other.versions is None:
+            return changes
+        for name in self.intersection(other):
+            (version, arch) = self.get_version(name)
+            (other_version, other_arch) = other.get_version(name)
+            if not version or not other_version:
+                continue
+            if (version, arch) != (other_version, other_arch):
+                changes.append((name, version, arch, other_version,
+                                other_arch))
+        return changes
+
+    def __eq__(self, other):
+        if isinstance(other, PackageSet):
+            return (self.names == other.names and self.autos == other.autos
+                    and self.versions == other.versions and
+                    self.archs == other.archs)
+        try:
+            return len(self) == len(other) and all(
+                name in other and
+                _normalize_entry(other[name]) == self._entry_at(i)
+                for (i, name) in enumerate(self.names))
+        except (TypeError, KeyError):
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'PackageSet(%d packages)' % len(self.names)
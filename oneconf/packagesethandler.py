@@ -18,49 +18,134 @@
 
 
 import hashlib
-import json
 import logging
 import os
 from pprint import pformat
+import threading
+import weakref
 
 LOG = logging.getLogger(__name__)
 
-from oneconf.hosts import Hosts
+from oneconf.hosts import get_hosts
 from oneconf.distributor import get_distro
-from oneconf.paths import PACKAGE_LIST_PREFIX
-from oneconf import utils
+from oneconf.drifttracker import DriftTracker
+from oneconf import inventoryworker, packagelistcache
+from oneconf.packageindex import PackageIndex
+from oneconf.packageset import (PackageSet, intersection_bits, names_of_bits,
+                                 popcount, union_bits)
+from oneconf.paths import DRIFT_FILENAME, PACKAGE_INDEX_FILENAME
+from oneconf import metrics, utils
+
+def get_packagelist_delta(old_package_list, new_package_list):
+    '''Compare two package lists, as dicts or PackageSets
+
+    Return: (added packages, removed packages,
+             packages whose auto flag changed), all sorted'''
+    old_package_list = PackageSet.from_dict(old_package_list)
+    new_package_list = PackageSet.from_dict(new_package_list)
+    added = new_package_list.difference(old_package_list)
+    removed = old_package_list.difference(new_package_list)
+    auto_changed = [
+        name for name in new_package_list.intersection(old_package_list)
+        if new_package_list.is_auto(name) != old_package_list.is_auto(name)]
+    return (added, removed, auto_changed)
+
 
 class PackageSetInitError(Exception):
     """An error occurred, preventing the package set to initialize."""
 
 
+def _locked(func):
+    '''serialize calls to func on the handler lock'''
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+class _UpdateRun(object):
+    '''Outcome of one update, shared by the requests waiting for it'''
+
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.error = None
+
+
 class PackageSetHandler(object):
     """
     Direct access to database for getting and updating the list
     """
 
-    def __init__(self, hosts=None):
+    def __init__(self, hosts=None, store=None, use_inventory_worker=False,
+                 snapshot_store=None):
 
         self.hosts = hosts
         if not hosts:
-            self.hosts = Hosts()
+            self.hosts = get_hosts()
         self.distro = get_distro()
         if not self.distro:
             raise PackageSetInitError(
                 "Can't initialize PackageSetHandler: no valid distro provided")
         self.last_storage_sync = None
+        # compute the local package list in a short lived process
+        self.use_inventory_worker = use_inventory_worker
+
+        # the dbus service runs requests in worker threads, while sync runs
+        # in the main loop: every public entry point takes this lock
+        self.lock = threading.RLock()
+
+        # update coalescing: at most one update running and one queued,
+        # the _UpdateRun every new request waits for
+        self._update_condition = threading.Condition()
+        self._update_running = False
+        self._next_update = None
 
         # create cache for storage package list, indexed by hostid
         self.package_list = {}
+        # hosts with the same packages checksum share one loaded PackageSet
+        self._package_sets = weakref.WeakValueDictionary()
+
+        # optional history of the package lists (SnapshotStore)
+        self.snapshot_store = snapshot_store
+
+        # package -> hosts index, loaded on first use (json backend only)
+        self._index = None
+        self._index_changed = False
+
+        # drift against the baseline host, loaded on first use
+        self._drift_tracker = None
+        self._drift_changed = False
+
+        # optional indexed backend (SqlitePackageStore). The json files stay
+        # the reference as they are what is synced with the infra.
+        self.store = store
+        # every attribute has to be set already: the migration can run the
+        # first update() of the current host
+        if self.store:
+            self.migrate_store()
 
 
     def update(self):
-        '''update the store with package list'''
+        '''update the store with package list
+
+        The package list is computed without holding the lock, so that the
+        other requests and the sync are answered meanwhile.
+
+        Return: (new packages checksum, delta against the previous list as
+                 returned by get_packagelist_delta)'''
 
         hostid = self.hosts.current_host['hostid']
 
         LOG.debug("Updating package list")
-        newpkg_list = self.distro.compute_local_packagelist()
+        with metrics.timer('compute_local_packagelist'):
+            if self.use_inventory_worker:
+                newpkg_list = inventoryworker.compute_local_packagelist(
+                    self.distro)
+            else:
+                newpkg_list = self.distro.compute_local_packagelist()
 
         LOG.debug("Creating the checksum")
         # We need to get a reliable checksum for the dictionary in
@@ -69,30 +154,201 @@ class PackageSetHandler(object):
         # of the dictionary.  pprint.pformat() seems to give us the best
         # option here since it guarantees that dictionary keys are sorted.
         # hashlib works on bytes only though, so assume utf-8.
-        hash_input = pformat(newpkg_list).encode('utf-8')
-        checksum = hashlib.sha224(hash_input).hexdigest()
+        with metrics.timer('packages_checksum'):
+            hash_input = pformat(newpkg_list).encode('utf-8')
+            checksum = hashlib.sha224(hash_input).hexdigest()
+        package_set = PackageSet.from_dict(newpkg_list)
 
+        return self._apply_update(hostid, checksum, newpkg_list, package_set)
+
+    @_locked
+    def _apply_update(self, hostid, checksum, newpkg_list, package_set):
+        '''Replace the package list of the current host by a computed one'''
         LOG.debug("Package list need refresh")
-        self.package_list[hostid] = {'valid': True, 'package_list': newpkg_list}
-        utils.save_json_file_update(os.path.join(self.hosts.get_currenthost_dir(), '%s_%s' % (PACKAGE_LIST_PREFIX, hostid)),
-                                    self.package_list[hostid]['package_list'])
+        old_package_list = self._get_cached_packagelist(hostid)
+        if old_package_list is None:
+            old_package_list = self._load_packagelist_file(hostid) or {}
+        package_set = self._share_package_set(checksum, package_set)
+        delta = get_packagelist_delta(old_package_list, package_set)
+        self.package_list[hostid] = {'valid': True, 'package_list': package_set}
+        packagelistcache.save_package_list(self.hosts.get_currenthost_dir(),
+                                           hostid, checksum, newpkg_list)
+        self._index_packagelist(hostid, checksum, package_set,
+                                old_package_list)
+        self._track_drift(hostid, checksum, package_set)
+        if self.snapshot_store:
+            self.snapshot_store.record(hostid, checksum, package_set)
+        self.save_indexes()
         if self.hosts.current_host['packages_checksum'] != checksum:
             self.hosts.current_host['packages_checksum'] = checksum
             self.hosts.save_current_host()
         LOG.debug("Update done")
+        return (checksum, delta)
+
+    def coalesced_update(self):
+        '''update, sharing the work with concurrent requests
+
+        Every caller waits for an update started after its request, but all
+        the requests made while an update runs share the next one and get
+        its result. Raise the error of the shared update if it failed.'''
+
+        with self._update_condition:
+            # the running update may have read the package state before
+            # this request was made: we need the next one
+            run = self._next_update
+            if run is None:
+                run = self._next_update = _UpdateRun()
+            while self._update_running and not run.done:
+                self._update_condition.wait()
+            if run.done:
+                LOG.debug("Update request shared with a concurrent one")
+                if run.error:
+                    raise run.error
+                return run.result
+            self._update_running = True
+            self._next_update = None
 
+        try:
+            run.result = self.update()
+            return run.result
+        except Exception as e:
+            run.error = e
+            raise
+        finally:
+            with self._update_condition:
+                self._update_running = False
+                run.done = True
+                self._update_condition.notify_all()
+
+    @_locked
+    def refresh_packagelist(self, hostid, checksum, package_list):
+        '''a new package list for hostid is saved, refresh caches and index
+
+        The index and the drift are only saved by the next save_indexes()
+        call.'''
+
+        LOG.debug("Refreshing package list for %s", hostid)
+        package_list = self._share_package_set(
+            checksum, PackageSet.from_dict(package_list))
+        old_package_list = self._get_cached_packagelist(hostid)
+        # only replace already loaded lists, others are loaded on demand
+        if hostid in self.package_list:
+            self.package_list[hostid] = {'valid': True,
+                                         'package_list': package_list}
+        self._index_packagelist(hostid, checksum, package_list,
+                                old_package_list)
+        self._track_drift(hostid, checksum, package_list)
+        if self.snapshot_store:
+            self.snapshot_store.record(hostid, checksum, package_list)
+
+    @_locked
+    def get_packagelist_delta(self, hostid, package_list):
+        '''compare package_list to the one currently known for hostid
+
+        To be called before the new list replaces the stored one.'''
+        old_package_list = self._get_cached_packagelist(hostid)
+        if old_package_list is None:
+            old_package_list = self._load_packagelist_file(hostid) or {}
+        return get_packagelist_delta(old_package_list, package_list)
+
+    def _share_package_set(self, checksum, package_set):
+        '''Return the PackageSet already loaded for checksum, or package_set
+        which is then shared with the next hosts having the same checksum'''
+        if not packagelistcache.is_valid_checksum(checksum):
+            return package_set
+        shared = self._package_sets.get(checksum)
+        if shared is not None:
+            metrics.count('packagelist_shared.hit')
+            return shared
+        self._package_sets[checksum] = package_set
+        return package_set
+
+    @_locked
+    def remove_unused_package_lists(self):
+        '''Remove the stored package lists no known host points to'''
+        used_checksums = set(self._get_packages_checksum(hostid)
+                             for hostid in self._get_all_hostids())
+        packagelistcache.remove_unused(self.hosts.get_currenthost_dir(),
+                                       used_checksums)
+
+    def _get_cached_packagelist(self, hostid):
+        '''Return the valid cached package list for hostid or None'''
+        try:
+            if self.package_list[hostid]['valid']:
+                return self.package_list[hostid]['package_list']
+        except KeyError:
+            pass
+        return None
+
+    def _index_packagelist(self, hostid, checksum, package_list,
+                           old_package_list=None):
+        '''Incrementally update the store or the index for hostid'''
+        if self.store:
+            self.store.set_packages(hostid, checksum, package_list)
+        else:
+            index = self._get_index()
+            index.set_host(hostid, checksum, package_list, old_package_list)
+            self._index_changed = True
+
+    @_locked
+    def save_indexes(self, save=utils.save_json_file_update):
+        '''Save the package index and the drift report if they changed
+
+        save(path, content) writes the files, the sync passes the one of its
+        transaction to save them with the new package lists.'''
+        if self._index_changed:
+            self._index.save(save)
+            self._index_changed = False
+        if self._drift_changed:
+            self._drift_tracker.save(save)
+            self._drift_changed = False
+
+    @_locked
     def get_packages(self, hostid=None, hostname=None, only_manual=False):
-        '''get all installed packages from the storage'''
+        '''get all installed packages from the storage
+
+        Return: the PackageSet of hostid, or the sorted list of manually
+                installed package names if only_manual is set'''
 
         hostid = self.hosts.get_hostid_from_context(hostid, hostname)
         LOG.debug ("Request for package list for %s with only manual packages reduced scope to: %s", hostid, only_manual)
+        if self.store:
+            self._ensure_stored(hostid)
+            return self.store.get_packages(hostid, only_manual)
         package_list = self._get_installed_packages(hostid)
         if only_manual:
-            package_list = [
-                package_elem for package_elem in package_list
-                if not package_list[package_elem]["auto"]]
+            package_list = package_list.manual_names()
         return package_list
 
+    @_locked
+    def get_packages_page(self, hostid=None, hostname=None, only_manual=False,
+                          offset=0, limit=None):
+        '''get a slice of the installed packages, sorted by name
+
+        Return: ([(name, auto), ...], total number of packages in scope)'''
+
+        hostid = self.hosts.get_hostid_from_context(hostid, hostname)
+        LOG.debug("Request for package page %s+%s for %s (only manual: %s)",
+                  offset, limit, hostid, only_manual)
+        if self.store:
+            self._ensure_stored(hostid)
+            return self.store.get_packages_page(hostid, only_manual, offset,
+                                                limit)
+        package_set = self._get_installed_packages(hostid)
+        end = None
+        if limit is not None:
+            end = offset + limit
+        if not only_manual:
+            # names are already sorted in the package set
+            return package_set.slice_items(offset, end), len(package_set)
+        # the manual list lives in the cache entry, replaced by any new list
+        cache_entry = self.package_list[hostid]
+        if 'sorted_manual' not in cache_entry:
+            cache_entry['sorted_manual'] = [
+                (name, False) for name in package_set.manual_names()]
+        packages = cache_entry['sorted_manual']
+        return packages[offset:end], len(packages)
+
     def _get_installed_packages(self, hostid):
         '''get installed packages from the storage or cache
 
@@ -107,15 +363,21 @@ class PackageSetHandler(object):
                 need_reload = True
         except KeyError:
             need_reload = True
+        if need_reload:
+            metrics.count('packagelist_cache.miss')
+        else:
+            metrics.count('packagelist_cache.hit')
 
         if need_reload:
             self.package_list[hostid] = {
                 'valid': True,
-                'package_list': self._get_packagelist_from_store(hostid),
+                'package_list': PackageSet.from_dict(
+                    self._get_packagelist_from_store(hostid)),
                 }
         return self.package_list[hostid]['package_list']
 
 
+    @_locked
     def diff(self, distant_hostid=None, distant_hostname=None):
         """get a diff from current package state from another host
 
@@ -128,21 +390,27 @@ class PackageSetHandler(object):
 
         distant_hostid = self.hosts.get_hostid_from_context(
             distant_hostid, distant_hostname)
-
-        LOG.debug("Collecting all installed packages on this system")
-        local_package_list = set(
-            self.get_packages(self.hosts.current_host['hostid'], False))
-
-        LOG.debug("Collecting all installed packages on the other system")
-        distant_package_list = set(self.get_packages(distant_hostid, False))
-
-        LOG.debug("Comparing")
-        packages_to_install = [
-            x for x in sorted(distant_package_list)
-            if x not in local_package_list]
-        packages_to_remove = [
-            x for x in sorted(local_package_list)
-            if x not in distant_package_list]
+        local_hostid = self.hosts.current_host['hostid']
+
+        if self.store:
+            LOG.debug("Comparing in the sqlite store")
+            self._ensure_stored(local_hostid)
+            self._ensure_stored(distant_hostid)
+            (packages_to_install, packages_to_remove) = self.store.diff(
+                local_hostid, distant_hostid)
+        else:
+            LOG.debug("Collecting all installed packages on this system")
+            local_package_list = self._get_installed_packages(local_hostid)
+
+            LOG.debug("Collecting all installed packages on the other system")
+            distant_package_list = self._get_installed_packages(
+                distant_hostid)
+
+            LOG.debug("Comparing")
+            packages_to_install = distant_package_list.difference(
+                local_package_list)
+            packages_to_remove = local_package_list.difference(
+                distant_package_list)
 
         # for Dbus which doesn't like empty list
         if not packages_to_install:
@@ -152,21 +420,352 @@ class PackageSetHandler(object):
 
         return packages_to_install, packages_to_remove
 
+    @_locked
+    def diff_versions(self, distant_hostid=None, distant_hostname=None):
+        """get a diff from current package state from another host, versions
+        included
 
-    def _get_packagelist_from_store(self, hostid):
-        '''load package list for every computer in cache'''
+        Return: (packages_to_install, packages_to_remove, as diff(),
+                 packages_to_change (packages on both hosts with another
+                 version or architecture, as sorted (name, local version,
+                 local arch, distant version, distant arch)))
+        Packages without a known version on one host aren't compared.
+        """
 
-        LOG.debug('get package list from store for hostid: %s' % hostid)
+        distant_hostid = self.hosts.get_hostid_from_context(
+            distant_hostid, distant_hostname)
+        local_hostid = self.hosts.current_host['hostid']
+
+        if self.store:
+            LOG.debug("Comparing versions in the sqlite store")
+            self._ensure_stored(local_hostid)
+            self._ensure_stored(distant_hostid)
+            (packages_to_install, packages_to_remove) = self.store.diff(
+                local_hostid, distant_hostid)
+            packages_to_change = self.store.diff_versions(local_hostid,
+                                                          distant_hostid)
+        else:
+            local_package_list = self._get_installed_packages(local_hostid)
+            distant_package_list = self._get_installed_packages(
+                distant_hostid)
+            packages_to_install = distant_package_list.difference(
+                local_package_list)
+            packages_to_remove = local_package_list.difference(
+                distant_package_list)
+            packages_to_change = local_package_list.version_changes(
+                distant_package_list)
+        return (packages_to_install, packages_to_remove, packages_to_change)
+
+    @_locked
+    def get_packages_at(self, timestamp, hostid=None, hostname=None):
+        """get the packages a host had installed at timestamp
+
+        Return: the PackageSet of hostid, None if there is no snapshot of
+                hostid before timestamp or no snapshot store
+        """
 
-        # load current content in cache
+        hostid = self.hosts.get_hostid_from_context(hostid, hostname)
+        if not self.snapshot_store:
+            return None
+        package_list = self.snapshot_store.get_packages_at(hostid, timestamp)
+        if package_list is None:
+            return None
+        return PackageSet.from_dict(package_list)
+
+    @_locked
+    def get_changes_between(self, start, end, hostid=None, hostname=None):
+        """get what changed on a host between two timestamps
+
+        Return: sorted (added, removed, changed) package names, as
+                SnapshotStore.get_changes
+        """
+
+        hostid = self.hosts.get_hostid_from_context(hostid, hostname)
+        if not self.snapshot_store:
+            return ([], [], [])
+        return self.snapshot_store.get_changes(hostid, start, end)
+
+    @_locked
+    def get_hosts_with_package(self, package, only_manual=False):
+        """get all hosts having a package installed
+
+        Return: sorted list of hostids (restricted to the ones where the
+                package was manually installed if only_manual is set)
+        """
+
+        LOG.debug("Request for hosts having %s installed, only manual: %s",
+                  package, only_manual)
+        if self.store:
+            self.migrate_store()
+            return self.store.get_hosts_with_package(package, only_manual)
+
+        return self._refresh_index().get_hosts_with_package(package,
+                                                            only_manual)
+
+    def _get_id_bits(self, hostid, only_manual=False):
+        '''Return the package ids of hostid as the bits of an integer'''
+        package_set = self._get_installed_packages(hostid)
+        if only_manual:
+            return package_set.get_manual_id_bits()
+        return package_set.get_id_bits()
+
+    @_locked
+    def get_common_packages(self, only_manual=False):
+        """get the packages installed on every host
+
+        Return: sorted list of package names (manually installed on every
+                host if only_manual is set)
+        """
+
+        return names_of_bits(intersection_bits(
+            [self._get_id_bits(hostid, only_manual)
+             for hostid in self._get_all_hostids()]))
+
+    @_locked
+    def get_unique_packages(self, hostid=None, hostname=None,
+                            only_manual=False):
+        """get the packages of a host which no other host has installed
+
+        Return: sorted list of package names (restricted to the ones
+                manually installed on the host if only_manual is set)
+        """
+
+        hostid = self.hosts.get_hostid_from_context(hostid, hostname)
+        others_bits = union_bits(
+            [self._get_id_bits(other_hostid)
+             for other_hostid in self._get_all_hostids()
+             if other_hostid != hostid])
+        return names_of_bits(self._get_id_bits(hostid, only_manual) &
+                             ~others_bits)
+
+    @_locked
+    def get_hosts_drift(self, baseline_hostid=None, baseline_hostname=None,
+                        only_manual=False):
+        """compare every other host to a baseline host
+
+        Return: [(hostid, number of baseline packages it misses,
+                  number of packages the baseline doesn't have), ...]
+                for all hosts but the baseline, most drifting first
+        """
+
+        baseline_hostid = self.hosts.get_hostid_from_context(
+            baseline_hostid, baseline_hostname)
+        baseline_bits = self._get_id_bits(baseline_hostid, only_manual)
+        drifts = []
+        for hostid in self._get_all_hostids():
+            if hostid == baseline_hostid:
+                continue
+            bits = self._get_id_bits(hostid, only_manual)
+            drifts.append((hostid, popcount(baseline_bits & ~bits),
+                           popcount(bits & ~baseline_bits)))
+        drifts.sort(key=lambda drift: (-drift[1] - drift[2], drift[0]))
+        return drifts
+
+    def emit_drift_changed(self, hostid, nb_missing, nb_extra):
+        '''called when the drift of hostid against the baseline changed'''
+        LOG.debug("Drift of %s changed: %s missing, %s extra packages",
+                  hostid, nb_missing, nb_extra)
+
+    @_locked
+    def set_drift_baseline(self, hostid=None, hostname=None):
+        """track the drift of every host against this one
+
+        Return: the drift summary, as get_drift_summary
+        """
+
+        hostid = self.hosts.get_hostid_from_context(hostid, hostname)
+        tracker = self._get_drift_tracker()
+        tracker.set_baseline(hostid, self._get_packages_checksum(hostid),
+                             self._get_installed_packages(hostid))
+        self._drift_changed = True
+        self._refresh_drift()
+        return tracker.get_summary()
+
+    @_locked
+    def get_drift_summary(self):
+        """get the drift of every host against the baseline one
+
+        Return: [(hostid, number of baseline packages it misses,
+                  number of packages the baseline doesn't have), ...]
+                most drifting first, empty if there is no baseline
+        """
+
+        if self._get_drift_tracker().baseline is None:
+            return []
+        return self._refresh_drift().get_summary()
+
+    @_locked
+    def get_drift(self, hostid=None, hostname=None):
+        """get the packages of a host drifting from the baseline
+
+        Return: (sorted baseline packages it misses,
+                 sorted packages the baseline doesn't have)
+        """
+
+        hostid = self.hosts.get_hostid_from_context(hostid, hostname)
+        tracker = self._get_drift_tracker()
+        if tracker.baseline is None:
+            return ([], [])
+        return self._refresh_drift().get_drift(hostid)
+
+    def _get_drift_tracker(self):
+        '''Load the drift tracker on first use'''
+        if self._drift_tracker is None:
+            self._drift_tracker = DriftTracker(os.path.join(
+                self.hosts.get_currenthost_dir(), DRIFT_FILENAME))
+        return self._drift_tracker
+
+    def _track_drift(self, hostid, checksum, package_list):
+        '''Incrementally update the drift with a new package list'''
+        tracker = self._get_drift_tracker()
+        if tracker.baseline is None:
+            return
+        changed_hostids = tracker.set_host(hostid, checksum, package_list)
+        self._drift_changed = True
+        self._emit_drift_changes(changed_hostids)
+
+    def _refresh_drift(self):
+        '''Track hosts with a changed packages checksum, drop unknown ones'''
+        tracker = self._get_drift_tracker()
+        hostids = self._get_all_hostids()
+        changed_hostids = set()
+        # a new baseline list has to move the drifts first
+        if tracker.baseline in hostids:
+            hostids.remove(tracker.baseline)
+            hostids.insert(0, tracker.baseline)
+        for hostid in hostids:
+            checksum = self._get_packages_checksum(hostid)
+            if tracker.is_uptodate(hostid, checksum):
+                continue
+            package_list = self._get_installed_packages(hostid)
+            # loading the current host for the first time triggers an
+            # update() which already tracked it
+            checksum = self._get_packages_checksum(hostid)
+            if not tracker.is_uptodate(hostid, checksum):
+                changed_hostids.update(tracker.set_host(hostid, checksum,
+                                                        package_list))
+        for hostid in list(tracker.hosts):
+            if hostid not in hostids:
+                tracker.remove_host(hostid)
+                changed_hostids.add(hostid)
+        if changed_hostids:
+            self._drift_changed = True
+            self._emit_drift_changes(
+                [hostid for hostid in changed_hostids if hostid in hostids])
+        self.save_indexes()
+        return tracker
+
+    def _emit_drift_changes(self, hostids):
+        tracker = self._get_drift_tracker()
+        for hostid in sorted(hostids):
+            (missing, extra) = tracker.get_drift(hostid)
+            self.emit_drift_changed(hostid, len(missing), len(extra))
+
+    def _get_index(self):
+        '''Load the package index on first use'''
+        if self._index is None:
+            self._index = PackageIndex(os.path.join(
+                self.hosts.get_currenthost_dir(), PACKAGE_INDEX_FILENAME))
+        return self._index
+
+    def _refresh_index(self):
+        '''Index hosts with a changed packages checksum, drop unknown ones'''
+        index = self._get_index()
+        hostids = self._get_all_hostids()
+        for hostid in hostids:
+            if index.is_uptodate(hostid, self._get_packages_checksum(hostid)):
+                continue
+            package_list = self._get_installed_packages(hostid)
+            # loading the current host for the first time triggers an
+            # update() which already indexed it
+            checksum = self._get_packages_checksum(hostid)
+            if not index.is_uptodate(hostid, checksum):
+                index.set_host(hostid, checksum, package_list)
+                self._index_changed = True
+        for hostid in list(index.hosts):
+            if hostid not in hostids:
+                index.remove_host(hostid)
+                self._index_changed = True
+        self.save_indexes()
+        return index
+
+    def _get_all_hostids(self):
+        '''Return current hostid followed by every other hostids'''
+        return [self.hosts.current_host['hostid']] + list(self.hosts.other_hosts)
+
+    def _get_packages_checksum(self, hostid):
+        '''Return the packages checksum currently advertised for hostid'''
+        return self.hosts.gethost_by_id(hostid).get('packages_checksum')
+
+    def _ensure_stored(self, hostid):
+        '''(re)import hostid package list in the store if it's outdated'''
+        if not self.store.is_uptodate(hostid,
+                                      self._get_packages_checksum(hostid)):
+            self._import_in_store(hostid)
+
+    def _import_in_store(self, hostid):
+        '''import the json package list of hostid in the store'''
+        LOG.debug("Importing package list for %s in the store", hostid)
+        pkg_list = self._get_packagelist_from_store(hostid)
+        # loading the current host for the first time triggers an update()
+        # which already refreshed both the checksum and the store
+        checksum = self._get_packages_checksum(hostid)
+        if not self.store.is_uptodate(hostid, checksum):
+            self.store.set_packages(hostid, checksum, pkg_list)
+
+    @_locked
+    def migrate_store(self):
+        """import the package_list_* files in the store
+
+        Only hosts with a changed packages checksum are (re)imported and
+        hosts which are no more known are dropped from the store.
+        """
+
+        stored_checksums = self.store.get_checksums()
+        hostids = self._get_all_hostids()
+        for hostid in hostids:
+            try:
+                if stored_checksums[hostid] == self._get_packages_checksum(hostid):
+                    continue
+            except KeyError:
+                pass
+            self._import_in_store(hostid)
+        for hostid in stored_checksums:
+            if hostid not in hostids:
+                self.store.remove_host(hostid)
+
+
+    def _load_packagelist_file(self, hostid):
+        '''Return the saved package list of hostid, None if there is none
+
+        Lists stored by checksum are returned as the shared PackageSet.'''
+        host_dir = self.hosts.get_currenthost_dir()
         try:
-            with open(os.path.join(self.hosts.get_currenthost_dir(), '%s_%s' % (PACKAGE_LIST_PREFIX, hostid)), 'r') as f:
-                # can be none in corrupted null file
-                pkg_list = json.load(f)
+            # can be none in corrupted null file
+            with metrics.timer('json_load'):
+                (checksum, pkg_list) = packagelistcache.load_host_file(
+                    host_dir, hostid)
+                if checksum is None:
+                    return pkg_list
+                package_set = self._package_sets.get(checksum)
+                if package_set is not None:
+                    metrics.count('packagelist_shared.hit')
+                    return package_set
+                pkg_list = packagelistcache.load_content(host_dir, checksum)
         except (IOError, ValueError):
             LOG.warning ("no valid package list stored for hostid: %s" % hostid)
-            pkg_list = None
+            return None
+        if pkg_list is None:
+            return None
+        return self._share_package_set(checksum, PackageSet.from_dict(pkg_list))
 
+    def _get_packagelist_from_store(self, hostid):
+        '''load package list for every computer in cache'''
+
+        LOG.debug('get package list from store for hostid: %s' % hostid)
+
+        # load current content in cache
+        pkg_list = self._load_packagelist_file(hostid)
         if pkg_list is None:
             pkg_list = {}
             # there is no way that no package is installed in current host
@@ -0,0 +1,131 @@
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Compact binary layout for package lists sent over D-Bus
+
+A packed payload is one flag byte followed by a body, zlib compressed if
+PACKED_COMPRESSED is set. The body is:
+  - two big endian unsigned ints: number of names, number of names in the
+    first part (the "to install" side of a diff, all names otherwise)
+  - the newline joined, utf-8 encoded names
+  - one bit per name (LSB first), set for automatically installed packages
+If PACKED_VERSIONS is set, the names are followed by the newline joined
+versions then architectures of every package ('' if unknown), and the
+header by the byte lengths of those three text columns.
+"""
+
+import logging
+import struct
+import zlib
+
+from oneconf.packageset import PackageSet
+
+LOG = logging.getLogger(__name__)
+
+PACKED_COMPRESSED = 1
+PACKED_VERSIONS = 2
+_HEADER = struct.Struct('>II')
+_COLUMNS_HEADER = struct.Struct('>III')
+
+
+def _pack(names, autos, nb_first, compress):
+    bitmap = bytearray((len(names) + 7) // 8)
+    for i, auto in enumerate(autos):
+        if auto:
+            bitmap[i // 8] |= 1 << (i % 8)
+    return _pack_bitmap(names, bitmap, nb_first, compress)
+
+
+def _pack_bitmap(names, bitmap, nb_first, compress, versions=None,
+                 archs=None):
+    flags = 0
+    if versions is None:
+        body = b''.join((_HEADER.pack(len(names), nb_first),
+                         '\n'.join(names).encode('utf-8'), bytes(bitmap)))
+    else:
+        flags |= PACKED_VERSIONS
+        columns = ['\n'.join(column).encode('utf-8')
+                   for column in (names, versions, archs)]
+        body = b''.join([_HEADER.pack(len(names), nb_first),
+                         _COLUMNS_HEADER.pack(*[len(column)
+                                                for column in columns])] +
+                        columns + [bytes(bitmap)])
+    if compress:
+        flags |= PACKED_COMPRESSED
+        body = zlib.compress(body)
+    return bytes(bytearray((flags,))) + body
+
+
+def _unpack(data):
+    data = bytes(data)
+    flags = bytearray(data[:1])[0]
+    body = data[1:]
+    if flags & PACKED_COMPRESSED:
+        body = zlib.decompress(body)
+    (nb_names, nb_first) = _HEADER.unpack_from(body)
+    bitmap = bytearray(body[len(body) - (nb_names + 7) // 8:])
+    autos = [bool(bitmap[i // 8] & (1 << (i % 8))) for i in range(nb_names)]
+    if not flags & PACKED_VERSIONS:
+        names = []
+        if nb_names:
+            names = body[_HEADER.size:len(body) - len(bitmap)].decode(
+                'utf-8').split('\n')
+        return (names, autos, nb_first, None, None)
+    columns = []
+    start = _HEADER.size + _COLUMNS_HEADER.size
+    for length in _COLUMNS_HEADER.unpack_from(body, _HEADER.size):
+        column = []
+        if nb_names:
+            column = body[start:start + length].decode('utf-8').split('\n')
+        columns.append(column)
+        start += length
+    (names, versions, archs) = columns
+    return (names, autos, nb_first, versions, archs)
+
+
+def pack_packages(package_list, compress=False):
+    '''Pack a {name: {"auto": bool, ...}} package list or a PackageSet'''
+    package_list = PackageSet.from_dict(package_list)
+    # same sorted names and auto bitmap than the wire format
+    return _pack_bitmap(package_list.names, package_list.autos,
+                        len(package_list), compress, package_list.versions,
+                        package_list.get_arch_names())
+
+
+def unpack_packages(data):
+    '''Return the {name: {"auto": bool, ...}} package list from packed data'''
+    return unpack_package_set(data).to_dict()
+
+
+def unpack_package_set(data):
+    '''Return the PackageSet of packed data'''
+    (names, autos, nb_first, versions, archs) = _unpack(data)
+    return PackageSet.from_columns(names, autos, versions, archs)
+
+
+def pack_diff(packages_to_install, packages_to_remove, compress=False):
+    '''Pack both sides of a diff in the same name table'''
+    names = list(packages_to_install) + list(packages_to_remove)
+    return _pack(names, [False] * len(names), len(packages_to_install),
+                 compress)
+
+
+def unpack_diff(data):
+    '''Return (packages_to_install, packages_to_remove) from packed data'''
+    (names, autos, nb_first, versions, archs) = _unpack(data)
+    return (names[:nb_first], names[nb_first:])
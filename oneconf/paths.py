@@ -32,11 +32,17 @@ ONECONF_OVERRIDE_FILE = "/tmp/oneconf.override"
 ONECONF_DATADIR = '/usr/share/oneconf/data'
 ONECONF_CACHE_DIR = os.path.join(xdg.xdg_cache_home, "oneconf")
 PACKAGE_LIST_PREFIX = "package_list"
+PACKAGE_LISTS_DIRNAME = "package_lists"
 OTHER_HOST_FILENAME = "other_hosts"
 PENDING_UPLOAD_FILENAME = "pending_upload"
 HOST_DATA_FILENAME = "host"
 LOGO_PREFIX = "logo"
 LAST_SYNC_DATE_FILENAME = "last_sync"
+PACKAGE_DB_FILENAME = "packages.db"
+PACKAGE_INDEX_FILENAME = "package_index"
+DRIFT_FILENAME = "drift"
+SNAPSHOTS_DIRNAME = "snapshots"
+TRANSACTION_JOURNAL_FILENAME = "transaction_journal"
 
 _datadir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
 # In both Python 2 and 3, _datadir will be a relative path, however, in Python
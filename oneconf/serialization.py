@@ -0,0 +1,94 @@
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""JSON serialization of the cache files, with the fastest available encoder
+
+orjson, then ujson, are used when installed, the json module otherwise.
+Whatever the backend, dumps() returns ascii only text that json.loads()
+reads back to the same content, and loads() raises ValueError on invalid
+content. ONECONF_JSON_BACKEND=orjson|ujson|json forces a backend.
+"""
+
+import json
+import logging
+import os
+
+LOG = logging.getLogger(__name__)
+
+BACKENDS = ('orjson', 'ujson', 'json')
+
+
+def _get_orjson():
+    import orjson
+
+    def dumps(content):
+        try:
+            data = orjson.dumps(content)
+        except TypeError:
+            # orjson rejects str subclasses as keys, like dbus.String
+            return json.dumps(content)
+        # orjson doesn't escape non ascii characters, json does
+        try:
+            if data.isascii():
+                return data.decode('ascii')
+        except AttributeError:
+            pass
+        return json.dumps(content)
+    return (dumps, orjson.loads)
+
+
+def _get_ujson():
+    import ujson
+    return (ujson.dumps, ujson.loads)
+
+
+def _get_json():
+    return (json.dumps, json.loads)
+
+
+def get_backend(name):
+    '''Return the (dumps, loads) functions of the name backend
+
+    Raise ImportError if it isn't installed.'''
+    if name not in BACKENDS:
+        raise ValueError("Unknown json backend: %s" % name)
+    return globals()['_get_%s' % name]()
+
+
+def _select_backend():
+    forced_backend = os.environ.get('ONECONF_JSON_BACKEND')
+    for name in (forced_backend,) if forced_backend else BACKENDS:
+        try:
+            (dumps, loads) = get_backend(name)
+            LOG.debug("Using %s for json serialization", name)
+            return (name, dumps, loads)
+        except ImportError:
+            LOG.debug("%s isn't available for json serialization", name)
+    return ('json', json.dumps, json.loads)
+
+(BACKEND, dumps, loads) = _select_backend()
+
+
+def dump(content, f):
+    '''Serialize content to the text file f'''
+    f.write(dumps(content))
+
+
+def load(f):
+    '''Return the content deserialized from the text file f'''
+    return loads(f.read())
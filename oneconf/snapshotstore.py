@@ -0,0 +1,230 @@
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""History of the package lists of every host
+
+Every new packages checksum of a host is recorded as a snapshot: a delta
+against the previous one and, every CHECKPOINT_INTERVAL snapshots, the full
+package list. Deltas and full lists are content addressed objects, stored
+once whatever the number of hosts or snapshots using them.
+
+A delta is {"added": {name: entry}, "removed": {name: old entry},
+"changed": {name: [old entry, new entry]}}, so that deltas can be composed
+without rebuilding any package list.
+"""
+
+from bisect import bisect_right
+import errno
+import hashlib
+import json
+import logging
+import os
+import time
+
+LOG = logging.getLogger(__name__)
+
+from oneconf.packageset import PackageSet
+from oneconf import serialization, utils
+
+CHECKPOINT_INTERVAL = 20
+HISTORY_PREFIX = "history"
+OBJECTS_DIRNAME = "objects"
+
+# history entries: [time, packages checksum, delta object, full object]
+(_TIME, _CHECKSUM, _DELTA, _FULL) = range(4)
+
+
+def compute_delta(old_package_list, new_package_list):
+    '''Return the delta from old_package_list to new_package_list'''
+    old_package_list = PackageSet.from_dict(old_package_list)
+    new_package_list = PackageSet.from_dict(new_package_list)
+    delta = {'added': {}, 'removed': {}, 'changed': {}}
+    for name in new_package_list.difference(old_package_list):
+        delta['added'][name] = new_package_list[name]
+    for name in old_package_list.difference(new_package_list):
+        delta['removed'][name] = old_package_list[name]
+    for name in new_package_list.intersection(old_package_list):
+        (old_entry, new_entry) = (old_package_list[name],
+                                  new_package_list[name])
+        if old_entry != new_entry:
+            delta['changed'][name] = [old_entry, new_entry]
+    return delta
+
+
+def _apply_delta(package_list, delta):
+    for (name, entry) in delta['added'].items():
+        package_list[name] = entry
+    for name in delta['removed']:
+        del package_list[name]
+    for (name, (old_entry, new_entry)) in delta['changed'].items():
+        package_list[name] = new_entry
+
+
+class SnapshotStore(object):
+    """
+    Content addressed store of the package list history of every host
+    """
+
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+        self.objects_dir = os.path.join(snapshot_dir, OBJECTS_DIRNAME)
+        try:
+            os.makedirs(self.objects_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # hostid -> history entries, loaded on first use
+        self._histories = {}
+        # hostid -> latest PackageSet, to compute the next delta
+        self._latest = {}
+
+    def _get_history_path(self, hostid):
+        return os.path.join(self.snapshot_dir,
+                            '%s_%s' % (HISTORY_PREFIX, hostid))
+
+    def get_history(self, hostid):
+        '''Return the [time, checksum, delta, full] entries of hostid'''
+        if hostid not in self._histories:
+            try:
+                with open(self._get_history_path(hostid), 'r') as f:
+                    self._histories[hostid] = serialization.load(f)
+            except (IOError, ValueError):
+                self._histories[hostid] = []
+        return self._histories[hostid]
+
+    def _save_object(self, content):
+        '''Store content once, return its object id'''
+        data = json.dumps(content, sort_keys=True)
+        object_id = hashlib.sha224(data.encode('utf-8')).hexdigest()
+        object_path = os.path.join(self.objects_dir, object_id)
+        if not os.path.exists(object_path):
+            new_path = object_path + '.new'
+            with open(new_path, 'w') as f:
+                f.write(data)
+            os.rename(new_path, object_path)
+        else:
+            LOG.debug("Object %s already stored", object_id)
+        return object_id
+
+    def _load_object(self, object_id):
+        with open(os.path.join(self.objects_dir, object_id), 'r') as f:
+            return serialization.load(f)
+
+    def record(self, hostid, checksum, package_list, timestamp=None):
+        '''Record package_list as the snapshot of hostid at timestamp
+
+        Nothing is recorded if the checksum didn't change.
+        Return: True if a snapshot was recorded'''
+        history = self.get_history(hostid)
+        if history and history[-1][_CHECKSUM] == checksum:
+            return False
+        if timestamp is None:
+            timestamp = time.time()
+        if history and timestamp < history[-1][_TIME]:
+            # clock going backward: keep the history sorted
+            timestamp = history[-1][_TIME]
+        package_list = PackageSet.from_dict(package_list)
+        delta_id = None
+        full_id = None
+        if history:
+            previous = self._latest.get(hostid)
+            if previous is None:
+                previous = self._rebuild(hostid, len(history) - 1)
+            delta_id = self._save_object(compute_delta(previous,
+                                                       package_list))
+        nb_since_checkpoint = 0
+        for entry in reversed(history):
+            if entry[_FULL]:
+                break
+            nb_since_checkpoint += 1
+        if not history or nb_since_checkpoint + 1 >= CHECKPOINT_INTERVAL:
+            full_id = self._save_object(package_list.to_dict())
+        LOG.debug("Recording snapshot %s of %s", checksum, hostid)
+        history.append([timestamp, checksum, delta_id, full_id])
+        utils.save_json_file_update(self._get_history_path(hostid), history)
+        self._latest[hostid] = package_list
+        return True
+
+    def _rebuild(self, hostid, index):
+        '''Return the package list of the index snapshot of hostid'''
+        history = self.get_history(hostid)
+        start = index
+        while not history[start][_FULL]:
+            start -= 1
+        package_list = self._load_object(history[start][_FULL])
+        for entry in history[start + 1:index + 1]:
+            _apply_delta(package_list, self._load_object(entry[_DELTA]))
+        return package_list
+
+    def _find(self, hostid, timestamp):
+        '''Return the index of the snapshot of hostid at timestamp, -1 if
+        there was none yet'''
+        times = [entry[_TIME] for entry in self.get_history(hostid)]
+        return bisect_right(times, timestamp) - 1
+
+    def get_packages_at(self, hostid, timestamp):
+        '''Return the package list of hostid at timestamp
+
+        Only the closest checkpoint and the following deltas are read.
+        Return: {name: {"auto": bool, ...}}, None before the first
+                snapshot'''
+        index = self._find(hostid, timestamp)
+        if index < 0:
+            return None
+        return self._rebuild(hostid, index)
+
+    def get_changes(self, hostid, start, end):
+        '''Return the changes of hostid from start to end
+
+        Only the deltas of the snapshots in between are read.
+        Return: sorted (added, removed, changed) package names, changed
+                ones having another auto flag, version or architecture'''
+        history = self.get_history(hostid)
+        start_index = self._find(hostid, start)
+        end_index = self._find(hostid, end)
+        if end_index < 0:
+            return ([], [], [])
+        # name -> [entry at start, entry at end], None when not installed
+        changes = {}
+        if start_index < 0:
+            # everything was added since the first snapshot
+            start_index = 0
+            for (name, entry) in self._rebuild(hostid, 0).items():
+                changes[name] = [None, entry]
+        for entry in history[start_index + 1:end_index + 1]:
+            delta = self._load_object(entry[_DELTA])
+            for (name, new_entry) in delta['added'].items():
+                changes.setdefault(name, [None, None])[1] = new_entry
+            for (name, old_entry) in delta['removed'].items():
+                changes.setdefault(name, [old_entry, None])[1] = None
+            for (name, (old_entry, new_entry)) in delta['changed'].items():
+                changes.setdefault(name, [old_entry, None])[1] = new_entry
+        added = []
+        removed = []
+        changed = []
+        for (name, (old_entry, new_entry)) in changes.items():
+            if old_entry == new_entry:
+                continue
+            if old_entry is None:
+                added.append(name)
+            elif new_entry is None:
+                removed.append(name)
+            else:
+                changed.append(name)
+        return (sorted(added), sorted(removed), sorted(changed))
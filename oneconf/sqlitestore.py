@@ -0,0 +1,195 @@
+# Copyright (C) 2013 Canonical
+#
+# Authors:
+#  Didier Roche <didrocks@ubuntu.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+import sqlite3
+
+LOG = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hosts (
+    hostid TEXT PRIMARY KEY,
+    packages_checksum TEXT
+);
+CREATE TABLE IF NOT EXISTS packages (
+    hostid TEXT NOT NULL,
+    package TEXT NOT NULL,
+    auto INTEGER NOT NULL,
+    version TEXT,
+    arch TEXT,
+    PRIMARY KEY (hostid, package)
+);
+CREATE INDEX IF NOT EXISTS packages_by_name
+    ON packages (package, hostid, auto);
+"""
+
+
+class SqlitePackageStore(object):
+    """
+    Optional storage backend keeping (hostid, package, auto, version, arch)
+    rows in sqlite, version and arch being NULL when unknown
+
+    Every host is recorded with the packages_checksum its rows were imported
+    from, so that callers can detect a stale host and reimport it.
+    """
+
+    def __init__(self, db_path):
+        LOG.debug("Opening sqlite package store at %s", db_path)
+        self.db_path = db_path
+        # callers serialize the accesses (PackageSetHandler.lock), but they
+        # come from worker threads as well as from the main loop
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        # the store can always be rebuilt from the json files, no need to
+        # pay a full fsync on every host import
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._add_version_columns()
+        self._conn.commit()
+
+    def _add_version_columns(self):
+        '''Add the version columns to a store created without them'''
+        columns = [row[1] for row in self._conn.execute(
+            "PRAGMA table_info(packages)")]
+        if 'version' in columns:
+            return
+        LOG.debug("Adding version columns to the sqlite package store")
+        with self._conn:
+            self._conn.execute("ALTER TABLE packages ADD COLUMN version TEXT")
+            self._conn.execute("ALTER TABLE packages ADD COLUMN arch TEXT")
+            # every host has to be imported again with its versions
+            self._conn.execute("DELETE FROM hosts")
+
+    def close(self):
+        '''close the underlying database connection'''
+        self._conn.close()
+
+    def get_checksums(self):
+        '''Return a {hostid: packages_checksum} dict of every stored host'''
+        return dict(self._conn.execute(
+            "SELECT hostid, packages_checksum FROM hosts"))
+
+    def is_uptodate(self, hostid, checksum):
+        '''Return True if hostid is stored with this exact checksum'''
+        row = self._conn.execute(
+            "SELECT packages_checksum FROM hosts WHERE hostid = ?",
+            (hostid,)).fetchone()
+        return row is not None and row[0] == checksum
+
+    def set_packages(self, hostid, checksum, package_list):
+        '''Replace the whole package list of hostid in one transaction'''
+        LOG.debug("Storing %s packages for %s in sqlite store",
+                  len(package_list), hostid)
+        with self._conn:
+            self._conn.execute("DELETE FROM packages WHERE hostid = ?",
+                               (hostid,))
+            self._conn.executemany(
+                "INSERT INTO packages (hostid, package, auto, version, arch) "
+                "VALUES (?, ?, ?, ?, ?)",
+                ((hostid, name, int(bool(details['auto'])),
+                  details.get('version') or None, details.get('arch') or None)
+                 for (name, details) in package_list.items()))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO hosts (hostid, packages_checksum) "
+                "VALUES (?, ?)", (hostid, checksum))
+
+    def remove_host(self, hostid):
+        '''Drop every row belonging to hostid'''
+        LOG.debug("Removing %s from sqlite store", hostid)
+        with self._conn:
+            self._conn.execute("DELETE FROM packages WHERE hostid = ?",
+                               (hostid,))
+            self._conn.execute("DELETE FROM hosts WHERE hostid = ?",
+                               (hostid,))
+
+    def get_packages(self, hostid, only_manual=False):
+        '''get packages for hostid, in the same format than PackageSetHandler
+
+        Return: {name: {"auto": bool, ...}} or a list of names if
+                only_manual'''
+        if only_manual:
+            return [row[0] for row in self._conn.execute(
+                "SELECT package FROM packages WHERE hostid = ? AND auto = 0 "
+                "ORDER BY package", (hostid,))]
+        package_list = {}
+        for (name, auto, version, arch) in self._conn.execute(
+                "SELECT package, auto, version, arch FROM packages "
+                "WHERE hostid = ? ORDER BY package", (hostid,)):
+            details = {"auto": bool(auto)}
+            if version:
+                details["version"] = version
+            if arch:
+                details["arch"] = arch
+            package_list[name] = details
+        return package_list
+
+    def get_packages_page(self, hostid, only_manual=False, offset=0,
+                          limit=None):
+        '''get a slice of the packages for hostid, sorted by name
+
+        Return: ([(name, auto), ...], total number of packages in scope)'''
+        condition = "hostid = ?"
+        if only_manual:
+            condition += " AND auto = 0"
+        total = self._conn.execute(
+            "SELECT COUNT(*) FROM packages WHERE " + condition,
+            (hostid,)).fetchone()[0]
+        if limit is None:
+            limit = -1
+        page = [(name, bool(auto)) for name, auto in self._conn.execute(
+            "SELECT package, auto FROM packages WHERE " + condition +
+            " ORDER BY package LIMIT ? OFFSET ?", (hostid, limit, offset))]
+        return page, total
+
+    def diff(self, local_hostid, distant_hostid):
+        '''Return (packages only in distant_hostid, packages only in
+        local_hostid), both sorted'''
+        query = ("SELECT package FROM packages WHERE hostid = ? AND "
+                 "package NOT IN (SELECT package FROM packages "
+                 "WHERE hostid = ?) ORDER BY package")
+        packages_to_install = [row[0] for row in self._conn.execute(
+            query, (distant_hostid, local_hostid))]
+        packages_to_remove = [row[0] for row in self._conn.execute(
+            query, (local_hostid, distant_hostid))]
+        return packages_to_install, packages_to_remove
+
+    def diff_versions(self, local_hostid, distant_hostid):
+        '''Return the packages of both hosts with another version or arch,
+        as sorted [(name, local version, local arch, distant version,
+        distant arch)], skipping the ones without known versions'''
+        rows = self._conn.execute(
+            "SELECT local.package, local.version, local.arch, "
+            "distant.version, distant.arch FROM packages AS local "
+            "JOIN packages AS distant ON local.package = distant.package "
+            "WHERE local.hostid = ? AND distant.hostid = ? AND "
+            "local.version IS NOT NULL AND distant.version IS NOT NULL AND "
+            "(local.version != distant.version OR "
+            "IFNULL(local.arch, '') != IFNULL(distant.arch, '')) "
+            "ORDER BY local.package", (local_hostid, distant_hostid))
+        return [(name, local_version, local_arch or '', distant_version,
+                 distant_arch or '')
+                for (name, local_version, local_arch, distant_version,
+                     distant_arch) in rows]
+
+    def get_hosts_with_package(self, package, only_manual=False):
+        '''Return the sorted list of hostids having package installed'''
+        query = "SELECT hostid FROM packages WHERE package = ?"
+        if only_manual:
+            query += " AND auto = 0"
+        query += " ORDER BY hostid"
+        return [row[0] for row in self._conn.execute(query, (package,))]
@@ -17,12 +17,17 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 
-import json
 import logging
 import os
 
+from oneconf import metrics, serialization
+from oneconf.paths import TRANSACTION_JOURNAL_FILENAME
+
 LOG = logging.getLogger(__name__)
 
+# suffix of the files written by a transaction and not committed yet
+TRANSACTION_SUFFIX = '.transaction'
+
 def save_json_file_update(file_uri, content):
     '''Save local file in an atomic transaction'''
 
@@ -35,9 +40,151 @@ def save_json_file_update(file_uri, content):
 
     try:
         with open(new_file, 'w') as f:
-            json.dump(content, f)
+            with metrics.timer('json_save'):
+                serialization.dump(content, f)
         os.rename(new_file, file_uri)
         return True
     except IOError:
         LOG.error("Can't save update file for %s", file_uri)
         return False
+
+
+def _fsync_path(path):
+    '''fsync a file or directory by path'''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class JsonFileTransaction(object):
+    """
+    Save several json files in one durable, all or nothing, commit
+
+    Saved files are written next to their target and only replace them on
+    commit(), once their content is flushed to disk. The pending renames
+    are recorded first in a journal of journal_dir: if we stop or fail
+    during the renames, recover_json_file_transaction() completes them.
+    A commit costs one fsync per saved file and per target directory, plus
+    two for the journal.
+
+    Used as a context manager, it commits on exit unless there was an
+    error. Saved files are not visible before commit.
+    """
+
+    def __init__(self, journal_dir):
+        self.journal_path = os.path.join(journal_dir,
+                                         TRANSACTION_JOURNAL_FILENAME)
+        # a previous commit may have failed during its renames, complete
+        # it before its journal is replaced
+        try:
+            recover_json_file_transaction(journal_dir)
+        except (IOError, OSError) as e:
+            LOG.error("Can't complete the transaction of %s: %s",
+                      journal_dir, e)
+        # target path -> path of its pending content
+        self._pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def save(self, file_uri, content):
+        '''Write the new content of file_uri, to replace it on commit'''
+        if not content:
+            LOG.warning("Empty content saved as \"\" for %s" % file_uri)
+            content = {}
+        LOG.debug("Saving updated %s to disk on commit", file_uri)
+        pending_file = file_uri + TRANSACTION_SUFFIX
+        with open(pending_file, 'w') as f:
+            with metrics.timer('json_save'):
+                serialization.dump(content, f)
+        self._pending[file_uri] = pending_file
+
+    def commit(self):
+        '''Durably replace every saved file, return False on error'''
+        if not self._pending:
+            return True
+        committed = False
+        try:
+            with metrics.timer('transaction_commit'):
+                self._flush_pending_files()
+                with open(self.journal_path + TRANSACTION_SUFFIX, 'w') as f:
+                    serialization.dump(self._pending, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(self.journal_path + TRANSACTION_SUFFIX,
+                          self.journal_path)
+                # from there, the transaction is committed
+                committed = True
+                _fsync_path(os.path.dirname(self.journal_path))
+                _apply_journal(self._pending)
+                os.remove(self.journal_path)
+        except (IOError, OSError) as e:
+            if not committed:
+                LOG.error("Can't commit the transaction of %s: %s",
+                          sorted(self._pending), e)
+                self.abort()
+                return False
+            # the journal and the pending files are kept for
+            # recover_json_file_transaction() to complete the transaction
+            LOG.error("Can't apply the committed transaction of %s: %s",
+                      sorted(self._pending), e)
+            self._pending = {}
+            return False
+        self._pending = {}
+        return True
+
+    def abort(self):
+        '''Forget every saved file'''
+        for pending_file in self._pending.values():
+            try:
+                os.remove(pending_file)
+            except OSError:
+                pass
+        self._pending = {}
+
+    def _flush_pending_files(self):
+        '''make the content of every pending file durable'''
+        for pending_file in self._pending.values():
+            _fsync_path(pending_file)
+
+
+def _apply_journal(pending):
+    '''rename the pending files of a committed transaction'''
+    directories = set()
+    for file_uri in pending:
+        try:
+            os.rename(pending[file_uri], file_uri)
+        except OSError:
+            # already renamed before a crash
+            if os.path.exists(pending[file_uri]):
+                raise
+        directories.add(os.path.dirname(file_uri))
+    for directory in directories:
+        _fsync_path(directory)
+
+
+def recover_json_file_transaction(journal_dir):
+    '''Complete a transaction committed in journal_dir but not applied'''
+    journal_path = os.path.join(journal_dir, TRANSACTION_JOURNAL_FILENAME)
+    try:
+        with open(journal_path, 'r') as f:
+            pending = serialization.load(f)
+    except IOError:
+        return
+    except ValueError:
+        # the journal wasn't even renamed in place, nothing was committed
+        LOG.warning("Ignoring broken transaction journal %s", journal_path)
+        os.remove(journal_path)
+        return
+    LOG.warning("Completing an interrupted transaction of %s",
+                sorted(pending))
+    _apply_journal(pending)
+    os.remove(journal_path)
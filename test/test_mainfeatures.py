@@ -22,6 +22,7 @@ import os
 import shutil
 import sys
 import subprocess
+import time
 import unittest
 
 from gettext import gettext as _
@@ -276,6 +277,739 @@ class IntegrationTests(unittest.TestCase):
             packageset.hosts.current_host['packages_checksum'],
             '60f28c520e53c65cc37e9b68fe61911fb9f73ef910e08e988cb8ad52')
 
+    def get_sqlite_packageset(self):
+        '''Return a PackageSetHandler backed by a sqlite store'''
+        from oneconf.packagesethandler import PackageSetHandler
+        from oneconf.sqlitestore import SqlitePackageStore
+        store = SqlitePackageStore(
+            os.path.join(self.hostdir, paths.PACKAGE_DB_FILENAME))
+        return PackageSetHandler(store=store)
+
+    def test_sqlite_store_migration(self):
+        '''Existing package lists are imported in the sqlite store'''
+        packageset = self.get_sqlite_packageset()
+        self.assertEqual(
+            packageset.store.get_checksums(),
+            {'0000': '9c0d4e619c445551541af522b39ab483ba943b8b298fb96ccc3acd0b',
+             'AAAAAA': '086e176b91b97f4b7ee30f583a69f65c5c237133f225cfe3e0adb4d3',
+             'BBBBBB': 'b9b81f11af3da6ade72132968fc590836874e161d1be9b064d4e3c1a'})
+        self.assertEqual(packageset.store.get_packages('AAAAAA'),
+                         {'libqtdee2': {'auto': True},
+                          'ttf-lao': {'auto': False},
+                          'foo': {'auto': True}})
+
+    def test_sqlite_store_on_empty_cache(self):
+        '''A sqlite backed handler starts without any package list'''
+        from oneconf.hosts import Hosts
+        from oneconf.packagesethandler import PackageSetHandler
+        from oneconf.snapshotstore import SnapshotStore
+        from oneconf.sqlitestore import SqlitePackageStore
+        for with_snapshots in (False, True):
+            shutil.rmtree(self.hostdir)
+            hosts = Hosts()
+            store = SqlitePackageStore(
+                os.path.join(self.hostdir, paths.PACKAGE_DB_FILENAME))
+            snapshot_store = None
+            if with_snapshots:
+                snapshot_store = SnapshotStore(
+                    os.path.join(self.hostdir, paths.SNAPSHOTS_DIRNAME))
+            packageset = PackageSetHandler(hosts, store=store,
+                                           snapshot_store=snapshot_store)
+            checksum = hosts.current_host['packages_checksum']
+            self.assertEqual(store.get_checksums(), {'0000': checksum})
+            self.assertEqual(packageset.get_packages('0000', None, True),
+                             ['foo'])
+            if with_snapshots:
+                self.assertEqual([entry[1] for entry in
+                                  snapshot_store.get_history('0000')],
+                                 [checksum])
+            store.close()
+
+    def test_sqlite_store_same_results_than_json(self):
+        '''The sqlite store gives the same answers than the json backend'''
+        from oneconf.packagesethandler import PackageSetHandler
+        json_packageset = PackageSetHandler()
+        sqlite_packageset = self.get_sqlite_packageset()
+        for hostid in ('0000', 'AAAAAA', 'BBBBBB'):
+            self.assertEqual(json_packageset.get_packages(hostid),
+                             sqlite_packageset.get_packages(hostid))
+            # in the same order
+            self.assertEqual(list(json_packageset.get_packages(hostid)),
+                             list(sqlite_packageset.get_packages(hostid)))
+            self.assertEqual(json_packageset.get_packages(hostid, None, True),
+                             sqlite_packageset.get_packages(hostid, None,
+                                                            True))
+            self.assertEqual(json_packageset.diff(hostid),
+                             sqlite_packageset.diff(hostid))
+
+    def test_hosts_with_package(self):
+        '''Get hosts having a package, with both backends'''
+        from oneconf.packagesethandler import PackageSetHandler
+        for packageset in (PackageSetHandler(), self.get_sqlite_packageset()):
+            self.assertEqual(packageset.get_hosts_with_package('foo'),
+                             ['0000', 'AAAAAA'])
+            self.assertEqual(packageset.get_hosts_with_package('foo', True),
+                             ['0000'])
+            self.assertEqual(packageset.get_hosts_with_package('ttf-lao'),
+                             ['AAAAAA'])
+            self.assertEqual(packageset.get_hosts_with_package('unknown'), [])
+
+    def test_fleet_package_queries(self):
+        '''Packages common to all hosts, unique to one and drifting hosts'''
+        from oneconf.packagesethandler import PackageSetHandler
+        packageset = PackageSetHandler()
+        # BBBBBB has no package list
+        self.assertEqual(packageset.get_common_packages(), [])
+        self.assertEqual(packageset.get_unique_packages(), ['bar', 'baz'])
+        self.assertEqual(packageset.get_unique_packages('AAAAAA'),
+                         ['libqtdee2', 'ttf-lao'])
+        self.assertEqual(packageset.get_unique_packages('AAAAAA', None, True),
+                         ['ttf-lao'])
+        self.assertEqual(packageset.get_hosts_drift(),
+                         [('AAAAAA', 2, 2), ('BBBBBB', 3, 0)])
+        self.assertEqual(packageset.get_hosts_drift(None, 'julie-laptop',
+                                                    True),
+                         [('0000', 1, 2), ('BBBBBB', 1, 0)])
+        packageset.get_packages('BBBBBB')
+        packageset.refresh_packagelist('BBBBBB', 'new',
+                                       {'foo': {'auto': False}})
+        self.assertEqual(packageset.get_common_packages(), ['foo'])
+        self.assertEqual(packageset.get_common_packages(True), [])
+        self.assertEqual(packageset.get_unique_packages('BBBBBB'), [])
+
+    def test_drift_tracking(self):
+        '''Drift against a baseline host follows new package lists'''
+        from oneconf.packagesethandler import PackageSetHandler
+        packageset = PackageSetHandler()
+        self.assertEqual(packageset.get_drift_summary(), [])
+        self.assertEqual(packageset.set_drift_baseline('0000'),
+                         [('AAAAAA', 2, 2), ('BBBBBB', 3, 0)])
+        self.assertEqual(packageset.get_drift('AAAAAA'),
+                         (['bar', 'baz'], ['libqtdee2', 'ttf-lao']))
+        signals = []
+        packageset.emit_drift_changed = \
+            lambda *args: signals.append(args)
+        packageset.hosts.other_hosts['BBBBBB']['packages_checksum'] = 'new'
+        drift_path = os.path.join(self.hostdir, paths.DRIFT_FILENAME)
+        with open(drift_path) as f:
+            saved_drift = json.load(f)
+        packageset.refresh_packagelist('BBBBBB', 'new',
+                                       {'foo': {'auto': False},
+                                        'bar': {'auto': True}})
+        self.assertEqual(signals, [('BBBBBB', 1, 0)])
+        # saved by the sync, with the package lists
+        with open(drift_path) as f:
+            self.assertEqual(json.load(f), saved_drift)
+        packageset.save_indexes()
+        with open(drift_path) as f:
+            self.assertEqual(json.load(f)['hosts']['BBBBBB']['checksum'],
+                             'new')
+        self.assertEqual(packageset.get_drift_summary(),
+                         [('AAAAAA', 2, 2), ('BBBBBB', 1, 0)])
+        # the same list doesn't change the drift
+        packageset.refresh_packagelist('BBBBBB', 'new',
+                                       {'foo': {'auto': False},
+                                        'bar': {'auto': False}})
+        self.assertEqual(len(signals), 1)
+        # a new baseline list moves every drift
+        packageset.update()
+        self.assertEqual(signals[1:], [('AAAAAA', 1, 2), ('BBBBBB', 1, 1)])
+        self.assertEqual(packageset.get_drift('BBBBBB'), (['pool'], ['bar']))
+        # persisted, and the same than computing it again
+        packageset = PackageSetHandler()
+        packageset.hosts.other_hosts['BBBBBB']['packages_checksum'] = 'new'
+        self.assertEqual(packageset.get_drift_summary(),
+                         [('AAAAAA', 1, 2), ('BBBBBB', 1, 1)])
+        self.assertEqual(packageset.package_list, {})
+        packageset.get_packages('BBBBBB')
+        packageset.refresh_packagelist('BBBBBB', 'new',
+                                       {'foo': {'auto': False},
+                                        'bar': {'auto': True}})
+        self.assertEqual(packageset.set_drift_baseline(),
+                         [('AAAAAA', 1, 2), ('BBBBBB', 1, 1)])
+
+    def test_get_packages_page(self):
+        '''Package lists can be fetched page by page, sorted by name'''
+        from oneconf.packagesethandler import PackageSetHandler
+        for packageset in (PackageSetHandler(), self.get_sqlite_packageset()):
+            self.assertEqual(packageset.get_packages_page('AAAAAA', None,
+                                                          False, 0, 2),
+                             ([('foo', True), ('libqtdee2', True)], 3))
+            self.assertEqual(packageset.get_packages_page('AAAAAA', None,
+                                                          False, 2, 2),
+                             ([('ttf-lao', False)], 3))
+            self.assertEqual(packageset.get_packages_page('AAAAAA', None,
+                                                          True),
+                             ([('ttf-lao', False)], 1))
+            self.assertEqual(packageset.get_packages_page('AAAAAA', None,
+                                                          False, 5, 2),
+                             ([], 3))
+
+    def test_packed_package_list(self):
+        '''Package lists and diffs survive the packed wire format'''
+        from oneconf.packagesethandler import PackageSetHandler
+        from oneconf import packing
+        packageset = PackageSetHandler()
+        package_list = packageset.get_packages('AAAAAA')
+        diff = packageset.diff('AAAAAA')
+        for compress in (False, True):
+            self.assertEqual(packing.unpack_packages(
+                packing.pack_packages(package_list, compress)), package_list)
+            self.assertEqual(packing.unpack_diff(
+                packing.pack_diff(diff[0], diff[1], compress)), diff)
+            self.assertEqual(packing.unpack_packages(
+                packing.pack_packages({}, compress)), {})
+            self.assertEqual(packing.unpack_diff(
+                packing.pack_diff([], [], compress)), ([], []))
+
+    def test_package_versions(self):
+        '''Versions and architectures are kept and compared'''
+        from oneconf.packagesethandler import PackageSetHandler
+        from oneconf.packageset import PackageSet
+        from oneconf import packing
+        local_packages = {'foo': {'auto': False, 'version': '1.0',
+                                  'arch': 'amd64'},
+                          'bar': {'auto': True, 'version': '2.0',
+                                  'arch': 'all'},
+                          'baz': {'auto': False}}
+        distant_packages = {'foo': {'auto': False, 'version': '1.1',
+                                    'arch': 'amd64'},
+                            'bar': {'auto': True, 'version': '2.0',
+                                    'arch': 'i386'},
+                            'baz': {'auto': False, 'version': '3.0'},
+                            'pool': {'auto': True, 'version': '4.0',
+                                     'arch': 'amd64'}}
+        package_set = PackageSet.from_dict(distant_packages)
+        self.assertEqual(package_set, distant_packages)
+        self.assertEqual(package_set.to_dict(), distant_packages)
+        self.assertEqual(package_set.get_version('bar'), ('2.0', 'i386'))
+        self.assertEqual(package_set.get_version('baz'), ('3.0', ''))
+        self.assertNotEqual(package_set, PackageSet.from_dict(
+            dict(distant_packages, pool={'auto': True, 'version': '4.1',
+                                         'arch': 'amd64'})))
+        for compress in (False, True):
+            self.assertEqual(packing.unpack_packages(
+                packing.pack_packages(package_set, compress)),
+                distant_packages)
+        for (hostid, package_list) in (('0000', local_packages),
+                                       ('AAAAAA', distant_packages)):
+            with open(os.path.join(self.hostdir, '%s_%s' % (
+                    paths.PACKAGE_LIST_PREFIX, hostid)), 'w') as f:
+                json.dump(package_list, f)
+        for packageset in (PackageSetHandler(), self.get_sqlite_packageset()):
+            packageset.hosts.current_host['packages_checksum'] = 'local'
+            packageset.hosts.other_hosts['AAAAAA']['packages_checksum'] = \
+                'distant'
+            self.assertEqual(packageset.get_packages('AAAAAA'),
+                             distant_packages)
+            self.assertEqual(packageset.diff_versions('AAAAAA'),
+                             (['pool'], [],
+                              [('bar', '2.0', 'all', '2.0', 'i386'),
+                               ('foo', '1.0', 'amd64', '1.1', 'amd64')]))
+
+    def test_package_lists_by_checksum(self):
+        '''Hosts with the same packages checksum share their package list'''
+        from oneconf import packagelistcache
+        from oneconf.packagesethandler import PackageSetHandler
+        package_list = {'foo': {'auto': False}, 'bar': {'auto': True}}
+        shared = 'a' * 56
+        for hostid in ('AAAAAA', 'BBBBBB'):
+            packagelistcache.save_package_list(self.hostdir, hostid, shared,
+                                               package_list)
+        lists_dir = os.path.join(self.hostdir, paths.PACKAGE_LISTS_DIRNAME)
+        self.assertEqual(os.listdir(lists_dir), [shared])
+        self.assertEqual(packagelistcache.load_package_list(self.hostdir,
+                                                            'BBBBBB'),
+                         package_list)
+        packageset = PackageSetHandler()
+        for hostid in ('AAAAAA', 'BBBBBB'):
+            packageset.hosts.other_hosts[hostid]['packages_checksum'] = \
+                shared
+        self.assertEqual(packageset.get_packages('AAAAAA'), package_list)
+        self.assertTrue(packageset.get_packages('AAAAAA') is
+                        packageset.get_packages('BBBBBB'))
+        # the current host is stored by checksum as well
+        (checksum, delta) = packageset.update()
+        self.assertEqual(packagelistcache.load_host_file(self.hostdir, '0000'),
+                         (checksum, None))
+        self.assertEqual(sorted(os.listdir(lists_dir)),
+                         sorted([checksum, shared]))
+        packageset.remove_unused_package_lists()
+        self.assertEqual(len(os.listdir(lists_dir)), 2)
+        # lists saved by older versions are still loaded
+        legacy_list = {'baz': {'auto': True}}
+        with open(packagelistcache.get_host_path(self.hostdir, 'BBBBBB'),
+                  'w') as f:
+            json.dump(legacy_list, f)
+        packageset = PackageSetHandler()
+        packageset.hosts.other_hosts['BBBBBB']['packages_checksum'] = 'legacy'
+        self.assertEqual(packageset.get_packages('BBBBBB'), legacy_list)
+        os.remove(packagelistcache.get_host_path(self.hostdir, 'AAAAAA'))
+        packageset.hosts.other_hosts['AAAAAA']['packages_checksum'] = None
+        packageset.remove_unused_package_lists()
+        self.assertEqual(os.listdir(lists_dir), [checksum])
+
+    def test_package_lists_invalid_checksum(self):
+        '''Checksums not computed by oneconf are never used as file names'''
+        from oneconf import packagelistcache
+        victim = os.path.join(self.hostdir, 'victim')
+        with open(victim, 'w') as f:
+            f.write('not json')
+        package_list = {'foo': {'auto': False}}
+        for checksum in ('../victim', victim, '../' + 'a' * 53, 'A' * 56,
+                         'a' * 56 + '\n', None, 42):
+            self.assertFalse(packagelistcache.is_valid_checksum(checksum))
+            self.assertFalse(packagelistcache.has_package_list(self.hostdir,
+                                                               checksum))
+            self.assertRaises(ValueError, packagelistcache.load_content,
+                              self.hostdir, checksum)
+            # the host file holds the list itself then
+            packagelistcache.save_package_list(self.hostdir, 'AAAAAA',
+                                               checksum, package_list)
+            self.assertEqual(packagelistcache.load_host_file(self.hostdir,
+                                                             'AAAAAA'),
+                             (None, package_list))
+        with open(victim) as f:
+            self.assertEqual(f.read(), 'not json')
+        self.assertFalse(os.path.exists(os.path.join(
+            self.hostdir, paths.PACKAGE_LISTS_DIRNAME)))
+
+    @patch('oneconf.snapshotstore.CHECKPOINT_INTERVAL', 3)
+    def test_package_list_snapshots(self):
+        '''Package lists history is kept and queried at any time'''
+        from oneconf.packagesethandler import PackageSetHandler
+        from oneconf.snapshotstore import SnapshotStore
+        snapshot_dir = os.path.join(self.hostdir, paths.SNAPSHOTS_DIRNAME)
+        store = SnapshotStore(snapshot_dir)
+        package_lists = [
+            {'foo': {'auto': False}},
+            {'foo': {'auto': False}, 'bar': {'auto': True}},
+            {'foo': {'auto': True}, 'bar': {'auto': True}},
+            {'bar': {'auto': True}, 'baz': {'auto': False}},
+            {'foo': {'auto': False}, 'bar': {'auto': True}}]
+        for (i, package_list) in enumerate(package_lists):
+            self.assertTrue(store.record('AAAAAA', str(i), package_list,
+                                         10 * (i + 1)))
+        self.assertFalse(store.record('AAAAAA', '4', package_lists[4], 60))
+        self.assertEqual([entry[3] is not None
+                          for entry in store.get_history('AAAAAA')],
+                         [True, False, False, True, False])
+        self.assertEqual(len(os.listdir(store.objects_dir)), 6)
+        # the same full list and delta are only stored once
+        store.record('BBBBBB', 'a', package_lists[0], 10)
+        store.record('BBBBBB', 'b', package_lists[1], 20)
+        self.assertEqual(len(os.listdir(store.objects_dir)), 6)
+        store = SnapshotStore(snapshot_dir)
+        self.assertEqual(store.get_packages_at('AAAAAA', 5), None)
+        for (i, package_list) in enumerate(package_lists):
+            self.assertEqual(store.get_packages_at('AAAAAA', 10 * (i + 1)),
+                             package_list)
+        self.assertEqual(store.get_packages_at('AAAAAA', 45),
+                         package_lists[3])
+        self.assertEqual(store.get_changes('AAAAAA', 10, 45),
+                         (['bar', 'baz'], ['foo'], []))
+        self.assertEqual(store.get_changes('AAAAAA', 25, 35),
+                         ([], [], ['foo']))
+        self.assertEqual(store.get_changes('AAAAAA', 0, 20),
+                         (['bar', 'foo'], [], []))
+        self.assertEqual(store.get_changes('AAAAAA', 20, 50),
+                         ([], [], []))
+        # the handler records every new list
+        packageset = PackageSetHandler(snapshot_store=store)
+        (checksum, delta) = packageset.update()
+        self.assertEqual(packageset.get_packages_at(time.time()),
+                         {'foo': {'auto': False}, 'pool': {'auto': True}})
+        self.assertEqual(packageset.get_changes_between(0, time.time()),
+                         (['foo', 'pool'], [], []))
+        self.assertEqual(packageset.get_packages_at(0), None)
+
+    def test_concurrent_packageset_requests(self):
+        '''Requests from worker threads are serialized by the handler'''
+        import threading
+        from oneconf.packagesethandler import PackageSetHandler
+        packageset = PackageSetHandler()
+        expected_diff = packageset.diff('AAAAAA')
+        results = []
+        def request():
+            results.append(packageset.diff('AAAAAA'))
+        threads = [threading.Thread(target=request) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [expected_diff] * 10)
+
+    def test_coalesced_updates(self):
+        '''Concurrent update requests share one or two recomputations'''
+        import threading
+        import time
+        from oneconf.packagesethandler import PackageSetHandler
+        packageset = PackageSetHandler()
+        compute_local_packagelist = packageset.distro.compute_local_packagelist
+        computations = []
+        def slow_compute():
+            computations.append(True)
+            time.sleep(0.2)
+            return compute_local_packagelist()
+        threads = [threading.Thread(target=packageset.coalesced_update)
+                   for i in range(100)]
+        with patch.object(packageset.distro, 'compute_local_packagelist',
+                          slow_compute):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertIn(len(computations), (1, 2))
+        self.assertEqual(packageset.hosts.current_host['packages_checksum'],
+                         '60f28c520e53c65cc37e9b68fe61911fb9f73ef910e08e988cb8ad52')
+
+    def test_coalesced_update_error(self):
+        '''Requests sharing a failed update get its error, not a result'''
+        import threading
+        import time
+        from oneconf.packagesethandler import PackageSetHandler
+        packageset = PackageSetHandler()
+        compute_local_packagelist = packageset.distro.compute_local_packagelist
+        computing = threading.Event()
+        release = threading.Event()
+        computations = []
+        def compute():
+            computations.append(True)
+            if len(computations) == 1:
+                computing.set()
+                release.wait(5)
+            elif len(computations) == 2:
+                raise IOError("apt cache is broken")
+            return compute_local_packagelist()
+        outcomes = []
+        def request():
+            try:
+                outcomes.append(packageset.coalesced_update()[0])
+            except IOError:
+                outcomes.append('error')
+        with patch.object(packageset.distro, 'compute_local_packagelist',
+                          compute):
+            first_request = threading.Thread(target=request)
+            first_request.start()
+            computing.wait(5)
+            threads = [threading.Thread(target=request) for i in range(10)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.2)
+            release.set()
+            first_request.join()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(computations), 2)
+            self.assertEqual(sorted(outcomes, key=len),
+                             ['error'] * 10 + [packageset.hosts.current_host[
+                                 'packages_checksum']])
+            # the next request gets its own update
+            self.assertEqual(packageset.coalesced_update()[0],
+                             packageset.hosts.current_host['packages_checksum'])
+            self.assertEqual(len(computations), 3)
+
+    def test_requests_answered_during_update(self):
+        '''The package list is computed without holding the handler lock'''
+        import threading
+        from oneconf.packagesethandler import PackageSetHandler
+        packageset = PackageSetHandler()
+        compute_local_packagelist = packageset.distro.compute_local_packagelist
+        computing = threading.Event()
+        answered = threading.Event()
+        answered_in_time = []
+        def slow_compute():
+            computing.set()
+            answered_in_time.append(answered.wait(5))
+            return compute_local_packagelist()
+        with patch.object(packageset.distro, 'compute_local_packagelist',
+                          slow_compute):
+            thread = threading.Thread(target=packageset.update)
+            thread.start()
+            computing.wait(5)
+            packageset.diff('AAAAAA')
+            answered.set()
+            thread.join()
+        self.assertEqual(answered_in_time, [True])
+
+    def test_packagelist_delta(self):
+        '''Updates and new package lists come with their delta'''
+        from oneconf.packagesethandler import PackageSetHandler
+        packageset = PackageSetHandler()
+        (checksum, delta) = packageset.update()
+        self.assertEqual(checksum,
+                         '60f28c520e53c65cc37e9b68fe61911fb9f73ef910e08e988cb8ad52')
+        self.assertEqual(delta, (['pool'], ['bar', 'baz'], []))
+        self.assertEqual(packageset.update(), (checksum, ([], [], [])))
+        self.assertEqual(packageset.get_packagelist_delta(
+            'AAAAAA', {'foo': {'auto': False}, 'pool': {'auto': True}}),
+            (['pool'], ['libqtdee2', 'ttf-lao'], ['foo']))
+
+    def test_metrics(self):
+        '''Timers and counters are recorded around the hot paths'''
+        from oneconf import metrics
+        from oneconf.packagesethandler import PackageSetHandler
+        metrics.reset()
+        packageset = PackageSetHandler()
+        packageset.update()
+        packageset.get_packages('AAAAAA')
+        packageset.get_packages('AAAAAA')
+        stats = metrics.get_metrics()
+        self.assertEqual(stats['compute_local_packagelist.count'], 1)
+        self.assertEqual(stats['packages_checksum.count'], 1)
+        self.assertTrue(stats['json_save.count'] >= 1)
+        self.assertTrue(stats['json_load.max'] <= stats['json_load.total'])
+        self.assertEqual(stats['packagelist_cache.miss'], 1)
+        self.assertEqual(stats['packagelist_cache.hit'], 1)
+        metrics.profile_next_sync('/tmp/sync.prof')
+        self.assertEqual(metrics.pop_sync_profile_request(), '/tmp/sync.prof')
+        self.assertEqual(metrics.pop_sync_profile_request(), None)
+
+    def test_json_file_transaction(self):
+        '''Files saved in a transaction are all replaced on commit only'''
+        from oneconf import utils
+        other_hosts = os.path.join(self.hostdir, paths.OTHER_HOST_FILENAME)
+        last_sync = os.path.join(self.hostdir, paths.LAST_SYNC_DATE_FILENAME)
+        with open(other_hosts) as f:
+            old_other_hosts = json.load(f)
+        with utils.JsonFileTransaction(self.hostdir) as transaction:
+            transaction.save(other_hosts, {'AAAAA': {'hostname': 'aaaaa'}})
+            transaction.save(last_sync, {'last_sync': '42'})
+            with open(other_hosts) as f:
+                self.assertEqual(json.load(f), old_other_hosts)
+        with open(other_hosts) as f:
+            self.assertEqual(json.load(f), {'AAAAA': {'hostname': 'aaaaa'}})
+        with open(last_sync) as f:
+            self.assertEqual(json.load(f), {'last_sync': '42'})
+        self.assertEqual([filename for filename in os.listdir(self.hostdir)
+                          if filename.endswith(utils.TRANSACTION_SUFFIX) or
+                          filename == paths.TRANSACTION_JOURNAL_FILENAME],
+                         [])
+        # nothing is replaced on error
+        try:
+            with utils.JsonFileTransaction(self.hostdir) as transaction:
+                transaction.save(last_sync, {'last_sync': '43'})
+                raise ValueError()
+        except ValueError:
+            pass
+        with open(last_sync) as f:
+            self.assertEqual(json.load(f), {'last_sync': '42'})
+        # a committed transaction interrupted during the renames is completed
+        with open(last_sync + utils.TRANSACTION_SUFFIX, 'w') as f:
+            json.dump({'last_sync': '44'}, f)
+        with open(os.path.join(self.hostdir,
+                               paths.TRANSACTION_JOURNAL_FILENAME), 'w') as f:
+            json.dump({last_sync: last_sync + utils.TRANSACTION_SUFFIX,
+                       other_hosts: other_hosts + utils.TRANSACTION_SUFFIX},
+                      f)
+        Hosts()
+        with open(last_sync) as f:
+            self.assertEqual(json.load(f), {'last_sync': '44'})
+        self.assertFalse(os.path.exists(os.path.join(
+            self.hostdir, paths.TRANSACTION_JOURNAL_FILENAME)))
+        # a failure once committed keeps the journal for the recovery, and
+        # only the saved files are flushed
+        transaction = utils.JsonFileTransaction(self.hostdir)
+        transaction.save(last_sync, {'last_sync': '45'})
+        with patch('oneconf.utils._apply_journal', side_effect=OSError()):
+            with patch.object(utils.os, 'sync', create=True) as sync:
+                self.assertFalse(transaction.commit())
+        self.assertFalse(sync.called)
+        self.assertTrue(os.path.exists(os.path.join(
+            self.hostdir, paths.TRANSACTION_JOURNAL_FILENAME)))
+        self.assertTrue(os.path.exists(last_sync + utils.TRANSACTION_SUFFIX))
+        with utils.JsonFileTransaction(self.hostdir) as transaction:
+            transaction.save(other_hosts, {})
+        with open(last_sync) as f:
+            self.assertEqual(json.load(f), {'last_sync': '45'})
+        self.assertFalse(os.path.exists(os.path.join(
+            self.hostdir, paths.TRANSACTION_JOURNAL_FILENAME)))
+
+    def test_json_serialization_backends(self):
+        '''Every json backend gives ascii text with the json content'''
+        from oneconf import serialization
+        class HostId(type(u'')):
+            pass
+        content = {'foo': {'auto': False}, u'caf\xe9': {'auto': True},
+                   'hostname': 'a/b', 'empty': {}}
+        for name in serialization.BACKENDS:
+            try:
+                (dumps, loads) = serialization.get_backend(name)
+            except ImportError:
+                continue
+            text = dumps(content)
+            text.encode('ascii')
+            self.assertEqual(json.loads(text), content)
+            self.assertEqual(loads(json.dumps(content)), content)
+            self.assertRaises(ValueError, loads, '{"foo": ')
+            # hostids received over D-Bus are dbus.String, a str subclass
+            text = dumps({HostId('AAAAAA'): {HostId('hostname'): 'a'}})
+            self.assertEqual(json.loads(text), {'AAAAAA': {'hostname': 'a'}})
+
+    def test_package_set(self):
+        '''A PackageSet reads like the package list dict it replaces'''
+        from oneconf.packageset import PackageSet
+        package_list = {'foo': {'auto': False}, 'bar': {'auto': True},
+                        'baz': {'auto': False}}
+        package_set = PackageSet.from_dict(package_list)
+        self.assertEqual(package_set, package_list)
+        self.assertEqual(package_set.to_dict(), package_list)
+        self.assertEqual(list(package_set), ['bar', 'baz', 'foo'])
+        self.assertEqual(len(package_set), 3)
+        self.assertTrue('bar' in package_set)
+        self.assertFalse('pool' in package_set)
+        self.assertEqual(package_set['bar'], {'auto': True})
+        self.assertRaises(KeyError, package_set.__getitem__, 'pool')
+        self.assertEqual(package_set.get('pool'), None)
+        self.assertEqual(package_set.manual_names(), ['baz', 'foo'])
+        self.assertEqual(package_set.slice_items(1, 5),
+                         [('baz', False), ('foo', False)])
+        other = PackageSet.from_dict({'foo': {'auto': True},
+                                      'pool': {'auto': False}})
+        self.assertNotEqual(package_set, other)
+        self.assertEqual(package_set.difference(other), ['bar', 'baz'])
+        self.assertEqual(package_set.intersection(other), ['foo'])
+        self.assertEqual(package_set.union(other),
+                         ['bar', 'baz', 'foo', 'pool'])
+        self.assertEqual(PackageSet(), {})
+        # the package set handler caches them
+        from oneconf.packagesethandler import PackageSetHandler
+        packageset = PackageSetHandler()
+        self.assertTrue(isinstance(packageset.get_packages('AAAAAA'),
+                                   PackageSet))
+
+    def test_package_names_shared(self):
+        '''Package sets of all hosts share the names and their ids'''
+        from oneconf.packageset import PackageSet, name_table
+        first = PackageSet.from_dict({'foo': {'auto': False},
+                                      'bar': {'auto': True}})
+        second = PackageSet.from_dict(json.loads(
+            '{"foo": {"auto": true}, "pool": {"auto": false}}'))
+        self.assertTrue(first.names[1] is second.names[0])
+        self.assertEqual(first.ids[1], second.ids[0])
+        self.assertEqual(name_table.get_name(second.ids[1]), 'pool')
+        self.assertEqual(name_table.get_id('not-a-package'), None)
+        self.assertFalse('not-a-package' in first)
+        # a name added later in the table isn't in the previous sets
+        third = PackageSet(('zzz-new',))
+        self.assertFalse('zzz-new' in first)
+        self.assertEqual(third.difference(first), ['zzz-new'])
+        self.assertEqual(first.intersection({'bar': {'auto': False}}),
+                         ['bar'])
+
+    def test_inventory_worker(self):
+        '''The local package list can be computed in a worker process'''
+        from oneconf.packagesethandler import PackageSetHandler
+        packageset = PackageSetHandler(use_inventory_worker=True)
+        (checksum, delta) = packageset.update()
+        self.assertEqual(packageset.get_packages(),
+                         {'foo': {'auto': False}, 'pool': {'auto': True}})
+        self.assertEqual(checksum, PackageSetHandler().update()[0])
+
+    def test_package_index_incremental_update(self):
+        '''The package index follows update() and refreshed package lists'''
+        from oneconf import utils
+        from oneconf.packagesethandler import PackageSetHandler
+        packageset = PackageSetHandler()
+        self.assertEqual(packageset.get_hosts_with_package('bar'), ['0000'])
+        packageset.update()
+        self.assertEqual(packageset.get_hosts_with_package('bar'), [])
+        self.assertEqual(packageset.get_hosts_with_package('pool'), ['0000'])
+        index_path = os.path.join(self.hostdir, paths.PACKAGE_INDEX_FILENAME)
+        with open(index_path) as f:
+            saved_index = json.load(f)
+        packageset.refresh_packagelist('AAAAAA', 'new',
+                                       {'pool': {'auto': False}})
+        # refreshed lists are saved once, by the sync
+        with open(index_path) as f:
+            self.assertEqual(json.load(f), saved_index)
+        saved_paths = []
+        def save(path, content):
+            saved_paths.append(path)
+            utils.save_json_file_update(path, content)
+        packageset.save_indexes(save)
+        packageset.save_indexes(save)
+        self.assertEqual(saved_paths, [index_path])
+        packageset.hosts.other_hosts['AAAAAA']['packages_checksum'] = 'new'
+        self.assertEqual(packageset.get_hosts_with_package('pool', True),
+                         ['AAAAAA'])
+        self.assertEqual(packageset.get_hosts_with_package('ttf-lao'), [])
+        # the index is persisted and reused without reloading package lists
+        packageset = PackageSetHandler()
+        packageset.hosts.other_hosts['AAAAAA']['packages_checksum'] = 'new'
+        self.assertEqual(packageset.get_hosts_with_package('pool'),
+                         ['0000', 'AAAAAA'])
+        self.assertEqual(packageset.package_list, {})
+
+    def test_sqlite_store_refresh_outdated_host(self):
+        '''A new package list for another host is reimported in the store'''
+        packageset = self.get_sqlite_packageset()
+        with open(os.path.join(self.hostdir, '%s_AAAAAA' % paths.PACKAGE_LIST_PREFIX), 'w') as f:
+            json.dump({'kiki': {'auto': False}}, f)
+        packageset.hosts.other_hosts['AAAAAA']['packages_checksum'] = 'new'
+        self.assertEqual(packageset.get_packages('AAAAAA'),
+                         {'kiki': {'auto': False}})
+        packageset.hosts.other_hosts.pop('BBBBBB')
+        self.assertEqual(packageset.get_hosts_with_package('kiki'),
+                         ['AAAAAA'])
+        self.assertNotIn('BBBBBB', packageset.store.get_checksums())
+
+    def test_shared_hosts_instance(self):
+        '''The shared Hosts object is reused until its files change'''
+        from oneconf.hosts import get_hosts
+        host = get_hosts()
+        self.assertIs(get_hosts(), host)
+        host.set_share_inventory(False)
+        self.assertIs(get_hosts(), host)
+        with open(os.path.join(self.hostdir, paths.OTHER_HOST_FILENAME), 'w') as f:
+            json.dump({}, f)
+        new_host = get_hosts()
+        self.assertIsNot(new_host, host)
+        self.assertEqual(new_host.other_hosts, {})
+        os.environ["ONECONF_HOST"] = "%s:%s" % (self.hostid, 'barmachine')
+        self.assertEqual(get_hosts().current_host['hostname'], 'barmachine')
+
+    def test_direct_session(self):
+        '''A direct session keeps its package set handler between calls'''
+        with DirectConnect(session=True) as oneconf:
+            self.assertEqual(oneconf.diff('AAAAAA', None),
+                             ([u'libqtdee2', u'ttf-lao'], [u'bar', u'baz']))
+            packageset = oneconf._get_packageSetHandler()
+            self.assertIn('AAAAAA', packageset.package_list)
+            self.assertEqual(sorted(oneconf.get_packages('AAAAAA', None, True)),
+                             [u'ttf-lao'])
+            self.assertIs(oneconf._get_packageSetHandler(), packageset)
+            # errors are raised to the library user
+            self.assertRaises(HostError, oneconf.get_packages, 'A', None, False)
+            # a change on disk drops the cached handler
+            with open(os.path.join(self.hostdir, paths.OTHER_HOST_FILENAME), 'w') as f:
+                json.dump({}, f)
+            self.assertIsNot(oneconf._get_packageSetHandler(), packageset)
+        self.assertIsNone(oneconf._packageSetHandler)
+
+    def test_distro_id_from_os_release(self):
+        '''The distro id is read from os-release, without lsb_release'''
+        from oneconf.distributor import _get_os_release_id
+        os_release = os.path.join(paths.ONECONF_CACHE_DIR, 'os-release')
+        with open(os_release, 'w') as f:
+            f.write('NAME="Ubuntu"\nID=ubuntu\nID_LIKE=debian\n')
+        with patch('subprocess.Popen') as popen:
+            self.assertEqual(_get_os_release_id(os_release), 'Ubuntu')
+            with open(os_release, 'w') as f:
+                f.write('ID="debian"\n')
+            self.assertEqual(_get_os_release_id(os_release), 'Debian')
+            self.assertFalse(popen.called)
+
+    @patch('oneconf.hosts.Hosts._get_current_wallpaper_data')
+    def test_wallpaper_not_read_at_startup(self, wallpaper_data):
+        '''Loading hosts doesn't look at the wallpaper, refresh_logo does'''
+        wallpaper_data.return_value = ('foo', '/foo.png')
+        host = Hosts()
+        self.assertFalse(wallpaper_data.called)
+        # no logo can be created without PIL
+        self.assertFalse(host.refresh_logo())
+        self.assertTrue(wallpaper_data.called)
+
     @patch('oneconf.hosts.FAKE_WALLPAPER', '/wallpaper-doesnt-exist.png')
     @patch('oneconf.hosts.FAKE_WALLPAPER_MTIME', None)
     def test_no_valid_wallpaper(self):
@@ -464,6 +464,116 @@ class OneConfSyncing(unittest.TestCase):
         shutil.copy(os.path.join(os.path.dirname(__file__), "data", "oneconf.invaliddistro.override"), "/tmp/oneconf.override")
         self.assertFalse(self.check_msg_in_output("Start processing sync"))
 
+    def test_fake_infra_network_model(self):
+        '''The fake infra delays and failures follow the silo settings'''
+        silo = FakeWebCatalogSilo()
+        silo.set_setting('fake_network_delay', 0.5)
+        silo.set_setting('fake_endpoint_latency', {'list_packages': 1})
+        silo.set_setting('fake_bandwidth', 1000)
+        self.assertEqual(silo.get_network_delay('list_machines'), 0.5)
+        self.assertEqual(silo.get_network_delay('list_packages', 500), 1.5)
+        silo.set_setting('fake_jitter', 0.1)
+        silo.set_setting('fake_failure_rate', 0.5)
+        silo.set_setting('fake_seed', 42)
+        delays = [silo.get_network_delay('list_machines') for i in range(5)]
+        failures = [silo.inject_failure('list_machines') for i in range(20)]
+        for delay in delays:
+            self.assertTrue(0.45 <= delay <= 0.55)
+        self.assertTrue(True in failures and False in failures)
+        silo.set_setting('fake_seed', 42)
+        self.assertEqual(
+            [silo.get_network_delay('list_machines') for i in range(5)],
+            delays)
+        self.assertEqual(
+            [silo.inject_failure('list_machines') for i in range(20)],
+            failures)
+
+    def test_fake_infra_package_endpoints(self):
+        '''The package endpoints of the fake infra get delays and failures'''
+        from oneconf.networksync.infraclient_fake import WebCatalogAPI
+        from piston_mini_client.failhandlers import APIError
+        api = WebCatalogAPI()
+        api.silo.set_setting('fake_network_delay', 0)
+        api.silo.set_setting('fake_endpoint_latency',
+                             {'list_packages': 0.3, 'update_packages': 0.3})
+        api.update_machine(machine_uuid='AAAAA', hostname='foo')
+        start = time.time()
+        api.update_packages(machine_uuid='AAAAA', packages_checksum='ck',
+                            package_list={'bar': {'auto': False}})
+        self.assertTrue(time.time() - start >= 0.3)
+        start = time.time()
+        self.assertEqual(api.list_packages(machine_uuid='AAAAA'),
+                         {'bar': {'auto': False}})
+        self.assertTrue(time.time() - start >= 0.3)
+        api.silo.set_setting('fake_endpoint_latency', {})
+        api.silo.set_setting('fake_failure_rate', 1)
+        self.assertRaises(APIError, api.list_packages, machine_uuid='AAAAA')
+        self.assertRaises(APIError, api.update_packages, machine_uuid='AAAAA',
+                          packages_checksum='ck', package_list={})
+
+    def test_webcatalog_server(self):
+        '''The local HTTP stand-in answers from the silo and counts requests'''
+        try:
+            from urllib.request import Request, urlopen
+            from urllib.error import HTTPError
+        except ImportError:
+            # Python 2
+            from urllib2 import Request, urlopen, HTTPError
+        from oneconf.networksync.webcatalog_server import WebCatalogServer
+        server = WebCatalogServer()
+        server.silo.set_setting('fake_network_delay', 0)
+        server.start()
+        try:
+            root = server.service_root
+            self.assertEqual(json.loads(urlopen(
+                root + 'server-status/').read().decode('utf-8')), 'ok')
+            urlopen(Request(root + 'machine/AAAAA/',
+                            json.dumps({'hostname': 'foo'}).encode('utf-8')))
+            urlopen(Request(root + 'packages/AAAAA/', json.dumps(
+                {'package_list': {'bar': {'auto': False}},
+                 'packages_checksum': 'ck'}).encode('utf-8')))
+            self.assertEqual(server.silo.get_host_silo()['AAAAA'],
+                             {'hostname': 'foo', 'logo_checksum': None,
+                              'packages_checksum': 'ck'})
+            self.assertRaises(HTTPError, urlopen, root + 'packages/BBBBB/')
+            # deleting an unknown host doesn't touch the other silo data
+            server.silo.get_package_silo()['BBBBB'] = {'bar': {'auto': False}}
+            request = Request(root + 'machine/BBBBB/')
+            request.get_method = lambda: 'DELETE'
+            self.assertRaises(HTTPError, urlopen, request)
+            self.assertTrue('BBBBB' in server.silo.get_package_silo())
+            server.silo.set_setting('server_response_error', True)
+            self.assertRaises(HTTPError, urlopen, root + 'server-status/')
+        finally:
+            server.stop()
+        self.assertEqual(server.stats['server_status']['requests'], 2)
+        self.assertEqual(server.stats['list_packages']['requests'], 1)
+        self.assertTrue(server.stats['update_packages']['bytes_received'] > 0)
+
+    def test_fake_fleet(self):
+        '''Virtual hosts of a fake fleet see each other and their changes'''
+        from oneconf.networksync.fake_fleet import FakeFleet
+        fleet = FakeFleet(3, nb_packages=50, nb_changes=5)
+        (first_round, steady) = fleet.run(1)
+        self.assertTrue(first_round['requests'] > 0)
+        self.assertTrue(steady['bytes'] > 0)
+        silo = fleet.infraclient.silo
+        self.assertEqual(sorted(silo.get_host_silo()),
+                         ['simhost00000', 'simhost00001', 'simhost00002'])
+        # every change was pushed, then downloaded by the other hosts
+        for virtual_host in fleet.virtual_hosts:
+            self.assertEqual(silo.get_package_silo()[virtual_host.hostid],
+                             virtual_host.package_list)
+        self.assertEqual(sorted(fleet.virtual_hosts[0].hosts.other_hosts),
+                         ['simhost00001', 'simhost00002'])
+        # the virtual hosts only live in a temporary directory
+        self.assertFalse(os.path.exists(os.path.join(paths.ONECONF_CACHE_DIR,
+                                                     'simhost00000')))
+        self.assertTrue(os.path.isdir(os.path.join(fleet.cache_dir,
+                                                   'simhost00000')))
+        fleet.close()
+        self.assertFalse(os.path.exists(fleet.cache_dir))
+
 #
 # main
 #